@@ -0,0 +1,74 @@
+import argparse
+import io
+import time
+
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from db import configure, run_transaction
+from sql_queries import create_staging_immigration_table
+from warehouse import PostgresWarehouse, use_warehouse
+
+
+def copy_binary(cur, conn, warehouse):
+    """
+    Load staging immigration through the warehouse backend's binary COPY
+
+    """
+    cur.execute(warehouse.ddl(create_staging_immigration_table))
+    return warehouse.copy(cur, 'staging_immigration', 'staging_immigration_copy')
+
+
+def copy_csv(cur, conn, warehouse):
+    """
+    Baseline: load staging immigration with one CSV COPY per Parquet file
+
+    """
+    cur.execute(warehouse.ddl(create_staging_immigration_table))
+    rows = 0
+    for path in warehouse.dataset_files('immigration_data'):
+        table = pq.read_table(path)
+        buffer = io.BytesIO()
+        pa_csv.write_csv(table, buffer, pa_csv.WriteOptions(include_header=False))
+        buffer.seek(0)
+        cur.copy_expert("COPY public.staging_immigration FROM STDIN WITH (FORMAT csv)", buffer)
+        rows += table.num_rows
+    return rows
+
+
+def time_load(load, warehouse, repeat):
+    """
+    Best of repeat loads, returning (rows, seconds)
+
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = run_transaction('stage', load, warehouse)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return rows, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark loading staging immigration into a local PostgreSQL')
+    parser.add_argument('--processed-path', required=True,
+                        help='local preprocessing output holding immigration_data and its manifest')
+    parser.add_argument('--dsn', required=True)
+    parser.add_argument('--batch-rows', type=int, nargs='+', default=[10000, 100000, 500000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    configure(dsn=args.dsn)
+    loads = [('csv', copy_csv, PostgresWarehouse(args.processed_path))]
+    loads += [(f'binary {batch_rows}', copy_binary, PostgresWarehouse(args.processed_path, batch_rows))
+              for batch_rows in args.batch_rows]
+
+    for name, load, warehouse in loads:
+        use_warehouse(warehouse)
+        rows, seconds = time_load(load, warehouse, args.repeat)
+        print(f'{name:>16}: {seconds:.2f}s for {rows} rows ({rows / seconds:,.0f} rows/s)')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import argparse
+import time
+
+from pyspark.sql import SparkSession
+from pyspark.sql import functions as f
+
+from decoding import decode_immigration
+
+DECODED_COLUMNS = ['arrival_date', 'arrival_day', 'departure_date', 'mode', 'visa_category']
+
+
+def synthetic_month(spark, rows, partitions):
+    """
+    Build a synthetic I94 month with the columns the decoders read
+    
+    Keyword arguments:
+    spark -- Spark Context
+    rows -- number of I94 records
+    partitions -- number of Spark partitions
+    
+    """
+    # April 2016 in SAS days, with the odd null and out of range code
+    month_start = 20545
+    return spark.range(0, rows, numPartitions=partitions) \
+        .withColumn('arrdate', (month_start + f.floor(f.rand(1) * 30)).cast('double')) \
+        .withColumn('depdate', f.when(f.rand(2) < 0.05, None)
+                    .otherwise(f.col('arrdate') + f.floor(f.rand(3) * 60)).cast('double')) \
+        .withColumn('i94mode', f.when(f.rand(4) < 0.01, None)
+                    .otherwise(f.floor(f.rand(5) * 4) + 1).cast('double')) \
+        .withColumn('i94visa', f.floor(f.rand(6) * 4 + 1).cast('double')) \
+        .cache()
+
+
+def time_engine(df, engine):
+    """
+    Time one decoding engine over the full DataFrame
+    
+    Keyword arguments:
+    df -- synthetic I94 DataFrame
+    engine -- decoding engine name
+    
+    """
+    decoded = decode_immigration(df, engine=engine).select(DECODED_COLUMNS)
+    start = time.perf_counter()
+    decoded.write.format('noop').mode('overwrite').save()
+    return time.perf_counter() - start
+
+
+def check_equivalence(df):
+    """
+    Count rows where the native engine disagrees with the UDF reference
+    
+    Keyword arguments:
+    df -- synthetic I94 DataFrame
+    
+    """
+    native = decode_immigration(df, engine='native').select(['id'] + DECODED_COLUMNS)
+    reference = decode_immigration(df, engine='udf').select(['id'] + DECODED_COLUMNS)
+    return native.exceptAll(reference).count() + reference.exceptAll(native).count()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark I94 decoding engines on a synthetic month')
+    parser.add_argument('--rows', type=int, default=3000000)
+    parser.add_argument('--partitions', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    spark = SparkSession.builder.appName('decoding-benchmark').getOrCreate()
+    df = synthetic_month(spark, args.rows, args.partitions)
+    df.count()
+
+    mismatches = check_equivalence(df)
+    print(f'Rows differing between native and udf engines: {mismatches}')
+
+    timings = {}
+    for engine in ['udf', 'native']:
+        timings[engine] = min(time_engine(df, engine) for _ in range(args.repeat))
+        print(f'{engine:>6}: {timings[engine]:.2f}s for {args.rows} rows')
+    print(f'Speedup: {timings["udf"] / timings["native"]:.1f}x')
+
+    spark.stop()
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from pyspark.sql import SparkSession
+
+import code_mapping
+from benchmarks.synthetic_i94 import learn_distributions, write_month, month_path
+from join_keys import normalize_key
+
+MONTH = 4
+MON = 'apr'
+
+
+class PeakMemory:
+    """
+    Peak resident memory of this process and its children, such as the Spark JVM
+
+    Sampled from /proc in a background thread while the block runs.
+
+    """
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak_bytes = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+    def sample(self):
+        while True:
+            self.peak_bytes = max(self.peak_bytes, process_tree_rss(os.getpid()))
+            if self.stopped.wait(self.interval):
+                return
+
+
+def process_tree_rss(root):
+    """
+    Resident bytes of a process and all of its descendants
+
+    Keyword arguments:
+    root -- process id
+
+    """
+    children = {}
+    rss = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        pid = int(entry)
+        children.setdefault(int(fields[1]), []).append(pid)
+        rss[pid] = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+
+    total, pending = 0, [root]
+    while pending:
+        pid = pending.pop()
+        total += rss.get(pid, 0)
+        pending.extend(children.get(pid, []))
+    return total
+
+
+def measure(step, rows, func):
+    """
+    Run one benchmark step, returning its throughput and peak memory
+
+    Keyword arguments:
+    step -- step name
+    rows -- rows the step handles
+    func -- callable running the step
+
+    """
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+    return {'step': step, 'rows': rows, 'seconds': seconds, 'rows_per_second': rows / seconds,
+            'peak_rss_mb': memory.peak_bytes / 2 ** 20}
+
+
+def stage_postgres(cur, conn):
+    """
+    Create staging tables and load the processed immigration month and code tables
+
+    Immigration goes through the PostgreSQL warehouse backend. Ports and
+    countries come straight from the code tables, as the benchmark does not
+    preprocess them.
+
+    """
+    import stage_data
+
+    stage_data.create_tables(cur, conn)
+    stage_data.stage_table(cur, conn, 'staging_immigration')
+    stage_data.stage_table(cur, conn, 'staging_immigration_keys')
+
+    labels = code_mapping.load_labels()
+    ports = code_mapping.port_df(labels)
+    cur.executemany("INSERT INTO public.staging_ports VALUES (%s, %s, %s, %s)",
+                    [(row.port_code, row.port_city, row.port_state, normalize_key(row.port_city))
+                     for row in ports.itertuples()])
+    cur.executemany("INSERT INTO public.staging_countries VALUES (%s, %s, %s)",
+                    [(code, country, normalize_key(country))
+                     for code, country in code_mapping.country_dictionary(labels).items()])
+
+
+def extract_postgres(max_workers):
+    """
+    Build fact and dimension tables from staging as a full load would
+
+    Keyword arguments:
+    max_workers -- number of fact chunks loaded at the same time
+
+    """
+    import extract_data
+    from db import run_transaction
+    from fact_loader import load_fact_immigration
+    from time_loader import load_time_dimension
+
+    run_transaction('extract', extract_data.create_tables)
+    run_transaction('extract', extract_data.ensure_tables)
+    run_transaction('extract', extract_data.insert_fact_dim_tables)
+    load_time_dimension()
+    load_fact_immigration(max_workers=max_workers)
+
+
+def run_scale(spark, rows, work_dir, distributions, dsn=None, max_workers=4):
+    """
+    Benchmark preprocessing, staging and extraction of one synthetic month
+
+    Keyword arguments:
+    spark -- local Spark session
+    rows -- rows in the synthetic month
+    work_dir -- directory holding raw and processed data
+    distributions -- column distributions for the generator
+    dsn -- local PostgreSQL connection string, None to skip the SQL steps
+    max_workers -- number of fact chunks loaded at the same time
+
+    """
+    from preprocessing import process_immigration_data
+    from warehouse import PostgresWarehouse, use_warehouse
+
+    raw_dir = os.path.join(work_dir, 'raw', str(rows))
+    if not os.path.exists(month_path(raw_dir, MONTH, 'parquet')):
+        write_month(raw_dir, rows, 'parquet', month=MONTH, distributions=distributions)
+    load_path = os.path.join(os.path.abspath(raw_dir), 'i94_{mon}16_sub.parquet')
+    processed_path = os.path.join(os.path.abspath(work_dir), 'processed', str(rows)) + '/'
+
+    results = [measure('preprocess', rows, lambda: process_immigration_data(
+        spark, processed_path, months=[MON], load_path=load_path, force=True, load_format='parquet'))]
+
+    if dsn is not None:
+        from db import configure, run_transaction
+        use_warehouse(PostgresWarehouse(processed_path))
+        configure(dsn=dsn)
+        results.append(measure('stage', rows, lambda: run_transaction('stage', stage_postgres)))
+        results.append(measure('extract', rows, lambda: extract_postgres(max_workers)))
+    return results
+
+
+def print_results(results):
+    """
+    Print throughput per step and scale, relative to the smallest scale
+
+    """
+    smallest = {}
+    for result in sorted(results, key=lambda r: r['rows']):
+        smallest.setdefault(result['step'], result['rows_per_second'])
+
+    print(f'{"step":<12} {"rows":>12} {"seconds":>9} {"rows/s":>12} {"vs smallest":>12} {"peak MB":>9}')
+    for result in sorted(results, key=lambda r: (r['step'], r['rows'])):
+        relative = result['rows_per_second'] / smallest[result['step']]
+        print(f'{result["step"]:<12} {result["rows"]:>12} {result["seconds"]:>9.1f} '
+              f'{result["rows_per_second"]:>12,.0f} {relative:>11.2f}x {result["peak_rss_mb"]:>9.0f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on synthetic I94 months of growing size')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000000, 10000000, 50000000])
+    parser.add_argument('--work-dir', default='data/benchmark')
+    parser.add_argument('--dsn', default=None,
+                        help='local PostgreSQL to run staging and extract against, e.g. "dbname=immigration"')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--results', default='benchmarks/scaling_results.jsonl',
+                        help='JSONL file every run is appended to')
+    args = parser.parse_args()
+
+    spark = SparkSession.builder.master('local[*]').appName('scaling-benchmark') \
+        .config('spark.sql.sources.partitionOverwriteMode', 'dynamic').getOrCreate()
+    distributions = learn_distributions()
+
+    results = []
+    try:
+        for rows in args.rows:
+            results.extend(run_scale(spark, rows, args.work_dir, distributions, args.dsn, args.workers))
+    finally:
+        spark.stop()
+
+    run_at = datetime.now().isoformat()
+    with open(args.results, 'a') as f:
+        for result in results:
+            f.write(json.dumps(dict(result, run_at=run_at)) + '\n')
+    print_results(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+from cli import COMMANDS
+
+
+def time_startup_python(repeat):
+    """
+    Wall time to start a bare Python interpreter
+    
+    Keyword arguments:
+    repeat -- number of fresh interpreters to time
+    
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def time_startup(command, repeat):
+    """
+    Wall time to start Python and resolve a subcommand's entry point
+    
+    Keyword arguments:
+    command -- subcommand name
+    repeat -- number of fresh interpreters to time
+    
+    """
+    code = f"import cli; cli.resolve({command!r})"
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark CLI startup time per subcommand')
+    parser.add_argument('commands', nargs='*', default=list(COMMANDS))
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    baseline = statistics.median(time_startup_python(args.repeat))
+    print(f'{"python":>12}: {baseline:.3f}s median (interpreter only)')
+    for command in args.commands:
+        timings = time_startup(command, args.repeat)
+        print(f'{command:>12}: {statistics.median(timings):.3f}s median, {max(timings):.3f}s max')
+
+
+if __name__ == "__main__":
+    main()
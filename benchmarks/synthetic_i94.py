@@ -0,0 +1,262 @@
+import argparse
+import calendar
+import csv
+import os
+import time
+from collections import Counter
+from datetime import date
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+import code_mapping
+
+SAMPLE_PATH = 'immigration_data_sample.csv'
+SAS_EPOCH = date(1960, 1, 1)
+
+# Generated column -> code table whose codes are also drawn, beyond those seen in the sample
+CODE_TABLES = {
+    'i94cit': 'i94cntyl',
+    'i94res': 'i94cntyl',
+    'i94port': '$i94prtl',
+    'i94addr': 'i94addrl',
+}
+
+# Columns drawn independently from their sample frequencies
+CATEGORICAL = ['i94cit', 'i94res', 'i94port', 'i94mode', 'i94addr', 'i94visa', 'gender', 'airline', 'visatype']
+
+# Output columns in the order and types the SAS reader produces
+SCHEMA = pa.schema([
+    ('cicid', pa.float64()), ('i94yr', pa.float64()), ('i94mon', pa.float64()),
+    ('i94cit', pa.float64()), ('i94res', pa.float64()), ('i94port', pa.string()),
+    ('arrdate', pa.float64()), ('i94mode', pa.float64()), ('i94addr', pa.string()),
+    ('depdate', pa.float64()), ('i94bir', pa.float64()), ('i94visa', pa.float64()),
+    ('count', pa.float64()), ('biryear', pa.float64()), ('gender', pa.string()),
+    ('airline', pa.string()), ('visatype', pa.string()),
+])
+
+NUMERIC = {field.name for field in SCHEMA if pa.types.is_floating(field.type)}
+
+
+def parse_value(column, value):
+    """
+    Sample CSV value as the type of its output column, None when empty
+
+    """
+    if value == '':
+        return None
+    if column in NUMERIC:
+        return float(value)
+    return value
+
+
+def frequencies(values, extra_codes=(), code_share=0.0):
+    """
+    Values and their probabilities
+
+    A code_share of the probability is spread evenly over extra_codes, so
+    codes missing from a small sample still appear at scale.
+
+    Keyword arguments:
+    values -- observed values, None for missing
+    extra_codes -- other valid values
+    code_share -- probability given to extra_codes
+
+    """
+    counts = Counter(values)
+    support = list(counts)
+    for code in extra_codes:
+        if code not in counts:
+            support.append(code)
+
+    total = sum(counts.values())
+    observed = np.array([counts.get(value, 0) / total for value in support])
+    probabilities = observed * (1 - code_share)
+    if extra_codes and code_share:
+        codes = set(extra_codes)
+        uniform = np.array([1.0 if value in codes else 0.0 for value in support])
+        probabilities += code_share * uniform / uniform.sum()
+    return support, probabilities / probabilities.sum()
+
+
+def learn_distributions(sample_path=SAMPLE_PATH, labels=None, code_share=0.02):
+    """
+    Column distributions from the sample CSV and the label code tables
+
+    Keyword arguments:
+    sample_path -- I94 sample CSV
+    labels -- lookup tables from code_mapping.load_labels
+    code_share -- probability spread over valid codes missing from the sample
+
+    """
+    labels = code_mapping.load_labels() if labels is None else labels
+    with open(sample_path, newline='') as f:
+        rows = [{column: parse_value(column, value) for column, value in row.items() if column in SCHEMA.names}
+                for row in csv.DictReader(f)]
+
+    distributions = {}
+    for column in CATEGORICAL:
+        extra = []
+        if column in CODE_TABLES:
+            extra = list(labels[CODE_TABLES[column]])
+            if column in NUMERIC:
+                extra = [float(code) for code in extra]
+        distributions[column] = frequencies([row[column] for row in rows], extra, code_share)
+
+    distributions['i94bir'] = frequencies([row['i94bir'] for row in rows])
+    distributions['stay'] = frequencies([
+        row['depdate'] - row['arrdate'] if row['depdate'] is not None and row['arrdate'] is not None else None
+        for row in rows])
+    distributions['day_of_week'] = frequencies([
+        date.fromordinal(SAS_EPOCH.toordinal() + int(row['arrdate'])).weekday()
+        for row in rows if row['arrdate'] is not None])
+    return distributions
+
+
+def draw(rng, distribution, size, numeric=False):
+    """
+    Draw values from a (support, probabilities) distribution
+
+    Numeric draws are float arrays with NaN for missing values, others are
+    object arrays with None.
+
+    """
+    support, probabilities = distribution
+    if numeric:
+        values = np.array([np.nan if value is None else value for value in support], dtype=float)
+    else:
+        values = np.empty(len(support), dtype=object)
+        values[:] = support
+    return values[rng.choice(len(support), size=size, p=probabilities)]
+
+
+def numeric_array(values):
+    """
+    Float Arrow array with NaN stored as null
+
+    """
+    return pa.array(values, type=pa.float64(), from_pandas=True)
+
+
+def month_days(year, month, distributions):
+    """
+    SAS days of a month and the probability of arriving on each
+
+    Each day is weighted by how often its weekday appears in the sample.
+
+    """
+    weekday_support, weekday_probabilities = distributions['day_of_week']
+    weekday_weight = dict(zip(weekday_support, weekday_probabilities))
+    days = range(1, calendar.monthrange(year, month)[1] + 1)
+    sas_days = np.array([(date(year, month, day) - SAS_EPOCH).days for day in days], dtype=float)
+    weights = np.array([weekday_weight.get(date(year, month, day).weekday(), 0.0) for day in days])
+    return sas_days, weights / weights.sum()
+
+
+def generate_batches(distributions, rows, year=2016, month=4, batch_rows=1000000, seed=0):
+    """
+    Yield Arrow record batches of a synthetic I94 month
+
+    Keyword arguments:
+    distributions -- column distributions from learn_distributions
+    rows -- number of I94 records
+    year -- arrival year
+    month -- arrival month
+    batch_rows -- records per batch, bounding memory use
+    seed -- random seed, the same seed gives the same month
+
+    """
+    rng = np.random.default_rng(seed)
+    sas_days, day_probabilities = month_days(year, month, distributions)
+
+    for offset in range(0, rows, batch_rows):
+        size = min(batch_rows, rows - offset)
+        arrdate = sas_days[rng.choice(len(sas_days), size=size, p=day_probabilities)]
+        depdate = arrdate + draw(rng, distributions['stay'], size, numeric=True)
+        age = draw(rng, distributions['i94bir'], size, numeric=True)
+
+        columns = {
+            'cicid': pa.array(np.arange(offset + 1, offset + size + 1, dtype=float)),
+            'i94yr': pa.array(np.full(size, float(year))),
+            'i94mon': pa.array(np.full(size, float(month))),
+            'arrdate': pa.array(arrdate),
+            'depdate': numeric_array(depdate),
+            'i94bir': numeric_array(age),
+            'count': pa.array(np.ones(size)),
+            'biryear': numeric_array(year - age),
+        }
+        for column in CATEGORICAL:
+            if column in NUMERIC:
+                columns[column] = numeric_array(draw(rng, distributions[column], size, numeric=True))
+            else:
+                columns[column] = pa.array(draw(rng, distributions[column], size), type=pa.string())
+        yield pa.RecordBatch.from_arrays([columns[name] for name in SCHEMA.names], schema=SCHEMA)
+
+
+def month_path(out_dir, month, fmt):
+    """
+    Output file for a month, named like the raw I94 files
+
+    """
+    mon = calendar.month_abbr[month].lower()
+    return os.path.join(out_dir, f'i94_{mon}16_sub.{fmt}')
+
+
+def write_month(out_dir, rows, fmt='parquet', year=2016, month=4, batch_rows=1000000, seed=0, distributions=None):
+    """
+    Write a synthetic I94 month as CSV or Parquet and return its path
+
+    Keyword arguments:
+    out_dir -- output directory
+    rows -- number of I94 records
+    fmt -- 'parquet' or 'csv'
+    year -- arrival year
+    month -- arrival month
+    batch_rows -- records generated and written at a time
+    seed -- random seed
+    distributions -- column distributions, learned from the sample by default
+
+    """
+    if fmt not in ('parquet', 'csv'):
+        raise ValueError(f"Unknown format {fmt}. Expected 'parquet' or 'csv'")
+    distributions = learn_distributions() if distributions is None else distributions
+    os.makedirs(out_dir, exist_ok=True)
+    path = month_path(out_dir, month, fmt)
+    tmp_path = f'{path}.tmp'
+
+    batches = generate_batches(distributions, rows, year, month, batch_rows, seed)
+    if fmt == 'parquet':
+        with pq.ParquetWriter(tmp_path, SCHEMA) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+    else:
+        with pa_csv.CSVWriter(tmp_path, SCHEMA) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+    os.replace(tmp_path, path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic I94 months learned from the sample data')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000000])
+    parser.add_argument('--format', choices=['parquet', 'csv'], default='parquet')
+    parser.add_argument('--out', default='data/synthetic')
+    parser.add_argument('--month', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    distributions = learn_distributions()
+    for rows in args.rows:
+        out_dir = os.path.join(args.out, f'{rows}')
+        start = time.perf_counter()
+        path = write_month(out_dir, rows, args.format, month=args.month, seed=args.seed,
+                           distributions=distributions)
+        seconds = time.perf_counter() - start
+        print(f'{rows:>10} rows -> {path} in {seconds:.1f}s ({rows / seconds:,.0f} rows/s)')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import argparse
+import importlib
+import sys
+
+# subcommand -> (module, function); modules are only imported when their
+# subcommand runs, so `check`, `query` and `queries` never load Spark or pandas
+COMMANDS = {
+    'run': ('pipeline', 'main'),
+    'preprocess': ('preprocessing', 'preprocess_data'),
+    'compact': ('preprocessing', 'compact_data'),
+    'stage': ('stage_data', 'stage_data'),
+    'extract': ('extract_data', 'extract_data'),
+    'check': ('quality_check', 'check_data_quality'),
+    'query': ('query_data', 'print_report'),
+    'queries': ('query_service', 'run_queries'),
+}
+
+
+def resolve(command):
+    """
+    Import the module behind a subcommand and return its entry point
+
+    Keyword arguments:
+    command -- subcommand name
+
+    """
+    module, function = COMMANDS[command]
+    return getattr(importlib.import_module(module), function)
+
+
+def build_parser():
+    """
+    Argument parser with one subcommand per pipeline stage
+
+    """
+    parser = argparse.ArgumentParser(description='Run a single stage of the immigration pipeline')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run = subparsers.add_parser('run', help='Run the whole pipeline as a dependency graph')
+    run.add_argument('--workers', type=int, default=4, dest='max_workers',
+                     help='steps running at the same time')
+    run.add_argument('--incremental', action='store_true',
+                     help='upsert dimensions and only replace staged fact partitions')
+    run.add_argument('--force', action='store_true',
+                     help='preprocess datasets whose inputs and code are unchanged')
+
+    preprocess = subparsers.add_parser('preprocess', help='Clean raw data with Spark and write it to S3')
+    preprocess.add_argument('--force', action='store_true',
+                            help='process datasets whose inputs and code are unchanged')
+    compact = subparsers.add_parser('compact', help='Rewrite processed immigration months at the target file size')
+    compact.add_argument('--months', nargs='+', default=None, metavar='MON',
+                         help='month abbreviations to compact, all by default')
+    compact.add_argument('--target-file-mb', type=int, default=None,
+                         help='target Parquet file size, [LAYOUT] TARGET_FILE_MB by default')
+    stage = subparsers.add_parser('stage', help='Copy processed data from S3 into staging tables')
+    stage.add_argument('--workers', type=int, default=6, dest='max_workers',
+                       help='COPYs running at the same time')
+    stage.add_argument('--no-manifests', action='store_false', dest='use_manifests',
+                       help='copy every file under each dataset instead of its manifest')
+    stage.add_argument('--incremental', action='store_true',
+                       help='stage only the immigration months written by the last preprocess, for extract --incremental')
+
+    extract = subparsers.add_parser('extract', help='Load fact and dimension tables from staging')
+    extract.add_argument('--incremental', action='store_true',
+                         help='upsert dimensions and only replace staged fact partitions')
+    extract.add_argument('--workers', type=int, default=4, dest='max_workers',
+                         help='fact chunks loaded at the same time')
+    extract.add_argument('--resume', action='store_true',
+                         help='continue an interrupted fact load')
+
+    check = subparsers.add_parser('check', help='Run data quality checks')
+    check.add_argument('--workers', type=int, default=4, dest='max_workers',
+                       help='table scans running at the same time')
+    check.add_argument('--sample', type=int, default=None, dest='sample_rows', metavar='ROWS',
+                       help='smoke check only the first ROWS rows of each table')
+
+    query = subparsers.add_parser('query', help='Print an analytics report')
+    query.add_argument('report', choices=['immigrants-by-country', 'arrival-days'])
+
+    queries = subparsers.add_parser('queries', help='Run catalog queries concurrently and print their rows')
+    queries.add_argument('names', nargs='+', metavar='QUERY',
+                         help='query names from query_service.CATALOG')
+    queries.add_argument('--start-year', type=int, default=None)
+    queries.add_argument('--start-month', type=int, default=None)
+    queries.add_argument('--end-year', type=int, default=None)
+    queries.add_argument('--end-month', type=int, default=None)
+    queries.add_argument('--country', default=None, help='country name or I94 country code')
+    queries.add_argument('--port', default=None, help='I94 port code')
+    queries.add_argument('--visa-category', default=None)
+    queries.add_argument('--limit', type=int, default=None, help='rows of top-N queries')
+    queries.add_argument('--workers', type=int, default=None, dest='max_concurrency',
+                         help='queries running at the same time')
+    queries.add_argument('--timeout', type=float, default=None, dest='timeout_s',
+                         help='per-query timeout in seconds')
+    return parser
+
+
+def main(argv=None):
+    args = vars(build_parser().parse_args(argv))
+    command = args.pop('command')
+    entry_point = resolve(command)
+    try:
+        entry_point(**args)
+    finally:
+        # only close the pool if this process opened one
+        if 'db' in sys.modules:
+            sys.modules['db'].close_pool()
+        if 'instrumentation' in sys.modules:
+            sys.modules['instrumentation'].print_summary()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,222 @@
-import pandas as pd
-
-def read_lines():
-    """
-    Read in 
-    
-    """
-    codes = 'I94_SAS_Labels_Descriptions.SAS'
-    with open(codes) as f:
-        lines = f.readlines()
-        
-    lines = [line.replace('"','').replace('\n','').replace("'",'').replace('\t','') for line in lines]
-    return lines
-
-def country_dictionary(lines):
-    origin_country = lines[9:298]
-    oc_codes = [x.split('=')[0].replace(' ', '') for x in origin_country]
-    oc_countries = [' '.join(x.split('=')[-1].split(' ')[2:]) for x in origin_country]
-    oc = dict(zip(oc_codes, oc_countries))
-    return oc
-
-def port_df(lines):
-    ports = lines[302:961]
-    p_codes = [x.split('=')[0].replace(' ', '') for x in ports]
-    p_city = [x.split('=')[-1].split(',')[0] for x in ports]
-    p_state = [x.split('=')[-1].split(',')[-1].replace(' ', '') for x in ports]
-    
+import hashlib
+import json
+import os
+import re
+
+LABELS_PATH = 'I94_SAS_Labels_Descriptions.SAS'
+CACHE_PATH = '.i94_labels_cache.json'
+
+# Bump when the parser output changes so stale caches are rebuilt
+PARSER_VERSION = 1
+
+# (labels path, cache path) -> ((mtime_ns, size) of the labels file, tables)
+_labels = {}
+
+VALUE_BLOCK = re.compile(r"^\s*value\s+(\$?\w+)", re.IGNORECASE)
+COMMENT_BLOCK = re.compile(r"^\s*/\*\s*(\w+)\s+-")
+QUOTED = r"'((?:[^']|'')*)'"
+ENTRY = re.compile(r"^\s*(?:{0}|([^\s=']+))\s*=\s*(?:{0}|([^;]*?))\s*(;)?\s*$".format(QUOTED))
+
+
+def parse_entry(line):
+    """
+    Parse one `code = label` line
+
+    Returns (code, label, ends_block), or None when the line is not an
+    entry. Quoted codes are kept as strings, bare codes become ints.
+
+    Keyword arguments:
+    line -- line from the labels file
+
+    """
+    match = ENTRY.match(line)
+    if match is None:
+        return None
+    quoted_code, bare_code, quoted_label, bare_label, end = match.groups()
+    if quoted_code is not None:
+        code = quoted_code.replace("''", "'").strip()
+    else:
+        code = int(bare_code) if bare_code.isdigit() else bare_code
+    label = quoted_label.replace("''", "'") if quoted_label is not None else bare_label
+    return code, label.strip(), end is not None
+
+
+def parse_labels(path=LABELS_PATH):
+    """
+    Parse every lookup table in the SAS labels file
+
+    Reads the file line by line and collects each `value <name>` block, plus
+    code lists documented inside comments (I94VISA), keyed by block name.
+
+    Keyword arguments:
+    path -- labels file location
+
+    """
+    tables = {}
+    current = None
+    in_comment = None
+    with open(path, encoding='latin-1') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+
+            value_block = VALUE_BLOCK.match(line)
+            if value_block:
+                current = tables.setdefault(value_block.group(1).lower(), {})
+                continue
+
+            comment = COMMENT_BLOCK.match(line)
+            if comment and current is None:
+                in_comment = comment.group(1).lower()
+            if in_comment is not None:
+                entry = parse_entry(line)
+                if entry is not None and isinstance(entry[0], int):
+                    tables.setdefault(in_comment, {})[entry[0]] = entry[1]
+                if '*/' in line:
+                    in_comment = None
+                continue
+
+            if current is None:
+                continue
+            entry = parse_entry(line)
+            if entry is not None:
+                code, label, ends_block = entry
+                current[code] = label
+                if ends_block:
+                    current = None
+            elif line.strip() == ';':
+                current = None
+    return tables
+
+
+def file_hash(path):
+    """
+    SHA-256 of a file's contents
+
+    Keyword arguments:
+    path -- file location
+
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_labels(path=LABELS_PATH, cache_path=CACHE_PATH):
+    """
+    Lookup tables from the labels file, cached in memory and on disk
+
+    Tables are kept for the process while the labels file's mtime and size
+    are unchanged, so callers share one copy and must not modify it. The
+    disk cache is reused while the labels file hash and parser version
+    match, and rebuilt otherwise.
+
+    Keyword arguments:
+    path -- labels file location
+    cache_path -- compiled cache location, None to disable caching
+
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), cache_path and os.path.abspath(cache_path))
+    version = (stat.st_mtime_ns, stat.st_size)
+    loaded = _labels.get(key)
+    if loaded is not None and loaded[0] == version:
+        return loaded[1]
+    tables = load_labels_file(path, cache_path)
+    _labels[key] = (version, tables)
+    return tables
+
+
+def load_labels_file(path, cache_path):
+    """
+    Lookup tables from the disk cache, or parsed from the labels file
+
+    Keyword arguments:
+    path -- labels file location
+    cache_path -- compiled cache location, None to disable caching
+
+    """
+    source_hash = file_hash(path)
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+        if cache.get('source_hash') == source_hash and cache.get('parser_version') == PARSER_VERSION:
+            return {name: dict((code, label) for code, label in entries)
+                    for name, entries in cache['tables'].items()}
+
+    tables = parse_labels(path)
+    if cache_path:
+        cache = {
+            'source_hash': source_hash,
+            'parser_version': PARSER_VERSION,
+            # pairs rather than objects so int codes keep their type
+            'tables': {name: list(entries.items()) for name, entries in tables.items()},
+        }
+        tmp_path = f'{cache_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, cache_path)
+    return tables
+
+
+def country_dictionary(labels):
+    """
+    Country codes as strings mapped to country names
+
+    Keyword arguments:
+    labels -- lookup tables from load_labels
+
+    """
+    return {str(code): country for code, country in labels['i94cntyl'].items()}
+
+
+def port_columns(labels):
+    """
+    Port codes, cities and states as three lists
+
+    Keyword arguments:
+    labels -- lookup tables from load_labels
+
+    """
+    p_codes, p_city, p_state = [], [], []
+    for code, label in labels['$i94prtl'].items():
+        p_codes.append(code)
+        p_city.append(label.split(',')[0].strip())
+        p_state.append(label.split(',')[-1].replace(' ', '') if ',' in label else None)
+    return p_codes, p_city, p_state
+
+
+def port_df(labels):
+    """
+    Port codes with their city and state
+
+    Keyword arguments:
+    labels -- lookup tables from load_labels
+
+    """
+    import pandas as pd
+
+    p_codes, p_city, p_state = port_columns(labels)
     port_df = pd.DataFrame({
         'port_code': p_codes,
         'port_city': p_city,
         'port_state': p_state
     })
     return port_df
-    
-    
-lines = read_lines()
-country_codes = country_dictionary(lines)
-port_codes = port_df(lines)
+
+
+_lookups = {}
+
+
+def __getattr__(name):
+    """
+    Build country_codes and port_codes on first access
+
+    """
+    builders = {'country_codes': country_dictionary, 'port_codes': port_df}
+    if name not in builders:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    if name not in _lookups:
+        _lookups[name] = builders[name](load_labels())
+    return _lookups[name]
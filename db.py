@@ -0,0 +1,244 @@
+import configparser
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import pool as pg_pool
+from psycopg2.extensions import cursor as pg_cursor
+
+from instrumentation import record_sql
+from warehouse import get_warehouse
+
+logging.basicConfig(filename='staging.log', level=logging.DEBUG)
+logging.getLogger("py4j").setLevel(logging.ERROR)
+
+# Errors worth retrying on a fresh connection
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+_pool = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises when exhausted, so checkouts wait here instead
+_pool_slots = None
+_settings = None
+
+
+class TimedCursor(pg_cursor):
+    """
+    Cursor recording the execution time of every statement
+
+    """
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_sql(query, time.perf_counter() - start, self.rowcount)
+
+
+def read_settings(config_path='dl.cfg'):
+    """
+    Read connection and pool settings
+
+    Keyword arguments:
+    config_path -- configuration file location
+
+    """
+    config = configparser.ConfigParser()
+    config.read(config_path)
+
+    # the Redshift [CLUSTER] or the local [POSTGRES] section, by backend
+    cluster = config[get_warehouse().connection_section]
+    return {
+        'dsn': "host={} dbname={} user={} password={} port={}".format(
+            cluster['HOST'], cluster['DB_NAME'], cluster['USERNAME'], cluster['PASSWORD'], cluster['DB_PORT']),
+        'min_connections': config.getint('POOL', 'MIN_CONNECTIONS', fallback=1),
+        'max_connections': config.getint('POOL', 'MAX_CONNECTIONS', fallback=8),
+        'statement_timeout_ms': config.getint('POOL', 'STATEMENT_TIMEOUT_MS', fallback=0),
+        'retries': config.getint('POOL', 'RETRIES', fallback=3),
+        'retry_backoff_s': config.getfloat('POOL', 'RETRY_BACKOFF_S', fallback=1.0),
+    }
+
+
+def get_settings():
+    """
+    Connection and pool settings, read once per process
+
+    """
+    global _settings
+    if _settings is None:
+        _settings = read_settings()
+    return _settings
+
+
+def configure(**overrides):
+    """
+    Override connection or pool settings, e.g. dsn for a local database
+
+    The current pool is closed so the next transaction uses the new settings.
+
+    """
+    global _settings
+    close_pool()
+    _settings = dict(get_settings(), **overrides)
+    return _settings
+
+
+def get_pool():
+    """
+    Shared thread-safe connection pool, created and warmed on first use
+
+    """
+    global _pool, _pool_slots
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                settings = get_settings()
+                logging.info(f"Opening connection pool with {settings['min_connections']} warm connections")
+                _pool_slots = threading.BoundedSemaphore(settings['max_connections'])
+                _pool = pg_pool.ThreadedConnectionPool(
+                    settings['min_connections'], settings['max_connections'], settings['dsn'])
+    return _pool
+
+
+def close_pool():
+    """
+    Close every pooled connection
+
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+@contextmanager
+def transaction(stage, statement_timeout=None):
+    """
+    Borrow a pooled connection for one transaction
+
+    Commits when the block finishes and rolls back if it raises. Broken
+    connections are discarded instead of being returned to the pool.
+
+    Keyword arguments:
+    stage -- pipeline stage name, used for logging
+    statement_timeout -- statement timeout in milliseconds, 0 for none
+
+    """
+    settings = get_settings()
+    if statement_timeout is None:
+        statement_timeout = settings['statement_timeout_ms']
+
+    pool = get_pool()
+    slots = _pool_slots
+    slots.acquire()
+    try:
+        conn = pool.getconn()
+    except BaseException:
+        slots.release()
+        raise
+    broken = False
+    try:
+        cur = conn.cursor(cursor_factory=TimedCursor)
+        cur.execute("SET statement_timeout TO %s", (statement_timeout,))
+        yield cur, conn
+        conn.commit()
+    except BaseException as e:
+        broken = isinstance(e, TRANSIENT_ERRORS) or conn.closed != 0
+        if not broken:
+            conn.rollback()
+        logging.error(f'Transaction failed in {stage}: {e}')
+        raise
+    finally:
+        pool.putconn(conn, close=broken)
+        slots.release()
+
+
+def run_transaction(stage, func, *args, statement_timeout=None, retries=None, **kwargs):
+    """
+    Run func(cur, conn, ...) in a transaction, retrying transient errors
+
+    func must be safe to run again from the start, which every stage step
+    is as it either recreates or replaces what it writes.
+
+    Keyword arguments:
+    stage -- pipeline stage name, used for logging
+    func -- callable taking a cursor and connection
+    statement_timeout -- statement timeout in milliseconds, 0 for none
+    retries -- retries after a transient error, defaults to the pool setting
+
+    """
+    settings = get_settings()
+    retries = settings['retries'] if retries is None else retries
+
+    attempt = 0
+    while True:
+        try:
+            with transaction(stage, statement_timeout) as (cur, conn):
+                return func(cur, conn, *args, **kwargs)
+        except TRANSIENT_ERRORS as e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            backoff = settings['retry_backoff_s'] * 2 ** (attempt - 1)
+            logging.warning(f'Transient error in {stage}, retry {attempt}/{retries} in {backoff}s: {e}')
+            time.sleep(backoff)
+
+
+def execute(cur, conn, query, params=None):
+    """
+    Execute a single query, for use with run_transaction
+
+    Keyword arguments:
+    query -- SQL query
+    params -- query parameters
+
+    """
+    cur.execute(query, params)
+
+
+def fetch_all(stage, query, params=None, statement_timeout=None):
+    """
+    Run a read query on a pooled connection and return all rows
+
+    Keyword arguments:
+    stage -- pipeline stage name, used for logging
+    query -- SQL query
+    params -- query parameters
+    statement_timeout -- statement timeout in milliseconds, 0 for none
+
+    """
+    def fetch(cur, conn):
+        cur.execute(query, params)
+        return cur.fetchall()
+
+    return run_transaction(stage, fetch, statement_timeout=statement_timeout)
+
+
+def add_missing_columns(cur, table):
+    """
+    Add registry columns missing from an existing table and return their names
+
+    CREATE TABLE IF NOT EXISTS keeps tables created before a column was
+    registered, so the column is added as nullable and the caller fills in
+    the existing rows.
+
+    Keyword arguments:
+    cur -- cursor in the current transaction
+    table -- Table from schemas.WAREHOUSE_TABLES
+
+    """
+    from schemas import sql_type
+    from sql_queries import staging_column_types
+
+    cur.execute(staging_column_types, {'table_name': table.name})
+    existing = {name for name, _ in cur.fetchall()}
+    added = []
+    for column in table.columns:
+        if column.name not in existing:
+            cur.execute(f'ALTER TABLE public.{table.name} ADD COLUMN {column.name} {sql_type(column)}')
+            logging.info(f'Added column {column.name} to {table.name}')
+            added.append(column.name)
+    return added
@@ -0,0 +1,187 @@
+from datetime import datetime, timedelta
+
+from pyspark.sql import functions as f
+from pyspark.sql.types import DateType, IntegerType, StringType
+
+
+SAS_EPOCH = '1960-01-01'
+
+# Single code table driving both decoding engines
+# output column -> (source column, {code: label}, label for anything else)
+I94_CODES = {
+    'mode': ('i94mode', {1: 'Air', 2: 'Sea', 3: 'Land'}, 'Not reported'),
+    'visa_category': ('i94visa', {1: 'Business', 2: 'Pleasure', 3: 'Student'}, 'Invalid Visa Type'),
+}
+
+# output column -> source SAS day column
+I94_DATES = {
+    'arrival_date': 'arrdate',
+    'departure_date': 'depdate',
+}
+
+# output column -> source SAS day column
+I94_DAYS = {
+    'arrival_day': 'arrdate',
+}
+
+
+def decode_i94visa(code):
+    """
+    Decode the I94 Visa codes
+    
+    Keyword arguments:
+    code -- Visa value (int)
+    
+    """
+    if code == 1:
+        return 'Business'
+    if code == 2:
+        return 'Pleasure'
+    if code == 3:
+        return 'Student'
+    return 'Invalid Visa Type'
+
+
+def decode_mode(code):
+    """
+    Decode the I94 Mode codes
+    
+    Keyword arguments:
+    code -- Mode value (int)
+    
+    """
+    if code == 1:
+        return 'Air'
+    if code == 2:
+        return 'Sea'
+    if code == 3:
+        return 'Land'
+    return 'Not reported'
+
+
+def convert_sas_datetime(dt):
+    """
+    Convert datetime from SAS data
+
+    Keyword arguments:
+    dt -- datetime value
+
+    """
+    if dt is None:
+        return None
+    return datetime(1960, 1, 1) + timedelta(days=int(dt))
+
+
+def get_sas_day(days):
+    """
+    Get day value from SAS data
+
+    Fractional days are truncated first, as convert_sas_datetime does.
+
+    Keyword arguments:
+    dt -- datetime value
+
+    """
+    if days is None:
+        return None
+    return (datetime(1960, 1, 1) + timedelta(days=int(days))).day
+
+
+# output column in I94_CODES -> reference decoder used by the UDF engine
+I94_CODE_DECODERS = {
+    'mode': decode_mode,
+    'visa_category': decode_i94visa,
+}
+
+
+def code_column(column):
+    """
+    Build a native column expression decoding an I94 code
+
+    Keyword arguments:
+    column -- output column name in I94_CODES
+
+    """
+    source, codes, default = I94_CODES[column]
+    expr = None
+    for key, label in codes.items():
+        condition = f.col(source) == key
+        expr = f.when(condition, label) if expr is None else expr.when(condition, label)
+    return expr.otherwise(default)
+
+
+def sas_date_column(source):
+    """
+    Build a native column expression converting SAS days to a date
+
+    Keyword arguments:
+    source -- SAS day column name
+
+    """
+    return f.expr(f"date_add(DATE'{SAS_EPOCH}', CAST({source} AS INT))")
+
+
+def decode_native(i94):
+    """
+    Decode I94 columns with native Spark column expressions
+
+    Keyword arguments:
+    i94 -- raw I94 DataFrame
+
+    """
+    columns = {}
+    for column, source in I94_DATES.items():
+        columns[column] = sas_date_column(source)
+    for column, source in I94_DAYS.items():
+        columns[column] = f.dayofmonth(sas_date_column(source))
+    for column in I94_CODES:
+        columns[column] = code_column(column)
+
+    for column, expr in columns.items():
+        i94 = i94.withColumn(column, expr)
+    return i94
+
+
+def decode_udf(i94):
+    """
+    Decode I94 columns with row-at-a-time Python UDFs
+
+    This is the reference path the native engine is checked against. Code
+    columns are taken from I94_CODES, each decoded by its hand-written
+    function in I94_CODE_DECODERS, so a column added to the code table
+    without a reference decoder fails here.
+
+    Keyword arguments:
+    i94 -- raw I94 DataFrame
+
+    """
+    i94date_udf = f.udf(convert_sas_datetime, DateType())
+    i94day_udf = f.udf(get_sas_day, IntegerType())
+
+    for column, source in I94_DATES.items():
+        i94 = i94.withColumn(column, i94date_udf(i94[source]))
+    for column, source in I94_DAYS.items():
+        i94 = i94.withColumn(column, i94day_udf(i94[source]))
+    for column, (source, _, _) in I94_CODES.items():
+        i94 = i94.withColumn(column, f.udf(I94_CODE_DECODERS[column], StringType())(i94[source]))
+    return i94
+
+
+DECODING_ENGINES = {
+    'native': decode_native,
+    'udf': decode_udf,
+}
+
+
+def decode_immigration(i94, engine='native'):
+    """
+    Decode the I94 code and SAS date columns
+
+    Keyword arguments:
+    i94 -- raw I94 DataFrame
+    engine -- 'native' column expressions or the 'udf' reference path
+
+    """
+    if engine not in DECODING_ENGINES:
+        raise ValueError(f"Unknown decoding engine {engine}. Expected one of {list(DECODING_ENGINES)}")
+    return DECODING_ENGINES[engine](i94)
@@ -1,65 +1,127 @@
 import configparser
 import re
-import psycopg2
 import os
 import logging
 
 logging.basicConfig(filename='staging.log', level=logging.DEBUG)
 logging.getLogger("py4j").setLevel(logging.ERROR)
 
-from sql_queries import create_countries_table, create_ports_table, create_airports_table, create_demographics_table, create_time_table, create_fact_immigration_table, extract_countries, extract_ports, extract_airports, extract_demographics, extract_time_data, extract_immigration_data
+from db import run_transaction, add_missing_columns
+from schemas import WAREHOUSE_TABLES
+from instrumentation import traced
+from fact_loader import load_fact_immigration
+from time_loader import load_time_dimension
+from query_cache import bump_load_version
+from sql_queries import create_monthly_rollup_table, ensure_monthly_rollup_table, clear_watermarks, backfill_fact_partitions
+from sql_queries import create_countries_table, create_ports_table, create_airports_table, create_demographics_table, create_fact_immigration_table, extract_countries, extract_ports, extract_airports, extract_demographics
+from sql_queries import ensure_countries_table, ensure_ports_table, ensure_airports_table, ensure_demographics_table, ensure_time_table, ensure_fact_immigration_table, ensure_watermark_table, ensure_fact_chunk_table, upsert_countries, upsert_ports, upsert_airports, upsert_demographics
 
 create_fact_dim_tables = [
-    create_countries_table, create_ports_table, 
-    create_airports_table, create_demographics_table, 
-    create_time_table, create_fact_immigration_table
+    create_countries_table, create_ports_table,
+    create_airports_table, create_demographics_table,
+    create_fact_immigration_table,
+    create_monthly_rollup_table, ensure_watermark_table,
+    clear_watermarks
+]
+
+ensure_fact_dim_tables = [
+    ensure_countries_table, ensure_ports_table,
+    ensure_airports_table, ensure_demographics_table,
+    ensure_time_table, ensure_fact_immigration_table,
+    ensure_watermark_table, ensure_fact_chunk_table,
+    ensure_monthly_rollup_table
 ]
 
 extract_tables = [
     extract_countries, extract_ports, extract_airports,
-    extract_demographics,extract_time_data, extract_immigration_data
+    extract_demographics
+]
+
+upsert_dim_tables = [
+    upsert_countries, upsert_ports, upsert_airports,
+    upsert_demographics
 ]
 
 def create_tables(cur, conn):
     """
     Execute CREATE TABLE queries
-    
+
     """
     for query in create_fact_dim_tables:
         cur.execute(query)
-        conn.commit()
-        
-        
+
+
+def ensure_tables(cur, conn):
+    """
+    Create fact, dimension and watermark tables that do not exist yet
+
+    A fact_immigration from before incremental loads gets its year and
+    month partition columns, filled in from dim_time, so its partitions
+    can be replaced.
+
+    """
+    for query in ensure_fact_dim_tables:
+        cur.execute(query)
+    if add_missing_columns(cur, WAREHOUSE_TABLES['fact_immigration']):
+        cur.execute(backfill_fact_partitions)
+        logging.info(f'Backfilled partition columns of {cur.rowcount} fact_immigration rows')
+
+
 def insert_fact_dim_tables(cur, conn):
     """
-    Insert fact and dimension tables
-    
+    Insert dimension tables
+
     """
-    for query in extract_tables[:-1]:
+    for query in extract_tables:
         cur.execute(query)
-        conn.commit()
-        
 
 
-def extract_data():
+def upsert_dimensions(cur, conn):
     """
-    Connect to DB, create fact and dimension tables, extract data into tables from staging tables
-    
+    Upsert dimension tables by their natural keys
+
     """
-    config = configparser.ConfigParser()
-    config.read('dl.cfg')
+    for query in upsert_dim_tables:
+        cur.execute(query)
 
-    logging.info('Connecting to DB')
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
-    
-    logging.info('Creating Fact and Dimension Tables')
-    create_tables(cur, conn)
-    logging.info('Inserting Fact and Dimension Tables')
-    insert_fact_dim_tables(cur, conn)
 
-    conn.close()
+@traced('extract_data')
+def extract_data(incremental=False, max_workers=4, resume=False):
+    """
+    Connect to DB, create fact and dimension tables, extract data into tables from staging tables
+
+    Keyword arguments:
+    incremental -- keep existing tables, upsert dimensions and only replace
+                   the fact partitions present in staging
+    max_workers -- number of fact chunks loaded at the same time
+    resume -- only continue an interrupted fact load from its last finished chunk
+
+    """
+    if resume:
+        logging.info('Resuming Fact Table load')
+        load_fact_immigration(max_workers=max_workers, resume=True)
+        bump_load_version()
+        return
+    
+    if incremental:
+        logging.info('Ensuring Fact and Dimension Tables')
+        run_transaction('extract', ensure_tables)
+        logging.info('Upserting Dimension Tables')
+        run_transaction('extract', upsert_dimensions)
+    else:
+        logging.info('Creating Fact and Dimension Tables')
+        run_transaction('extract', create_tables)
+        run_transaction('extract', ensure_tables)
+        logging.info('Inserting Dimension Tables')
+        run_transaction('extract', insert_fact_dim_tables)
+    # dim_time is a calendar kept across full loads, only extended with new days
+    logging.info('Upserting Time Dimension')
+    load_time_dimension()
+    
+    logging.info('Loading Fact Table')
+    load_fact_immigration(max_workers=max_workers)
+    bump_load_version()
 
 
 if __name__ == "__main__":
-    extract_data()
\ No newline at end of file
+    extract_data()
@@ -0,0 +1,165 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from db import run_transaction
+from instrumentation import span, traced, annotate, submit
+from sql_queries import staged_immigration_days, delete_immigration_partition, extract_immigration_chunk, ensure_fact_chunk_table, finished_fact_chunks, record_fact_chunk, clear_fact_chunks, upsert_watermark, refresh_monthly_rollup
+
+logging.basicConfig(filename='staging.log', level=logging.DEBUG)
+logging.getLogger("py4j").setLevel(logging.ERROR)
+
+
+def plan_chunks(days, chunk_rows):
+    """
+    Group consecutive arrival days into chunks of roughly chunk_rows rows
+
+    Chunks never span two (year, month) partitions.
+
+    Keyword arguments:
+    days -- (arrdate, year, month, row_count) rows ordered by arrdate
+    chunk_rows -- target number of staged rows per chunk
+
+    """
+    chunks = []
+    current = None
+    for arrdate, year, month, row_count in days:
+        if current is None or (year, month) != (current['year'], current['month']) \
+                or current['staged_rows'] >= chunk_rows:
+            current = {'year': year, 'month': month, 'chunk_start': arrdate,
+                       'chunk_end': arrdate, 'staged_rows': 0}
+            chunks.append(current)
+        current['chunk_end'] = arrdate
+        current['staged_rows'] += row_count
+    return chunks
+
+
+def reset_partitions(cur, conn, partitions):
+    """
+    Clear fact rows and finished chunks for the partitions about to load
+
+    Keyword arguments:
+    partitions -- (year, month) pairs
+
+    """
+    for year, month in partitions:
+        params = {'year': year, 'month': month}
+        cur.execute(delete_immigration_partition, params)
+        cur.execute(clear_fact_chunks, params)
+
+
+def load_chunk(cur, conn, chunk):
+    """
+    Insert one chunk of arrival days and record it as finished
+
+    Keyword arguments:
+    chunk -- chunk from plan_chunks
+
+    """
+    with span(f"fact chunk {chunk['chunk_start']}-{chunk['chunk_end']}",
+              rows_in=chunk['staged_rows']) as record:
+        cur.execute(extract_immigration_chunk, chunk)
+        rows_loaded = cur.rowcount
+        record['rows_out'] = rows_loaded
+        cur.execute(record_fact_chunk, dict(chunk, rows_loaded=rows_loaded, loaded_at=datetime.now()))
+    return rows_loaded
+
+
+def record_watermarks(cur, conn, partitions):
+    """
+    Record the rows loaded for each fully loaded partition
+
+    Keyword arguments:
+    partitions -- {(year, month): rows_loaded}
+
+    """
+    for (year, month), rows_loaded in partitions.items():
+        cur.execute(upsert_watermark, {'table_name': 'fact_immigration', 'year': year, 'month': month,
+                                       'rows_loaded': rows_loaded, 'loaded_at': datetime.now()})
+
+
+def refresh_rollups(cur, conn, partition):
+    """
+    Rebuild the monthly rollup rows for one loaded partition
+
+    Keyword arguments:
+    partition -- (year, month)
+
+    """
+    year, month = partition
+    cur.execute(refresh_monthly_rollup, {'year': year, 'month': month})
+    rows = cur.rowcount
+    annotate(rollup_rows=rows)
+    cur.execute(upsert_watermark, {'table_name': 'agg_monthly_immigration', 'year': year, 'month': month,
+                                   'rows_loaded': rows, 'loaded_at': datetime.now()})
+    return rows
+
+
+@traced('load_fact_immigration')
+def load_fact_immigration(max_workers=4, chunk_rows=500000, resume=False):
+    """
+    Load fact_immigration from staging in concurrent chunks
+
+    Staged rows are split into ranges of arrival days and each range is
+    inserted in its own transaction on its own pooled connection. Finished
+    chunks are recorded in etl_fact_chunks, so with resume set a rerun only
+    loads the chunks that did not finish. Without resume the staged
+    partitions are cleared and loaded from scratch. The monthly rollup is
+    then rebuilt for the loaded partitions only.
+
+    Keyword arguments:
+    max_workers -- number of chunks loaded at the same time
+    chunk_rows -- target number of staged rows per chunk
+    resume -- skip chunks already recorded as finished
+
+    """
+    def plan(cur, conn):
+        cur.execute(ensure_fact_chunk_table)
+        cur.execute(staged_immigration_days)
+        days = cur.fetchall()
+        cur.execute(finished_fact_chunks)
+        return days, cur.fetchall()
+
+    days, finished = run_transaction('extract', plan)
+    chunks = plan_chunks(days, chunk_rows)
+    partitions = sorted({(chunk['year'], chunk['month']) for chunk in chunks})
+
+    rows_loaded = {partition: 0 for partition in partitions}
+    if resume:
+        done = {(start, end): rows for _, _, start, end, rows in finished}
+        pending = []
+        for chunk in chunks:
+            key = (chunk['chunk_start'], chunk['chunk_end'])
+            if key in done:
+                rows_loaded[(chunk['year'], chunk['month'])] += done[key]
+            else:
+                pending.append(chunk)
+        logging.info(f'Resuming fact load, {len(chunks) - len(pending)} of {len(chunks)} chunks already finished')
+    else:
+        run_transaction('extract', reset_partitions, partitions)
+        pending = chunks
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {submit(executor, run_transaction, 'extract', load_chunk, chunk): chunk for chunk in pending}
+        for future in as_completed(futures):
+            chunk = futures[future]
+            try:
+                rows = future.result()
+            except Exception as e:
+                logging.error(f"Fact chunk {chunk['chunk_start']}-{chunk['chunk_end']} failed: {e}")
+                failed.append(chunk)
+                continue
+            rows_loaded[(chunk['year'], chunk['month'])] += rows
+            logging.info(f"Fact chunk {chunk['chunk_start']}-{chunk['chunk_end']} loaded {rows} rows")
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(chunks)} fact chunks failed. Rerun with resume=True to load only those chunks")
+
+    run_transaction('extract', record_watermarks, rows_loaded)
+    for partition in partitions:
+        rollup_rows = run_transaction('extract', refresh_rollups, partition)
+        logging.info(f'Refreshed {rollup_rows} monthly rollup rows for {partition[0]}-{partition[1]:02d}')
+    annotate(rows_out=sum(rows_loaded.values()), chunks=len(chunks))
+    logging.info(f'Loaded {sum(rows_loaded.values())} rows into fact immigration in {len(chunks)} chunks')
+    return rows_loaded
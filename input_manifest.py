@@ -0,0 +1,177 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+from instrumentation import annotate
+
+logging.basicConfig(filename='staging.log', level=logging.DEBUG)
+logging.getLogger("py4j").setLevel(logging.ERROR)
+
+# Source files whose contents make up the preprocessing code version
+CODE_FILES = [
+    'preprocessing.py', 'reference_data.py', 'code_mapping.py', 'decoding.py',
+    'join_keys.py', 'schemas.py', 'layout.py', 'storage.py',
+]
+
+_lock = threading.Lock()
+_code_version = None
+
+
+def manifest_path(processed_path):
+    """
+    Location of the input manifest next to the processed data
+
+    """
+    return f"{processed_path}manifests/inputs.json"
+
+
+def code_version():
+    """
+    SHA-256 over the preprocessing source files, computed once per process
+
+    """
+    global _code_version
+    if _code_version is None:
+        from code_mapping import file_hash
+
+        root = os.path.dirname(os.path.abspath(__file__))
+        digest = hashlib.sha256()
+        for name in CODE_FILES:
+            digest.update(f'{name}:{file_hash(os.path.join(root, name))}\n'.encode('utf-8'))
+        _code_version = digest.hexdigest()
+    return _code_version
+
+
+def stream_hash(fs, path):
+    """
+    SHA-256 of a file read through an Arrow filesystem
+
+    """
+    digest = hashlib.sha256()
+    with fs.open_input_stream(path) as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fingerprint(path, previous=None):
+    """
+    Content hash, size and mtime of a raw input file or directory
+
+    The hash is only recomputed when size or mtime differ from the previous
+    fingerprint, so unchanged multi-GB inputs are not read again.
+
+    Keyword arguments:
+    path -- local or s3a file or directory
+    previous -- fingerprint recorded for the same path by an earlier run
+
+    """
+    import pyarrow.fs as pa_fs
+    from reference_data import filesystem
+
+    fs, fs_path = filesystem(path)
+    info = fs.get_file_info(fs_path)
+    if info.type == pa_fs.FileType.NotFound:
+        raise FileNotFoundError(f'Input {path} does not exist')
+    if info.type == pa_fs.FileType.Directory:
+        files = sorted((f for f in fs.get_file_info(pa_fs.FileSelector(fs_path, recursive=True)) if f.is_file),
+                       key=lambda f: f.path)
+    else:
+        files = [info]
+
+    size = sum(f.size for f in files)
+    mtime = max((f.mtime for f in files if f.mtime is not None), default=None)
+    mtime = mtime.isoformat() if mtime is not None else None
+    if previous is not None and (previous['size'], previous['mtime']) == (size, mtime):
+        return previous
+    if len(files) == 1:
+        sha256 = stream_hash(fs, files[0].path)
+    else:
+        digest = hashlib.sha256()
+        for f in files:
+            digest.update(f'{f.path[len(fs_path):]}:{stream_hash(fs, f.path)}\n'.encode('utf-8'))
+        sha256 = digest.hexdigest()
+    return {'path': path, 'sha256': sha256, 'size': size, 'mtime': mtime}
+
+
+def read_manifest(processed_path):
+    """
+    Steps recorded in the input manifest, empty when there is none yet
+
+    """
+    from reference_data import filesystem
+
+    fs, path = filesystem(manifest_path(processed_path))
+    if not fs.get_file_info(path).is_file:
+        return {}
+    with fs.open_input_stream(path) as f:
+        return json.loads(f.read())['steps']
+
+
+def save_manifest(processed_path, steps):
+    """
+    Replace the input manifest with the given steps
+
+    """
+    from reference_data import filesystem
+
+    fs, path = filesystem(manifest_path(processed_path))
+    fs.create_dir(os.path.dirname(path), recursive=True)
+    with fs.open_output_stream(path) as out:
+        out.write(json.dumps({'steps': steps}, indent=1, sort_keys=True).encode('utf-8'))
+
+
+def outputs_exist(processed_path, outputs):
+    """
+    Check every recorded output, relative to processed_path, is still there
+
+    """
+    import pyarrow.fs as pa_fs
+    from reference_data import filesystem
+
+    for output in outputs:
+        fs, path = filesystem(processed_path + output)
+        if fs.get_file_info(path).type == pa_fs.FileType.NotFound:
+            return False
+    return True
+
+
+def run_if_changed(step, inputs, outputs, processed_path, func, force=False):
+    """
+    Run a preprocessing step unless its inputs, code and outputs are as last recorded
+
+    After a successful run the step's input fingerprints, the code version
+    and its outputs are written to manifests/inputs.json. Returns None when
+    the step is skipped, otherwise what func returns.
+
+    Keyword arguments:
+    step -- step name, e.g. a dataset or immigration_data/<mon>
+    inputs -- raw input paths the step reads
+    outputs -- paths below processed_path the step writes
+    processed_path -- the output data location
+    func -- callable running the step
+    force -- run even when nothing changed
+
+    """
+    recorded = read_manifest(processed_path).get(step)
+    previous = {entry['path']: entry for entry in recorded['inputs']} if recorded else {}
+    fingerprints = [fingerprint(path, previous.get(path)) for path in inputs]
+
+    if not force and recorded is not None \
+            and recorded['code_version'] == code_version() \
+            and [entry['sha256'] for entry in recorded['inputs']] == [entry['sha256'] for entry in fingerprints] \
+            and outputs_exist(processed_path, recorded['outputs']):
+        logging.info(f'Skipping {step}, inputs and code unchanged since {recorded["finished_at"]}')
+        annotate(skipped_steps=1)
+        return None
+
+    result = func()
+    with _lock:
+        steps = read_manifest(processed_path)
+        steps[step] = {'inputs': fingerprints, 'outputs': outputs, 'code_version': code_version(),
+                       'finished_at': datetime.now().isoformat()}
+        save_manifest(processed_path, steps)
+    return result
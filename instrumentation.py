@@ -0,0 +1,353 @@
+import configparser
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+logging.basicConfig(filename='staging.log', level=logging.DEBUG)
+logging.getLogger("py4j").setLevel(logging.ERROR)
+
+RUN_ID = uuid.uuid4().hex
+
+# Spark stage metric -> span field, summed over every stage a span ran
+SPARK_STAGE_METRICS = {
+    'executorRunTime': 'spark_executor_run_ms',
+    'inputBytes': 'spark_input_bytes',
+    'inputRecords': 'rows_in',
+    'outputBytes': 'spark_output_bytes',
+    'outputRecords': 'rows_out',
+    'shuffleReadBytes': 'spark_shuffle_read_bytes',
+    'shuffleWriteBytes': 'spark_shuffle_write_bytes',
+}
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+_events_lock = threading.Lock()
+_finished_spans = []
+_settings = None
+_unpinned_warned = False
+
+
+def get_settings(config_path='dl.cfg'):
+    """
+    Metrics settings, read once per process
+
+    Keyword arguments:
+    config_path -- configuration file location
+
+    """
+    global _settings
+    if _settings is None:
+        config = configparser.ConfigParser()
+        config.read(config_path)
+        _settings = {
+            'path': config.get('METRICS', 'PATH', fallback='metrics.jsonl'),
+            'enabled': config.getboolean('METRICS', 'ENABLED', fallback=True),
+            'sql_events': config.getboolean('METRICS', 'SQL_EVENTS', fallback=True),
+        }
+    return _settings
+
+
+def emit(event):
+    """
+    Append one event to the JSONL metrics file
+
+    Keyword arguments:
+    event -- JSON serializable dict
+
+    """
+    settings = get_settings()
+    if not settings['enabled']:
+        return
+    line = json.dumps(dict(event, run_id=RUN_ID), default=str)
+    with _events_lock:
+        with open(settings['path'], 'a') as f:
+            f.write(line + '\n')
+
+
+@contextmanager
+def span(name, **fields):
+    """
+    Time a block and record it as a span
+
+    The span is a dict, so the block can add fields such as rows_out or
+    bytes_written to it, or call annotate from code further down. Spans
+    started inside the block, including in threads submitted with submit,
+    record it as their parent.
+
+    Keyword arguments:
+    name -- span name
+    fields -- extra fields stored with the span
+
+    """
+    parent = _current_span.get()
+    record = dict(fields, name=name, parent=parent['name'] if parent else None,
+                  span_id=uuid.uuid4().hex[:16], parent_id=parent['span_id'] if parent else None,
+                  started_at=datetime.now().isoformat(), sql_statements=0, sql_seconds=0.0,
+                  status='ok')
+    token = _current_span.set(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException:
+        record['status'] = 'failed'
+        raise
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        _current_span.reset(token)
+        with _events_lock:
+            _finished_spans.append(record)
+        emit(dict(record, event='span'))
+
+
+def annotate(**fields):
+    """
+    Add fields to the innermost span of the calling thread, if any
+
+    Numeric fields add up, so rows from several writes in one span sum.
+
+    """
+    record = _current_span.get()
+    if record is None:
+        return
+    for key, value in fields.items():
+        if isinstance(value, (int, float)) and isinstance(record.get(key), (int, float)):
+            record[key] += value
+        else:
+            record[key] = value
+
+
+def traced(name):
+    """
+    Decorator running a function inside a span
+
+    Keyword arguments:
+    name -- span name
+
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def submit(executor, func, *args, **kwargs):
+    """
+    executor.submit that keeps the caller's span as the parent of spans in func
+
+    """
+    return executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
+
+
+def record_sql(query, seconds, rowcount):
+    """
+    Record one executed statement against the current span
+
+    Keyword arguments:
+    query -- SQL text
+    seconds -- execution time
+    rowcount -- rows affected or returned, -1 when unknown
+
+    """
+    record = _current_span.get()
+    if record is not None:
+        record['sql_statements'] += 1
+        record['sql_seconds'] += seconds
+    if get_settings()['sql_events']:
+        statement = ' '.join(str(query).split())[:200]
+        emit({'event': 'sql', 'span': record['name'] if record else None,
+              'span_id': record['span_id'] if record else None,
+              'statement': statement, 'seconds': seconds, 'rowcount': rowcount})
+
+
+def spark_stage_metrics(spark, job_group, timeout=5.0):
+    """
+    Sum the metrics of every Spark stage run under a job group
+
+    Read from the Spark UI REST API. Returns an empty dict when the UI is
+    disabled or unreachable.
+
+    Keyword arguments:
+    spark -- Spark Context
+    job_group -- job group id set for the span, None for every job of the session
+    timeout -- seconds to wait for finished jobs to be reported
+
+    """
+    from urllib.request import urlopen
+
+    sc = spark.sparkContext
+    if not sc.uiWebUrl:
+        return {}
+    base = f'{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}'
+
+    def get(path):
+        with urlopen(base + path, timeout=timeout) as response:
+            return json.load(response)
+
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            jobs = [job for job in get('/jobs') if job_group is None or job.get('jobGroup') == job_group]
+            if all(job['status'] != 'RUNNING' for job in jobs) or time.monotonic() > deadline:
+                break
+            time.sleep(0.2)
+
+        stage_ids = sorted({stage_id for job in jobs for stage_id in job['stageIds']})
+        metrics = {field: 0 for field in SPARK_STAGE_METRICS.values()}
+        stages = 0
+        for stage_id in stage_ids:
+            for attempt in get(f'/stages/{stage_id}'):
+                if attempt['status'] != 'COMPLETE':
+                    continue
+                stages += 1
+                for metric, field in SPARK_STAGE_METRICS.items():
+                    metrics[field] += attempt.get(metric, 0)
+    except Exception as e:
+        logging.warning(f'Could not read Spark stage metrics for {job_group}: {e}')
+        return {}
+    if not stages:
+        return {}
+    return dict(metrics, spark_jobs=len(jobs), spark_stages=stages)
+
+
+def pinned_threads(spark):
+    """
+    Whether PySpark runs each Python thread on its own JVM thread
+
+    Job groups are local properties of the JVM thread. Only with pinned
+    threads (the default from Spark 3.2, or PYSPARK_PIN_THREAD=true from
+    3.0) do they stay with the Python thread that set them.
+
+    Keyword arguments:
+    spark -- Spark Context
+
+    """
+    version = tuple(int(part) for part in spark.version.split('.')[:2])
+    pin = os.environ.get('PYSPARK_PIN_THREAD', '').lower()
+    if version >= (3, 2):
+        return pin != 'false'
+    return version >= (3, 0) and pin == 'true'
+
+
+@contextmanager
+def spark_span(spark, name, **fields):
+    """
+    Span that also records the Spark stage metrics of the jobs it runs
+
+    With pinned threads, jobs are tagged with a job group for the span, so
+    concurrent spans on the same session keep their metrics apart.
+    Otherwise a job group set in one thread can tag jobs of another, so
+    spans get no Spark metrics and spark_run_metrics records them for the
+    whole session instead.
+
+    Keyword arguments:
+    spark -- Spark Context
+    name -- span name
+    fields -- extra fields stored with the span
+
+    """
+    global _unpinned_warned
+    if not pinned_threads(spark):
+        if not _unpinned_warned:
+            _unpinned_warned = True
+            logging.warning(f'PySpark threads are not pinned on Spark {spark.version}, '
+                            'Spark stage metrics are recorded for the whole run only')
+        with span(name, **fields) as record:
+            yield record
+        return
+
+    sc = spark.sparkContext
+    previous_group = sc.getLocalProperty('spark.jobGroup.id')
+    previous_description = sc.getLocalProperty('spark.job.description')
+    with span(name, **fields) as record:
+        sc.setJobGroup(record['span_id'], name)
+        try:
+            yield record
+        finally:
+            sc.setLocalProperty('spark.jobGroup.id', previous_group)
+            sc.setLocalProperty('spark.job.description', previous_description)
+            annotate(**spark_stage_metrics(spark, record['span_id']))
+
+
+def spark_run_metrics(spark):
+    """
+    Record the stage metrics of every job of a session, before it stops
+
+    Only needed when spans cannot record their own, see spark_span.
+
+    Keyword arguments:
+    spark -- Spark Context
+
+    """
+    if pinned_threads(spark):
+        return
+    metrics = spark_stage_metrics(spark, None)
+    if metrics:
+        emit(dict(metrics, event='spark_run', app_id=spark.sparkContext.applicationId))
+
+
+def spark_traced(name):
+    """
+    Decorator running a function taking the Spark session first inside a spark_span
+
+    Keyword arguments:
+    name -- span name
+
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(spark, *args, **kwargs):
+            with spark_span(spark, name):
+                return func(spark, *args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def slowest_spans(spans, top=5):
+    """
+    Slowest spans that did their own work, i.e. have no child spans
+
+    Keyword arguments:
+    spans -- finished span records
+    top -- number of spans to return
+
+    """
+    parents = {record['parent_id'] for record in spans}
+    leaves = [record for record in spans if record['span_id'] not in parents]
+    return sorted(leaves, key=lambda record: record['seconds'], reverse=True)[:top]
+
+
+def print_summary(top=5):
+    """
+    Log and print the slowest spans finished since the last summary
+
+    Keyword arguments:
+    top -- number of spans to list
+
+    """
+    with _events_lock:
+        spans = list(_finished_spans)
+        _finished_spans.clear()
+    if not spans:
+        return []
+
+    slowest = slowest_spans(spans, top)
+    lines = [f'Slowest steps of run {RUN_ID}',
+             f'{"step":<40} {"seconds":>8} {"sql s":>8} {"rows out":>12} {"bytes":>14}  status']
+    for record in slowest:
+        lines.append(f'{record["name"][:40]:<40} {record["seconds"]:>8.1f} {record["sql_seconds"]:>8.1f} '
+                     f'{record.get("rows_out", ""):>12} {record.get("bytes_written", ""):>14}  {record["status"]}')
+    lines.append(f'Details for {len(spans)} spans in {get_settings()["path"]}')
+
+    for line in lines:
+        logging.info(line)
+    print('\n'.join(lines))
+    return slowest
@@ -0,0 +1,36 @@
+# Accented characters and their plain replacements, position by position.
+# Spark's translate() and Python's str.translate() both use this table so
+# keys built either way match exactly.
+ACCENTED = 'ÀÁÂÃÄÅĀĂĄàáâãäåāăąÇĆČçćčĎďÈÉÊËĒĖĘĚèéêëēėęěĞğÌÍÎÏĪİìíîïīıŁłÑŃŇñńňÒÓÔÕÖØŌŐòóôõöøōőŘřŚŠŞśšşŤťÙÚÛÜŪŮŰùúûüūůűÝŸýÿŹŻŽźżž'
+PLAIN = 'AAAAAAAAAaaaaaaaaaCCCcccDdEEEEEEEEeeeeeeeeGgIIIIIIiiiiiiLlNNNnnnOOOOOOOOooooooooRrSSSsssTtUUUUUUUuuuuuuuYYyyZZZzzz'
+
+_TRANSLATION = str.maketrans(ACCENTED, PLAIN)
+
+
+def normalize_key(value):
+    """
+    Normalized join key for a city or country name
+
+    Strips accents, collapses and trims whitespace and upper cases.
+
+    Keyword arguments:
+    value -- city or country name
+
+    """
+    if value is None:
+        return None
+    return ' '.join(value.translate(_TRANSLATION).split()).upper()
+
+
+def normalize_key_column(column):
+    """
+    Spark column expression matching normalize_key
+
+    Keyword arguments:
+    column -- column name
+
+    """
+    from pyspark.sql import functions as f
+
+    plain = f.translate(f.col(column), ACCENTED, PLAIN)
+    return f.upper(f.trim(f.regexp_replace(plain, r'\s+', ' ')))
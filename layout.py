@@ -0,0 +1,271 @@
+import configparser
+import json
+import logging
+
+from pyspark.sql import functions as f
+
+from instrumentation import annotate
+from storage import hadoop_path, path_exists, read_text, write_text, list_files, delete_path, move_path
+
+logging.basicConfig(filename='staging.log', level=logging.DEBUG)
+logging.getLogger("py4j").setLevel(logging.ERROR)
+
+PARTITION_COLUMNS = ['year', 'month', 'arrival_day']
+# Columns with min/max stats in the partition manifest
+STATS_COLUMNS = ['arrdate', 'depdate', 'port_code', 'origin_country_code']
+# Rows in a partition are sorted by these, so their stats stay narrow
+SORT_COLUMNS = ['port_code', 'arrdate']
+# Shuffle tasks per month written, one per arrival_day directory it can have
+MONTH_TASKS = 31
+
+_settings = None
+
+
+def get_settings(config_path='dl.cfg'):
+    """
+    Parquet layout settings, read once per process
+
+    Keyword arguments:
+    config_path -- configuration file location
+
+    """
+    global _settings
+    if _settings is None:
+        config = configparser.ConfigParser()
+        config.read(config_path)
+        _settings = {
+            'target_file_bytes': config.getint('LAYOUT', 'TARGET_FILE_MB', fallback=128) * 2 ** 20,
+            'estimated_row_bytes': config.getint('LAYOUT', 'ESTIMATED_ROW_BYTES', fallback=40),
+        }
+    return _settings
+
+
+def partition_manifest_path(processed_path, dataset):
+    """
+    Location of a dataset's partition manifest
+
+    """
+    return f"{processed_path}manifests/{dataset}.partitions.json"
+
+
+def read_partition_manifest(spark, processed_path, dataset):
+    """
+    Partition entries of a dataset, empty when it has no manifest yet
+
+    """
+    path = partition_manifest_path(processed_path, dataset)
+    if not path_exists(spark, path):
+        return []
+    return json.loads(read_text(spark, path))['partitions']
+
+
+def row_bytes(partitions):
+    """
+    Average Parquet bytes per row in existing partitions, None without any
+
+    """
+    rows = sum(partition['rows'] for partition in partitions)
+    if not rows:
+        return None
+    return sum(partition['bytes'] for partition in partitions) / rows
+
+
+def rows_per_file(target_file_bytes, bytes_per_row):
+    """
+    Rows to write per file so files come out near the target size
+
+    """
+    return max(1, int(target_file_bytes // max(bytes_per_row, 1)))
+
+
+def write_partitioned(df, path, records_per_file, tasks, partition_columns=PARTITION_COLUMNS):
+    """
+    Write a DataFrame with each partition directory split into files of records_per_file rows
+
+    Rows are shuffled so each partition directory is written by a single
+    task, then sorted, so a directory gets ceil(rows / records_per_file)
+    files rather than one per task.
+
+    Keyword arguments:
+    df -- DataFrame holding the partition columns
+    path -- dataset location
+    records_per_file -- rows per output file
+    tasks -- shuffle partitions, about the number of partition directories written
+    partition_columns -- directory partition columns
+
+    """
+    df.repartition(tasks, *partition_columns) \
+        .sortWithinPartitions(*(partition_columns + SORT_COLUMNS)) \
+        .write.mode('overwrite') \
+        .option('maxRecordsPerFile', records_per_file) \
+        .partitionBy(*partition_columns) \
+        .parquet(path)
+
+
+def partition_stats(spark, processed_path, dataset, months):
+    """
+    Row counts, sizes and min/max stats for the partitions of some months
+
+    Keyword arguments:
+    spark -- Spark Context
+    processed_path -- the output data location
+    dataset -- output directory name below processed_path
+    months -- month numbers to describe
+
+    """
+    base = processed_path + dataset
+    aggs = [f.count(f.lit(1)).alias('rows')]
+    for column in STATS_COLUMNS:
+        aggs += [f.min(column).alias(f'min_{column}'), f.max(column).alias(f'max_{column}')]
+    rows = spark.read.parquet(base).where(f.col('month').isin(months)) \
+        .groupBy(*PARTITION_COLUMNS).agg(*aggs).collect()
+
+    partitions = []
+    for row in rows:
+        directory = '/'.join(f'{column}={row[column]}' for column in PARTITION_COLUMNS)
+        files = list_files(spark, f'{base}/{directory}')
+        partitions.append(dict(
+            {column: row[column] for column in PARTITION_COLUMNS},
+            path=f'{dataset}/{directory}', rows=row['rows'], files=len(files),
+            bytes=sum(size for _, size in files),
+            stats={column: {'min': _json_value(row[f'min_{column}']), 'max': _json_value(row[f'max_{column}'])}
+                   for column in STATS_COLUMNS}))
+    return partitions
+
+
+def _json_value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def write_partition_manifest(spark, processed_path, dataset, partitions, months):
+    """
+    Replace the manifest entries of some months with new partition entries
+
+    Keyword arguments:
+    spark -- Spark Context
+    processed_path -- the output data location
+    dataset -- output directory name below processed_path
+    partitions -- entries from partition_stats
+    months -- months the new entries cover; their old entries are dropped
+
+    """
+    kept = [partition for partition in read_partition_manifest(spark, processed_path, dataset)
+            if partition['month'] not in months]
+    merged = sorted(kept + partitions, key=lambda p: tuple(p[column] for column in PARTITION_COLUMNS))
+    write_text(spark, partition_manifest_path(processed_path, dataset),
+               json.dumps({'partition_columns': PARTITION_COLUMNS, 'partitions': merged}, indent=1))
+    logging.info(f'Wrote partition manifest for {dataset} with {len(merged)} partitions')
+    return merged
+
+
+def prune_partitions(partitions, **bounds):
+    """
+    Partitions whose min/max stats can hold rows within the given bounds
+
+    Keyword arguments:
+    partitions -- partition manifest entries
+    bounds -- <column>=(low, high) ranges, either end None for open
+
+    """
+    selected = []
+    for partition in partitions:
+        for column, (low, high) in bounds.items():
+            if column in PARTITION_COLUMNS:
+                low_value = high_value = partition[column]
+            else:
+                low_value, high_value = partition['stats'][column]['min'], partition['stats'][column]['max']
+            if low_value is None or (high is not None and low_value > high) or \
+                    (low is not None and high_value < low):
+                break
+        else:
+            selected.append(partition)
+    return selected
+
+
+def partition_directories(spark, path):
+    """
+    year=/month=/arrival_day= directories below a dataset location, relative to it
+
+    """
+    fs, pattern = hadoop_path(spark, f'{path}/year=*/month=*/arrival_day=*')
+    return ['/'.join(status.getPath().toString().rstrip('/').split('/')[-3:])
+            for status in fs.globStatus(pattern) or []]
+
+
+def recover_compaction(spark, processed_path, dataset):
+    """
+    Put back partitions a failed compaction left between their old and new files
+
+    A partition with a backup was being swapped. If its new files are no
+    longer in the scratch directory they were fully moved in and the backup
+    is dropped, otherwise the old files are restored.
+
+    Keyword arguments:
+    spark -- Spark Context
+    processed_path -- the output data location
+    dataset -- output directory name below processed_path
+
+    """
+    base = processed_path + dataset
+    scratch = f'{processed_path}_compaction/{dataset}'
+    backup = f'{processed_path}_compaction/{dataset}.backup'
+    for directory in partition_directories(spark, backup):
+        if path_exists(spark, f'{scratch}/{directory}') or not path_exists(spark, f'{base}/{directory}'):
+            delete_path(spark, f'{base}/{directory}')
+            move_path(spark, f'{backup}/{directory}', f'{base}/{directory}')
+            logging.warning(f'Restored {dataset}/{directory} from an interrupted compaction')
+    delete_path(spark, backup)
+
+
+def compact_partitions(spark, processed_path, dataset, months, target_file_bytes=None):
+    """
+    Rewrite existing partitions of some months in place at the target file size
+
+    The months are rewritten to a scratch directory first. Each partition
+    directory is then moved to a backup, its new files are moved in, and
+    the backup is only deleted once they are in place. A partition that
+    fails to swap is restored from its backup. Renames on S3 are copies, so
+    a process killed mid-swap can leave one partition incomplete; the next
+    compaction restores it before doing anything else.
+
+    Keyword arguments:
+    spark -- Spark Context
+    processed_path -- the output data location
+    dataset -- output directory name below processed_path
+    months -- month numbers to compact
+    target_file_bytes -- target Parquet file size, the configured one by default
+
+    """
+    settings = get_settings()
+    target_file_bytes = target_file_bytes or settings['target_file_bytes']
+    existing = [p for p in read_partition_manifest(spark, processed_path, dataset) if p['month'] in months]
+    bytes_per_row = row_bytes(existing) or settings['estimated_row_bytes']
+
+    recover_compaction(spark, processed_path, dataset)
+    base = processed_path + dataset
+    scratch = f'{processed_path}_compaction/{dataset}'
+    backup = f'{processed_path}_compaction/{dataset}.backup'
+    delete_path(spark, scratch)
+    df = spark.read.parquet(base).where(f.col('month').isin(months))
+    write_partitioned(df, scratch, rows_per_file(target_file_bytes, bytes_per_row), tasks=MONTH_TASKS * len(months))
+
+    for directory in partition_directories(spark, scratch):
+        target, old = f'{base}/{directory}', f'{backup}/{directory}'
+        move_path(spark, target, old)
+        try:
+            move_path(spark, f'{scratch}/{directory}', target)
+        except Exception:
+            delete_path(spark, target)
+            move_path(spark, old, target)
+            raise
+        delete_path(spark, old)
+    delete_path(spark, backup)
+    delete_path(spark, scratch)
+
+    partitions = partition_stats(spark, processed_path, dataset, months)
+    write_partition_manifest(spark, processed_path, dataset, partitions, months)
+    before = sum(p['files'] for p in existing)
+    after = sum(p['files'] for p in partitions)
+    annotate(files_before=before, files_after=after)
+    logging.info(f'Compacted {dataset} months {months} from {before} to {after} files')
+    return partitions
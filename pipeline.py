@@ -1,30 +1,159 @@
-from preprocessing import preprocess_data
-from stage_data import stage_data
-from extract_data import extract_data
-from quality_check import check_data_quality
+import threading
 
 import logging
 logging.basicConfig(filename='staging.log', level=logging.DEBUG)
 logging.getLogger("py4j").setLevel(logging.ERROR)
 
-def main():
-    
-    # Clean data
-    logging.info("----- Clean data -----")
-    preprocess_data()
-    
-    # Stage data
-    logging.info("----- Stage data -----")
-    stage_data()
-    
+
+class SharedSpark:
+    """
+    Spark session created by the first step that needs it
+
+    """
+    def __init__(self):
+        self.session = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.session is None:
+                from preprocessing import create_spark_session
+                self.session = create_spark_session()
+            return self.session
+
+    def stop(self):
+        if self.session is not None:
+            from instrumentation import spark_run_metrics
+            spark_run_metrics(self.session)
+            self.session.stop()
+
+
+def build_graph(spark, processed_path=None, raw_path="data/raw_data", incremental=False, force=False):
+    """
+    Pipeline steps and the steps each one waits on
+
+    Keyword arguments:
+    spark -- SharedSpark
+    processed_path -- the output data location, the warehouse backend's by default
+    raw_path -- the input data location
+    incremental -- upsert dimensions and only replace staged fact partitions
+    force -- preprocess datasets whose inputs and code are unchanged
+
+    """
+    import preprocessing
+    import reference_data
+    import stage_data
+    import extract_data
+    import quality_check
+    import sql_queries
+    from db import run_transaction, execute
+    from fact_loader import load_fact_immigration
+    from time_loader import load_time_dimension
+    from query_cache import bump_load_version
+    from scheduler import Task
+    from warehouse import get_warehouse
+
+    if processed_path is None:
+        processed_path = get_warehouse().processed_path
+
+    def sql_step(stage, query):
+        return lambda: run_transaction(stage, execute, query)
+
+    def reference_step(dataset):
+        return lambda: reference_data.process_reference_data(dataset, raw_path, processed_path, spark.get, force)
+
+    def staging_step(table):
+        # a full load rebuilds fact_immigration, so it stages every processed month
+        return lambda: run_transaction('stage', stage_data.stage_table, table, incremental=incremental)
+
+    # The enriched immigration output joins the processed temperature
+    immigration_deps = ['process_temperature'] if reference_data.get_settings()['enriched_output'] else []
+
+    graph = {
+        # Clean data, with Spark only started for temperature and immigration;
+        # steps whose inputs and code are unchanged are skipped
+        'process_port_codes': Task(reference_step('port_codes'), []),
+        'process_country_codes': Task(reference_step('country_codes'), []),
+        'process_airport_codes': Task(reference_step('airport_codes'), []),
+        'process_temperature': Task(lambda: preprocessing.process_temperature_data(spark.get, raw_path, processed_path, force), []),
+        'process_demographic': Task(reference_step('demographic'), []),
+        'process_immigration_data': Task(lambda: preprocessing.process_immigration_data(spark.get(), processed_path, force=force), immigration_deps),
+
+        # Stage data
+        'staging_ports': Task(staging_step('staging_ports'), ['process_port_codes']),
+        'staging_countries': Task(staging_step('staging_countries'), ['process_country_codes']),
+        'staging_airports': Task(staging_step('staging_airports'), ['process_airport_codes']),
+        'staging_temperatures': Task(staging_step('staging_temperatures'), ['process_temperature']),
+        'staging_demographics': Task(staging_step('staging_demographics'), ['process_demographic']),
+        'staging_immigration': Task(staging_step('staging_immigration'), ['process_immigration_data']),
+        'staging_immigration_keys': Task(staging_step('staging_immigration_keys'), ['process_immigration_data']),
+    }
+
     # Extract data into fact and dimension tables
-    logging.info("----- Extract data -----")
-    extract_data()
-    
+    if incremental:
+        graph['create_fact_dim_tables'] = Task(lambda: run_transaction('extract', extract_data.ensure_tables), [])
+        dim_queries = {
+            'extract_countries': sql_queries.upsert_countries,
+            'extract_ports': sql_queries.upsert_ports,
+            'extract_airports': sql_queries.upsert_airports,
+            'extract_demographics': sql_queries.upsert_demographics,
+        }
+    else:
+        def create_tables():
+            run_transaction('extract', extract_data.create_tables)
+            run_transaction('extract', extract_data.ensure_tables)
+        graph['create_fact_dim_tables'] = Task(create_tables, [])
+        dim_queries = {
+            'extract_countries': sql_queries.extract_countries,
+            'extract_ports': sql_queries.extract_ports,
+            'extract_airports': sql_queries.extract_airports,
+            'extract_demographics': sql_queries.extract_demographics,
+        }
+
+    dim_deps = {
+        'extract_countries': ['create_fact_dim_tables', 'staging_countries', 'staging_temperatures', 'staging_immigration_keys'],
+        'extract_ports': ['create_fact_dim_tables', 'staging_ports', 'staging_temperatures', 'staging_immigration_keys'],
+        'extract_airports': ['extract_ports', 'staging_airports'],
+        'extract_demographics': ['extract_ports', 'staging_demographics', 'staging_immigration_keys'],
+    }
+    for name, query in dim_queries.items():
+        graph[name] = Task(sql_step('extract', query), dim_deps[name])
+    # dim_time is a calendar upserted in both modes
+    graph['extract_time'] = Task(load_time_dimension, ['create_fact_dim_tables', 'staging_immigration_keys'])
+    graph['extract_immigration'] = Task(load_fact_immigration, ['extract_countries', 'extract_ports', 'extract_time'])
+    graph['publish_load_version'] = Task(bump_load_version,
+                                         ['extract_immigration', 'extract_airports', 'extract_demographics'])
+
     # Check data quality
-    logging.info("----- Check data quality -----")
-    check_data_quality()
-    
+    graph['check_staging'] = Task(quality_check.count_immigration_staging,
+                                  [name for name in graph if name.startswith('staging_')])
+    graph['check_fact'] = Task(quality_check.count_immigration_fact, ['extract_immigration'])
+    return graph
+
+
+def main(max_workers=4, incremental=False, force=False):
+    """
+    Run the pipeline, starting each step as soon as its dependencies finish
+
+    Keyword arguments:
+    max_workers -- number of steps running at the same time
+    incremental -- upsert dimensions and only replace staged fact partitions
+    force -- preprocess datasets whose inputs and code are unchanged
+
+    """
+    from scheduler import run_graph
+    from db import close_pool
+    from instrumentation import print_summary
+
+    spark = SharedSpark()
+    try:
+        logging.info("----- Run pipeline -----")
+        run_graph(build_graph(spark, incremental=incremental, force=force), max_workers=max_workers)
+    finally:
+        spark.stop()
+        close_pool()
+        print_summary()
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
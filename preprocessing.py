@@ -1,16 +1,25 @@
-import pandas as pd
 import calendar
 from pyspark.sql.types import DateType
 from pyspark.sql import functions as f
 from pyspark.sql.types import IntegerType, StringType, DoubleType
-from pyspark.sql.window import Window
 from pyspark.sql import SparkSession
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import configparser
+import json
 import re
 import os
 
-from code_mapping import port_codes, country_codes
+import code_mapping
+from decoding import decode_immigration
+from join_keys import normalize_key_column
+from storage import write_text, list_files, copy_manifest
+from instrumentation import spark_traced, spark_run_metrics, annotate, submit
+from warehouse import get_warehouse
+from reference_data import process_reference_data, get_settings as get_preprocess_settings
+from input_manifest import run_if_changed
+import layout
+import schemas
 
 import logging
 logging.basicConfig(filename='staging.log', level=logging.DEBUG)
@@ -24,77 +33,44 @@ os.environ['AWS_ACCESS_KEY_ID']=config.get('aws', 'AWS_ACCESS_KEY_ID')
 os.environ['AWS_SECRET_ACCESS_KEY']=config.get('aws','AWS_SECRET_ACCESS_KEY')
 S3_STAGING = config.get('S3', 'STAGING')
 
+I94_PATH = '../../data/18-83510-I94-Data-2016/i94_{mon}16_sub.sas7bdat'
+I94_FORMAT = 'com.github.saurfang.sas.spark'
+MONTHS = [m.lower() for m in list(calendar.month_abbr[1:])]
+
 def create_spark_session():
     spark = SparkSession \
     .builder \
     .config("spark.jars.repositories", "https://repos.spark-packages.org/") \
     .config("spark.jars.packages", "saurfang:spark-sas7bdat:2.0.0-s_2.11") \
     .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
+    .config("spark.sql.sources.partitionOverwriteMode", "dynamic") \
     .enableHiveSupport().getOrCreate()
     
     return spark
 
 
-def decode_i94visa(code):
-    """
-    Decode the I94 Visa codes
-    
-    Keyword arguments:
-    code -- Visa value (int)
-    
-    """
-    if code == 1:
-        return 'Business'
-    if code == 2:
-        return 'Pleasure'
-    if code == 3:
-        return 'Student'
-    return 'Invalid Visa Type'
-
-
-def decode_mode(code):
-    """
-    Decode the I94 Mode codes
-    
-    Keyword arguments:
-    code -- Mode value (int)
-    
-    """
-    if code == 1:
-        return 'Air'
-    if code == 2:
-        return 'Sea'
-    if code == 3:
-        return 'Land'
-    return 'Not reported'
-
-
-def convert_sas_datetime(dt):
-    """
-    Convert datetime from SAS data
-    
-    Keyword arguments:
-    dt -- datetime value
-    
-    """
-    if dt is None:
-        return None
-    return datetime(1960, 1, 1) + timedelta(days=int(dt))
-
-
-def get_sas_day(days):
+def write_manifest(spark, processed_path, dataset, patterns=('*',), name=None):
     """
-    Get day value from SAS data
+    Write the COPY manifest listing a dataset's Parquet files
     
     Keyword arguments:
-    dt -- datetime value
+    spark -- Spark Context
+    processed_path -- the S3 output data location
+    dataset -- output directory name below processed_path
+    patterns -- globs below the dataset selecting the partitions to list
+    name -- manifest file name without .manifest, the dataset name by default
     
     """
-    if days is None:
-        return None
-    return (datetime(1960, 1, 1) + timedelta(days=days)).day
+    name = name or dataset
+    files = []
+    for pattern in patterns:
+        files.extend(list_files(spark, processed_path + dataset, pattern))
+    write_text(spark, f"{processed_path}manifests/{name}.manifest", copy_manifest(files))
+    annotate(files_written=len(files), bytes_written=sum(size for _, size in files))
+    logging.info(f'Wrote manifest {name} with {len(files)} files')
 
 
+@spark_traced('process_port_codes')
 def process_port_codes(spark, processed_path):
     """
     Process Port Codes
@@ -104,13 +80,17 @@ def process_port_codes(spark, processed_path):
     processed_path -- the S3 output data location
     """
     logging.info(f'Processing port codes {datetime.now()}')
-    pc = spark.createDataFrame(port_codes)
+    pc = spark.createDataFrame(code_mapping.port_codes)
+    pc = pc.withColumn('city_key', normalize_key_column('port_city'))
+    schemas.check_dataframe(pc, 'port_codes')
     
     logging.info(f'Begin writting port codes {datetime.now()}')
     pc.write.mode("overwrite").parquet(processed_path + 'port_codes')
+    write_manifest(spark, processed_path, 'port_codes')
     logging.info(f'Finished writing port codes {datetime.now()}')
     
     
+@spark_traced('process_country_codes')
 def process_country_codes(spark, processed_path):
     """
     Process Country Codes
@@ -120,14 +100,20 @@ def process_country_codes(spark, processed_path):
     processed_path -- the S3 output data location
     """
     logging.info(f'Processing country codes {datetime.now()}')
-    cc_pdf = pd.DataFrame(list(country_codes.items()), columns=['country_code', 'country'])
+    import pandas as pd
+    
+    cc_pdf = pd.DataFrame(list(code_mapping.country_codes.items()), columns=['country_code', 'country'])
     cc = spark.createDataFrame(cc_pdf)
+    cc = cc.withColumn('country_key', normalize_key_column('country'))
+    schemas.check_dataframe(cc, 'country_codes')
     
     logging.info(f'Begin writting country codes {datetime.now()}')
     cc.write.mode("overwrite").parquet(processed_path + 'country_codes')
+    write_manifest(spark, processed_path, 'country_codes')
     logging.info(f'Finished writing country codes {datetime.now()}')
 
 
+@spark_traced('process_airport_codes')
 def process_airport_codes(spark, raw_path, processed_path):
     """
     Process Airport Codes
@@ -140,42 +126,93 @@ def process_airport_codes(spark, raw_path, processed_path):
     
     """
     logging.info(f'Reading airport codes {datetime.now()}')
-    airport = spark.read.option("mergeSchema", "true").csv('data/raw_data/airport-codes_csv.csv', inferSchema=True, header=True)
+    raw = schemas.RAW_FILES['airport_codes']
+    airport = spark.read.csv(f'{raw_path}/{raw.name}', schema=schemas.spark_schema(raw), header=True)
     
     airport = airport.select(['ident', 'type', 'name', 'elevation_ft',
                               'iso_country', 'municipality', 'gps_code', 'local_code', 'coordinates'])
+    schemas.check_dataframe(airport, 'airport_codes')
     
     logging.info(f'Begin writing airport codes {datetime.now()}')
     airport.write.mode("overwrite").parquet(processed_path + 'airport_codes')
+    write_manifest(spark, processed_path, 'airport_codes')
     logging.info(f'Finished writting airport codes {datetime.now()}')
     
     
 
-def process_temperature(spark, raw_path, processed_path):
+def latest_per_group(df, keys, order_col, extra_aggs=()):
+    """
+    Keep the row with the latest order_col value for each group
+    
+    Aggregates a struct led by order_col, so Spark combines partial
+    results per partition instead of sorting the whole dataset.
+    
+    Keyword arguments:
+    df -- DataFrame
+    keys -- grouping columns
+    order_col -- column deciding which row is latest
+    extra_aggs -- additional aggregate columns computed in the same pass
+    
+    """
+    columns = [order_col] + [col for col in df.columns if col != order_col]
+    return df.groupBy(*keys).agg(f.max(f.struct(*columns)).alias('latest'), *extra_aggs)
+
+
+@spark_traced('process_temperature')
+def process_temperature(spark, raw_path, processed_path, yearly_averages=False):
     """
     Process Temperature Data
     
+    Keeps the latest reading per city. With yearly_averages, also writes the
+    average temperature per city and year from the same scan.
+    
     Keyword arguments:
     spark -- Spark Context
     raw_path -- the input data location
     processed_path -- the S3 output data location
+    yearly_averages -- also write temperature_yearly
     
     """
     logging.info(f'Reading temperature {datetime.now()}')
-    temperature = spark.read.csv(f'{raw_path}/GlobalLandTemperaturesByCity.csv', header=True, inferSchema=True)
+    raw = schemas.RAW_FILES['temperature']
+    temperature = spark.read.csv(f'{raw_path}/{raw.name}', schema=schemas.spark_schema(raw), header=True,
+                                 timestampFormat='yyyy-MM-dd')
     
     norm_cols = [col[0].lower() + re.sub(r'(?!^)[A-Z]', lambda x: '_' + x.group(0).lower(), col[1:]) for col in temperature.columns]
     
     temperature = temperature.toDF(*norm_cols)
     temperature = temperature.dropna(subset=['average_temperature'])
+    columns = temperature.columns
+    
     logging.info(f'Dropping temperatures {datetime.now()}')
-    temperature = temperature.sort(['city', 'country', 'dt'], ascending=False).drop_duplicates(['city', 'country'])
+    if yearly_averages:
+        # One pass to (city, country, year), then pick the latest of ~270 years per city
+        yearly = latest_per_group(
+            temperature, ['city', 'country', f.year('dt').alias('year')], 'dt',
+            [f.avg('average_temperature').alias('average_temperature'), f.count('*').alias('readings')]
+        ).cache()
+        latest = yearly.groupBy('city', 'country').agg(f.max('latest').alias('latest'))
+        
+        logging.info(f'Begin writing yearly temperature {datetime.now()}')
+        yearly.select('city', 'country', 'year', 'average_temperature', 'readings') \
+            .write.mode("overwrite").parquet(processed_path + 'temperature_yearly')
+        write_manifest(spark, processed_path, 'temperature_yearly')
+    else:
+        latest = latest_per_group(temperature, ['city', 'country'], 'dt')
+    temperature = latest.select([f.col(f'latest.{col}').alias(col) for col in columns]) \
+        .withColumn('city_key', normalize_key_column('city')) \
+        .withColumn('country_key', normalize_key_column('country'))
+    schemas.check_dataframe(temperature, 'temperature')
     
     logging.info(f'Begin writing temperature {datetime.now()}')
     temperature.write.mode("overwrite").parquet(processed_path + 'temperature')
+    write_manifest(spark, processed_path, 'temperature')
     logging.info(f'Finished writting temperatures {datetime.now()}')
+    if yearly_averages:
+        yearly.unpersist()
     
     
+@spark_traced('process_demographic')
 def process_demographic(spark, raw_path, processed_path):
     """
     Process Demographic Data
@@ -187,73 +224,456 @@ def process_demographic(spark, raw_path, processed_path):
     
     """
     logging.info(f'Reading demographics {datetime.now()}')
-    demographic = spark.read.csv(f'{raw_path}/us-cities-demographics.csv', header=True, inferSchema=True, sep=';')
+    raw = schemas.RAW_FILES['demographic']
+    demographic = spark.read.csv(f'{raw_path}/{raw.name}', schema=schemas.spark_schema(raw), header=True, sep=';')
     norm_cols = [col.lower().replace(' ', '_').replace('-', '_') for col in demographic.columns]
     demographic = demographic.toDF(*norm_cols)
+    demographic = demographic.withColumn('city_key', normalize_key_column('city'))
+    schemas.check_dataframe(demographic, 'demographic')
     
     logging.info(f'Begin writing demographics {datetime.now()}')
     demographic.write.mode("overwrite").parquet(processed_path + 'demographic')
+    write_manifest(spark, processed_path, 'demographic')
     logging.info(f'Finished writting demographics {datetime.now()}')
     
     
-def process_immigration_data(spark, processed_path):
+def immigration_checkpoint_path(processed_path, mon):
+    """
+    Location of the checkpoint marker for one month of I94 data
+    
+    Keyword arguments:
+    processed_path -- the S3 output data location
+    mon -- lower case month abbreviation
+    
+    """
+    return f"{processed_path}checkpoints/immigration_data/{mon}"
+
+
+def immigration_records_per_file(spark, processed_path, dataset='immigration_data'):
+    """
+    Rows per immigration Parquet file for the configured target file size
+    
+    Bytes per row come from the partition manifest once one exists, so the
+    estimate follows the data after the first run.
+    
+    Keyword arguments:
+    spark -- Spark Context
+    processed_path -- the S3 output data location
+    dataset -- immigration_data or immigration_enriched
+    
     """
-    Process I94 Data
+    settings = layout.get_settings()
+    partitions = layout.read_partition_manifest(spark, processed_path, dataset)
+    bytes_per_row = layout.row_bytes(partitions) or settings['estimated_row_bytes']
+    return layout.rows_per_file(settings['target_file_bytes'], bytes_per_row)
+
+
+def write_immigration_keys(spark, processed_path, mon):
+    """
+    Write the distinct (country, port) pairs of one written month with their row counts
+    
+    Read back from the month's Parquet, which only touches three columns,
+    and staged as staging_immigration_keys so dimension extracts and the
+    dim_time range never scan staging_immigration. Each pair also carries
+    the first and last departure day of its rows. Months go to separate directories so each can be
+    replaced on its own.
     
     Keyword arguments:
     spark -- Spark Context
     processed_path -- the S3 output data location
+    mon -- lower case month abbreviation
     
     """
-    i94visa_udf = f.udf(decode_i94visa, StringType())
-    i94mode_udf = f.udf(decode_mode, StringType())
-    i94date_udf = f.udf(convert_sas_datetime, DateType())
-    i94day_udf = f.udf(get_sas_day, IntegerType())
-    
-    months = [m.lower() for m in list(calendar.month_abbr[1:])]
-    
-    logging.info('Begin loading immigration data')
-    for mon in months:
-        logging.info(f'Loading immigration data for {mon}')
-        load_path = f'../../data/18-83510-I94-Data-2016/i94_{mon}16_sub.sas7bdat'
-        i94 = spark.read.format('com.github.saurfang.sas.spark').load(load_path)
-        #i94 = spark.read.parquet('sas_data/')
-        i94 = i94 \
-            .withColumn('year', i94['i94yr'].cast(IntegerType())) \
-            .withColumn('month', i94['i94mon'].cast(IntegerType())) \
-            .withColumn('origin_country_code', i94['i94cit'].cast(IntegerType()).cast(StringType())) \
-            .withColumn('age', i94['i94bir'].cast(IntegerType())) \
-            .withColumn('arrival_date', i94date_udf(i94['arrdate'])) \
-            .withColumn('arrival_day', i94day_udf(i94['arrdate'])) \
-            .withColumn('departure_date', i94date_udf(i94['depdate'])) \
-            .withColumn('port_code', i94['i94port'].cast(StringType())) \
-            .withColumn('mode', i94mode_udf(i94['i94mode'])) \
-            .withColumn('visa_category', i94visa_udf(i94['i94visa']))
-    
-        i94 = i94.select([
-            'cicid', 'year','month', 'origin_country_code', 'age', 'arrival_date',
-            'arrival_day', 'departure_date', 'depdate', 'arrdate', 'port_code', 'mode', 'gender', 
-            'visa_category', 'visatype'])
-        
-        logging.info(f'Writing immigration data for {mon}')
-        i94.write.mode("append").partitionBy("year", "month", "arrival_day") \
-                .parquet(f"{processed_path}immigration_data")
-        logging.info(f'Finished writing immigration data for {mon}')
-        break
+    keys = spark.read.parquet(f"{processed_path}immigration_data") \
+        .where(f.col('month') == MONTHS.index(mon) + 1) \
+        .groupBy('year', 'month', 'origin_country_code', 'port_code') \
+        .agg(f.count(f.lit(1)).alias('row_count'), f.min('depdate').alias('min_depdate'),
+             f.max('depdate').alias('max_depdate'))
+    schemas.check_dataframe(keys, 'immigration_keys')
+    keys.coalesce(1).write.mode("overwrite").parquet(f"{processed_path}immigration_keys/{mon}")
+
+
+def enrichment_lookups(spark, processed_path):
+    """
+    Country and port lookups with the average temperature of each, for broadcast joins
+    
+    Built from code_mapping and the processed temperature, averaged over
+    the matching cities the same way dim_countries and dim_ports are, and
+    cached for every month of a run.
+    
+    Keyword arguments:
+    spark -- Spark Context
+    processed_path -- the S3 output data location holding temperature
     
-def preprocess_data():
+    """
+    temperature = spark.read.parquet(processed_path + 'temperature')
+    
+    countries = spark.createDataFrame(list(code_mapping.country_codes.items()), 'country_code string, country string') \
+        .withColumn('country_key', normalize_key_column('country'))
+    country_temperature = temperature.groupBy('country_key') \
+        .agg(f.avg('average_temperature').alias('country_average_temperature'))
+    countries = countries.join(country_temperature, 'country_key', 'left').select(
+        f.col('country_code').alias('origin_country_code'), f.col('country').alias('origin_country'),
+        'country_average_temperature')
+    
+    ports = spark.createDataFrame(list(zip(*code_mapping.port_columns(code_mapping.load_labels()))),
+                                  'port_code string, port_city string, port_state string') \
+        .withColumn('city_key', normalize_key_column('port_city'))
+    port_temperature = temperature.groupBy('city_key') \
+        .agg(f.avg('average_temperature').alias('port_average_temperature'))
+    ports = ports.join(port_temperature, 'city_key', 'left') \
+        .select('port_code', 'port_city', 'port_state', 'port_average_temperature')
+    
+    return countries.cache(), ports.cache()
+
+
+def write_immigration_enriched(spark, processed_path, mon, lookups, records_per_file):
+    """
+    Write one written month of I94 data with its country, port and temperature columns joined on
+    
+    The lookups are a few hundred rows each, so they are broadcast and the
+    month is read back and written without a shuffle for the joins. The
+    output is partitioned and sized like immigration_data, so scans on it
+    need no warehouse joins.
+    
+    Keyword arguments:
+    spark -- Spark Context
+    processed_path -- the S3 output data location
+    mon -- lower case month abbreviation
+    lookups -- (countries, ports) from enrichment_lookups
+    records_per_file -- rows per Parquet file
+    
+    """
+    countries, ports = lookups
+    month = MONTHS.index(mon) + 1
+    enriched = spark.read.parquet(f"{processed_path}immigration_data") \
+        .where(f.col('month') == month) \
+        .join(f.broadcast(countries), 'origin_country_code', 'left') \
+        .join(f.broadcast(ports), 'port_code', 'left')
+    columns = [column.name for column in schemas.OUTPUT_TABLES['immigration_enriched'].columns]
+    enriched = enriched.select(columns + layout.PARTITION_COLUMNS)
+    schemas.check_dataframe(enriched.drop(*layout.PARTITION_COLUMNS), 'immigration_enriched')
+    
+    logging.info(f'Writing enriched immigration data for {mon} {datetime.now()}')
+    layout.write_partitioned(enriched, f"{processed_path}immigration_enriched", records_per_file,
+                             tasks=layout.MONTH_TASKS)
+
+
+@spark_traced('process_immigration_month')
+def process_immigration_month(spark, mon, processed_path, decoding_engine='native', load_path=I94_PATH,
+                              load_format=I94_FORMAT, records_per_file=None, lookups=None,
+                              enriched_records_per_file=None):
+    """
+    Process one month of I94 Data and write its checkpoint
+    
+    Rewriting a month only replaces that month's partitions, so a month
+    that failed halfway can simply be run again. With lookups, the month is
+    also written to immigration_enriched.
+    
+    Keyword arguments:
+    spark -- Spark Context
+    mon -- lower case month abbreviation
+    processed_path -- the S3 output data location
+    decoding_engine -- 'native' column expressions or the 'udf' reference path
+    load_path -- raw I94 file location with a {mon} placeholder
+    load_format -- Spark source format of the raw files, e.g. parquet for synthetic months
+    records_per_file -- rows per Parquet file, from the configured target file size by default
+    lookups -- (countries, ports) from enrichment_lookups, None to skip the enriched output
+    enriched_records_per_file -- rows per enriched Parquet file
+    
+    """
+    annotate(month=mon)
+    logging.info(f'Loading immigration data for {mon} {datetime.now()}')
+    i94 = spark.read.format(load_format).load(load_path.format(mon=mon))
+    i94 = i94 \
+        .withColumn('year', i94['i94yr'].cast(IntegerType())) \
+        .withColumn('month', i94['i94mon'].cast(IntegerType())) \
+        .withColumn('origin_country_code', i94['i94cit'].cast(IntegerType()).cast(StringType())) \
+        .withColumn('age', i94['i94bir'].cast(IntegerType())) \
+        .withColumn('port_code', i94['i94port'].cast(StringType()))
+    i94 = decode_immigration(i94, engine=decoding_engine)
+
+    i94 = i94.select([
+        'cicid', 'year','month', 'origin_country_code', 'age', 'arrival_date',
+        'arrival_day', 'departure_date', 'depdate', 'arrdate', 'port_code', 'mode', 'gender', 
+        'visa_category', 'visatype'])
+    schemas.check_dataframe(i94.drop(*layout.PARTITION_COLUMNS), 'immigration_data')
+    
+    logging.info(f'Writing immigration data for {mon} {datetime.now()}')
+    if records_per_file is None:
+        records_per_file = immigration_records_per_file(spark, processed_path)
+    layout.write_partitioned(i94, f"{processed_path}immigration_data", records_per_file,
+                             tasks=layout.MONTH_TASKS)
+    
+    write_immigration_keys(spark, processed_path, mon)
+    if lookups is not None:
+        if enriched_records_per_file is None:
+            enriched_records_per_file = immigration_records_per_file(spark, processed_path, 'immigration_enriched')
+        write_immigration_enriched(spark, processed_path, mon, lookups, enriched_records_per_file)
+    
+    checkpoint = {'month': mon, 'source': load_path.format(mon=mon), 'finished_at': datetime.now().isoformat()}
+    write_text(spark, immigration_checkpoint_path(processed_path, mon), json.dumps(checkpoint))
+    logging.info(f'Finished writing immigration data for {mon} {datetime.now()}')
+    return mon
+
+
+@spark_traced('process_immigration_data')
+def process_immigration_data(spark, processed_path, months=None, max_workers=4,
+                             decoding_engine='native', load_path=I94_PATH, force=False, load_format=I94_FORMAT,
+                             enriched=None):
+    """
+    Process I94 Data for several months concurrently
+    
+    A month is skipped unless force is set, its raw file or the code changed
+    since its checkpoint was written, or the checkpoint is missing. A failed
+    month does not stop the others; failures are raised together once every
+    month has finished.
+    
+    With enriched, each month is also written to immigration_enriched with
+    readable countries, ports and temperatures. The enriched months then
+    also depend on the labels file and the processed temperature.
+    
+    Keyword arguments:
+    spark -- Spark Context
+    processed_path -- the S3 output data location
+    months -- lower case month abbreviations to process, all 12 by default
+    max_workers -- number of months written at the same time
+    decoding_engine -- 'native' column expressions or the 'udf' reference path
+    load_path -- raw I94 file location with a {mon} placeholder
+    force -- reprocess months whose inputs and code are unchanged
+    load_format -- Spark source format of the raw files
+    enriched -- also write immigration_enriched, ENRICHED_OUTPUT under [PREPROCESS] by default
+    
+    """
+    months = MONTHS if months is None else [mon.lower() for mon in months]
+    unknown = [mon for mon in months if mon not in MONTHS]
+    if unknown:
+        raise ValueError(f"Unknown months {unknown}. Expected abbreviations from {MONTHS}")
+    if enriched is None:
+        enriched = get_preprocess_settings()['enriched_output']
+    
+    lookups = enriched_records_per_file = None
+    if enriched:
+        lookups = enrichment_lookups(spark, processed_path)
+        enriched_records_per_file = immigration_records_per_file(spark, processed_path, 'immigration_enriched')
+    
+    def process_month(mon, records_per_file):
+        checkpoint = immigration_checkpoint_path(processed_path, mon)
+        inputs, outputs = [load_path.format(mon=mon)], [checkpoint[len(processed_path):]]
+        if enriched:
+            inputs += [code_mapping.LABELS_PATH, processed_path + 'temperature']
+            outputs.append('immigration_enriched')
+        return run_if_changed(
+            f'immigration_data/{mon}', inputs, outputs, processed_path,
+            lambda: process_immigration_month(spark, mon, processed_path, decoding_engine, load_path,
+                                              load_format, records_per_file, lookups, enriched_records_per_file),
+            force)
+    
+    logging.info(f'Begin loading immigration data for {months} {datetime.now()}')
+    records_per_file = immigration_records_per_file(spark, processed_path)
+    written = []
+    failed = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {submit(executor, process_month, mon, records_per_file): mon for mon in months}
+        for future in as_completed(futures):
+            mon = futures[future]
+            try:
+                if future.result() is not None:
+                    written.append(mon)
+            except Exception as e:
+                logging.error(f'Failed processing immigration data for {mon}: {e}')
+                failed[mon] = e
+    
+    # Incremental loads stage only the months written by this run. Full loads
+    # stage every processed month, so those manifests are rebuilt even when
+    # every month was skipped as unchanged
+    written = [mon for mon in months if mon in written]
+    if written:
+        write_immigration_manifests(spark, processed_path, [MONTHS.index(mon) + 1 for mon in written], enriched)
+    else:
+        write_immigration_copy_manifests(spark, processed_path)
+    if lookups is not None:
+        for lookup in lookups:
+            lookup.unpersist()
+    
+    if failed:
+        raise RuntimeError(f"Immigration data failed for months {sorted(failed)}. Rerun to retry only those months")
+    logging.info(f'Finished loading immigration data {datetime.now()}')
+
+
+
+def processed_immigration_months(spark, processed_path):
+    """
+    Month numbers with a checkpoint marker, i.e. every month processed so far
+    
+    Keyword arguments:
+    spark -- Spark Context
+    processed_path -- the S3 output data location
+    
+    """
+    checkpoints = list_files(spark, f"{processed_path}checkpoints/immigration_data")
+    return sorted(MONTHS.index(path.rstrip('/').split('/')[-1]) + 1 for path, _ in checkpoints)
+
+
+def immigration_partition_patterns(partitions, months):
+    """
+    Globs below immigration_data selecting the partitions of some months
+    
+    Months in the partition manifest are selected with layout.prune_partitions,
+    so only their arrival_day directories are listed. Months written before
+    the manifest existed fall back to a month glob.
+    
+    Keyword arguments:
+    partitions -- immigration_data partition manifest entries
+    months -- month numbers to select
+    
+    """
+    patterns = []
+    for month in months:
+        selected = layout.prune_partitions(partitions, month=(month, month))
+        if selected:
+            patterns.extend(partition['path'][len('immigration_data/'):] for partition in selected)
+        else:
+            patterns.append(f'year=*/month={month}')
+    return patterns
+
+
+def write_immigration_copy_manifests(spark, processed_path, months=()):
+    """
+    Write the COPY manifests of immigration data and its key set
+    
+    <dataset>.manifest lists every processed month, as a full load rebuilds
+    fact_immigration from staging. <dataset>.written.manifest lists the
+    given months, for incremental loads; it is left as it is when there
+    are none, and staging those months again replaces them with the same rows.
+    Files are listed from the partitions in the partition manifest, which
+    must already describe the written months.
+    
+    Keyword arguments:
+    spark -- Spark Context
+    processed_path -- the S3 output data location
+    months -- month numbers written
+    
+    """
+    partitions = layout.read_partition_manifest(spark, processed_path, 'immigration_data')
+    if months:
+        write_manifest(spark, processed_path, 'immigration_data', immigration_partition_patterns(partitions, months),
+                       'immigration_data.written')
+        write_manifest(spark, processed_path, 'immigration_keys', [MONTHS[month - 1] for month in months],
+                       'immigration_keys.written')
+    processed = processed_immigration_months(spark, processed_path)
+    write_manifest(spark, processed_path, 'immigration_data', immigration_partition_patterns(partitions, processed))
+    write_manifest(spark, processed_path, 'immigration_keys', [MONTHS[month - 1] for month in processed])
+
+
+def write_immigration_manifests(spark, processed_path, months, enriched=False):
+    """
+    Write the COPY manifests of immigration data and its key set and refresh the partition manifests
+    
+    immigration_enriched is never staged, so it only gets a partition manifest.
+    
+    Keyword arguments:
+    spark -- Spark Context
+    processed_path -- the S3 output data location
+    months -- month numbers written
+    enriched -- the months were also written to immigration_enriched
+    
+    """
+    for dataset in ['immigration_data'] + (['immigration_enriched'] if enriched else []):
+        partitions = layout.partition_stats(spark, processed_path, dataset, months)
+        layout.write_partition_manifest(spark, processed_path, dataset, partitions, months)
+    write_immigration_copy_manifests(spark, processed_path, months)
+
+
+@spark_traced('compact_immigration_data')
+def compact_immigration_data(spark, processed_path, months=None, target_file_mb=None):
+    """
+    Rewrite immigration months in place at the target Parquet file size
+    
+    For months written before the layout settings existed, or after the
+    target changed. The COPY manifests of immigration data and its key set
+    are then rewritten for the compacted files.
+    
+    Keyword arguments:
+    spark -- Spark Context
+    processed_path -- the S3 output data location
+    months -- lower case month abbreviations to compact, all 12 by default
+    target_file_mb -- target file size, [LAYOUT] TARGET_FILE_MB by default
+    
+    """
+    months = MONTHS if months is None else [mon.lower() for mon in months]
+    unknown = [mon for mon in months if mon not in MONTHS]
+    if unknown:
+        raise ValueError(f"Unknown months {unknown}. Expected abbreviations from {MONTHS}")
+    numbers = [MONTHS.index(mon) + 1 for mon in months]
+    
+    layout.compact_partitions(spark, processed_path, 'immigration_data', numbers,
+                              target_file_mb and target_file_mb * 2 ** 20)
+    # The compacted months become the written months, so the immigration
+    # and key set manifests staged next cover the same months
+    write_immigration_copy_manifests(spark, processed_path, numbers)
+
+
+def compact_data(months=None, target_file_mb=None):
+    """
+    Compact processed immigration data in its own Spark session
+    
+    Keyword arguments:
+    months -- lower case month abbreviations to compact, all 12 by default
+    target_file_mb -- target file size, [LAYOUT] TARGET_FILE_MB by default
+    
+    """
     spark = create_spark_session()
-    raw_path = "data/raw_data"
-    processed_path = "s3a://staging-immigration/"
+    try:
+        compact_immigration_data(spark, get_warehouse().processed_path, months, target_file_mb)
+    finally:
+        spark_run_metrics(spark)
+        spark.stop()
+    
+    
+def process_temperature_data(get_spark, raw_path, processed_path, force=False):
+    """
+    Process temperature data unless the raw file and code are unchanged
+    
+    Keyword arguments:
+    get_spark -- callable returning a Spark session, only called when the step runs
+    raw_path -- the input data location
+    processed_path -- the S3 output data location
+    force -- process even when nothing changed since the last run
+    
+    """
+    return run_if_changed(
+        'temperature', [f"{raw_path}/{schemas.RAW_FILES['temperature'].name}"], ['manifests/temperature.manifest'],
+        processed_path, lambda: process_temperature(get_spark(), raw_path, processed_path), force)
+
+
+def preprocess_data(force=False):
+    """
+    Process every dataset whose raw input or preprocessing code changed
     
-    #process_port_codes(spark, processed_path)
-    #process_country_codes(spark, processed_path)
-    process_airport_codes(spark, raw_path, processed_path)    
-    #process_temperature(spark, raw_path, processed_path)
-    #process_demographic(spark, raw_path, processed_path)
-    #process_immigration_data(spark, processed_path)
+    Keyword arguments:
+    force -- process every dataset even when nothing changed
     
-    spark.stop()
+    """
+    raw_path = "data/raw_data"
+    processed_path = get_warehouse().processed_path
+    
+    # Small reference data is written with Arrow, and Spark is only started
+    # by a step that runs and needs it
+    sessions = []
+    def get_spark():
+        if not sessions:
+            sessions.append(create_spark_session())
+        return sessions[0]
+    
+    for dataset in ['port_codes', 'country_codes', 'airport_codes', 'demographic']:
+        process_reference_data(dataset, raw_path, processed_path, get_spark, force)
+    process_temperature_data(get_spark, raw_path, processed_path, force)
+    process_immigration_data(get_spark(), processed_path, force=force)
+    
+    for spark in sessions:
+        spark_run_metrics(spark)
+        spark.stop()
     
 
 if __name__ == "__main__":
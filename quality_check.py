@@ -1,63 +1,264 @@
-import configparser
-import psycopg2
-from sql_queries import staging_count_data_quality_check, staging_to_fact_data_quality_check
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from db import run_transaction
+from instrumentation import span, traced, submit
+from sql_queries import quality_scan, quality_sample, staged_immigration_partitions
 
 import logging
 logging.basicConfig(filename='staging.log', level=logging.DEBUG)
 logging.getLogger("py4j").setLevel(logging.ERROR)
 
-def count_immigration_staging(cur, conn):
+# A declared data quality check
+# name -- description used in logs and failures
+# metrics -- (table, SQL aggregate over alias t) pairs the rule reads
+# joins -- (table, LEFT JOIN clause) pairs its metrics need, joined on unique keys only
+# check -- function of the metric values returning (passed, detail)
+# exact -- needs full table counts, so it is skipped in sampled mode
+Rule = namedtuple('Rule', ['name', 'metrics', 'joins', 'check', 'exact'])
+
+# Labels written by decoding.I94_CODES, repeated here so checks never import Spark
+TRAVEL_MODES = ('Air', 'Sea', 'Land', 'Not reported')
+VISA_CATEGORIES = ('Business', 'Pleasure', 'Student', 'Invalid Visa Type')
+
+
+def row_count(table, min_rows=1):
+    """
+    Table holds at least min_rows rows
+
+    """
+    def check(rows):
+        return rows >= min_rows, f'{rows} rows'
+    return Rule(f'{table} has at least {min_rows} rows', ((table, 'COUNT(*)'),), (), check, False)
+
+
+def null_rate(table, column, max_rate=0.0):
+    """
+    Share of NULLs in a column stays under max_rate
+
+    """
+    def check(rows, nulls):
+        rate = nulls / rows if rows else 0.0
+        return rate <= max_rate, f'{rate:.2%} null'
+    metrics = ((table, 'COUNT(*)'), (table, f'COUNT(CASE WHEN t.{column} IS NULL THEN 1 END)'))
+    return Rule(f'{table}.{column} null rate at most {max_rate:.2%}', metrics, (), check, False)
+
+
+def foreign_key(table, column, ref_table, ref_column):
+    """
+    Every non NULL value in a column exists in the referenced table
+
+    """
+    alias = f'{ref_table}_{column}'
+    join = f'LEFT JOIN public.{ref_table} {alias} ON t.{column} = {alias}.{ref_column}'
+    orphans = f'COUNT(CASE WHEN t.{column} IS NOT NULL AND {alias}.{ref_column} IS NULL THEN 1 END)'
+
+    def check(missing):
+        return missing == 0, f'{missing} rows without a {ref_table} match'
+    return Rule(f'{table}.{column} references {ref_table}.{ref_column}', ((table, orphans),),
+                ((table, join),), check, False)
+
+
+def value_domain(table, column, values):
     """
-    Ensure immigration data has made it to staging table
-    
+    Every non NULL value in a column is one of values
+
     """
-    cur.execute(staging_count_data_quality_check)
-    conn.commit()
-    values = cur.fetchall()
-    
-    if values[0][0] < 1:
-        logging.error("Staging immigration table returned no results".format(table))
-        raise ValueError("Data quality check failed. Staging immigration returned no results")
-        
-    logging.info("Staging immigration table appears to be populated")
-    
+    literals = ', '.join("'{}'".format(value.replace("'", "''")) for value in values)
+    outside = f'COUNT(CASE WHEN t.{column} NOT IN ({literals}) THEN 1 END)'
+
+    def check(invalid):
+        return invalid == 0, f'{invalid} rows outside the domain'
+    return Rule(f'{table}.{column} in {list(values)}', ((table, outside),), (), check, False)
 
-def count_immigration_fact(cur, conn):
+
+def staged_fact_reconciliation():
     """
-    Ensure immigration data has made it to fact table
-    
+    Every staged immigration row with known country and port reached the fact table
+
+    Fact rows are only counted for the partitions currently staged, so
+    partitions kept from earlier incremental loads do not count.
+
     """
-    cur.execute(staging_to_fact_data_quality_check)
-    conn.commit()
-    values = cur.fetchall()
-    
-    if values[0][0] > 0:
-        logging.error("Fact immigration table returned zero rows")
-        raise ValueError("Data quality check failed. Fact immigration returned no results")
-        
-    logging.info("Fact immigration table appears to be populated with staging data")
-    
+    staged = ('COUNT(CASE WHEN t.arrdate IS NOT NULL AND t.arrival_date IS NOT NULL '
+              'AND staged_country.country_code IS NOT NULL AND staged_port.port_code IS NOT NULL THEN 1 END)')
+    loaded = 'COUNT(staged_partition.year)'
+    joins = (
+        ('staging_immigration',
+         'LEFT JOIN public.dim_countries staged_country ON t.origin_country_code = staged_country.country_code'),
+        ('staging_immigration',
+         'LEFT JOIN public.dim_ports staged_port ON t.port_code = staged_port.port_code'),
+        ('fact_immigration',
+         f'LEFT JOIN ({staged_immigration_partitions}) staged_partition '
+         'ON t.year = staged_partition.year AND t.month = staged_partition.month'),
+    )
+
+    def check(staged_rows, fact_rows):
+        return staged_rows == fact_rows, f'{staged_rows} staged rows, {fact_rows} fact rows'
+    return Rule('staging_immigration reconciles with fact_immigration',
+                (('staging_immigration', staged), ('fact_immigration', loaded)), joins, check, True)
 
 
-def check_data_quality():
+def staged_keys_reconciliation():
     """
-    Connect to DB, create staging tables, copy data from S3 to DB
-    
+    The staged key set accounts for every staged immigration row
+
+    Dimension extracts only look at staging_immigration_keys, so a stale key
+    set would silently drop countries and ports.
+
+    """
+    def check(staged_rows, key_rows):
+        key_rows = key_rows or 0
+        return staged_rows == key_rows, f'{staged_rows} staged rows, {key_rows} rows in the key set'
+    return Rule('staging_immigration_keys reconciles with staging_immigration',
+                (('staging_immigration', 'COUNT(*)'), ('staging_immigration_keys', 'SUM(t.row_count)')),
+                (), check, True)
+
+
+STAGING_RULES = [
+    row_count('staging_immigration'),
+    row_count('staging_ports'),
+    row_count('staging_countries'),
+    row_count('staging_airports'),
+    row_count('staging_temperatures'),
+    row_count('staging_demographics'),
+    row_count('staging_immigration_keys'),
+    null_rate('staging_immigration', 'cicid'),
+    null_rate('staging_immigration', 'arrdate'),
+    null_rate('staging_immigration', 'origin_country_code', 0.01),
+    null_rate('staging_immigration', 'port_code', 0.01),
+    value_domain('staging_immigration', 'mode', TRAVEL_MODES),
+    value_domain('staging_immigration', 'visa_category', VISA_CATEGORIES),
+    staged_keys_reconciliation(),
+]
+
+FACT_RULES = [
+    row_count('fact_immigration'),
+    null_rate('fact_immigration', 'country_id'),
+    null_rate('fact_immigration', 'port_id'),
+    foreign_key('fact_immigration', 'country_id', 'dim_countries', 'country_id'),
+    foreign_key('fact_immigration', 'port_id', 'dim_ports', 'port_id'),
+    foreign_key('fact_immigration', 'arrdate', 'dim_time', 'sas_timestamp'),
+    foreign_key('fact_immigration', 'depdate', 'dim_time', 'sas_timestamp'),
+    value_domain('fact_immigration', 'travel_mode', TRAVEL_MODES),
+    value_domain('fact_immigration', 'visa_category', VISA_CATEGORIES),
+    staged_fact_reconciliation(),
+]
+
+
+def compile_scans(rules, sample_rows=None):
     """
-    config = configparser.ConfigParser()
-    config.read('dl.cfg')
+    Merge the metrics of every rule into one query per table
 
-    logging.info('Connecting to DB')
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
-    
-    logging.info('Data Quality Check 1')
-    count_immigration_staging(cur, conn)
-    logging.info('Data Quality Check 2')
-    count_immigration_fact(cur, conn)
+    Returns {table: (query, metrics)} with metrics in result column order.
 
-    conn.close()
+    Keyword arguments:
+    rules -- Rule list
+    sample_rows -- only scan the first sample_rows rows of each table
+
+    """
+    plans = {}
+    for rule in rules:
+        for table, metric in rule.metrics:
+            metrics, _ = plans.setdefault(table, ([], []))
+            if metric not in metrics:
+                metrics.append(metric)
+        for table, join in rule.joins:
+            _, joins = plans.setdefault(table, ([], []))
+            if join not in joins:
+                joins.append(join)
+
+    scans = {}
+    for table, (metrics, joins) in plans.items():
+        if sample_rows is None:
+            source = f'public.{table}'
+        else:
+            source = quality_sample.format(table=table, rows=int(sample_rows))
+        query = quality_scan.format(metrics=',\n'.join(f'{metric} AS m{i}' for i, metric in enumerate(metrics)),
+                                    source=source, joins='\n'.join(joins))
+        scans[table] = (query, metrics)
+    return scans
+
+
+def run_scan(cur, conn, table, query):
+    """
+    Execute one compiled scan and return its single result row
+
+    """
+    with span(f'check {table}', table=table):
+        cur.execute(query)
+        return cur.fetchone()
+
+
+def run_checks(rules, max_workers=4, sample_rows=None):
+    """
+    Evaluate rules with one concurrent scan per table
+
+    Keyword arguments:
+    rules -- Rule list
+    max_workers -- number of scans running at the same time
+    sample_rows -- smoke check the first sample_rows rows of each table, skipping exact rules
+
+    """
+    if sample_rows is not None:
+        skipped = [rule.name for rule in rules if rule.exact]
+        rules = [rule for rule in rules if not rule.exact]
+        if skipped:
+            logging.info(f'Sampled data quality check skips {skipped}')
+
+    scans = compile_scans(rules, sample_rows)
+    values = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {table: submit(executor, run_transaction, 'check', run_scan, table, query)
+                   for table, (query, _) in scans.items()}
+        for table, future in futures.items():
+            for metric, value in zip(scans[table][1], future.result()):
+                values[(table, metric)] = value
+
+    failed = []
+    for rule in rules:
+        passed, detail = rule.check(*(values[metric] for metric in rule.metrics))
+        if passed:
+            logging.info(f'Data quality check passed: {rule.name} ({detail})')
+        else:
+            logging.error(f'Data quality check failed: {rule.name} ({detail})')
+            failed.append(f'{rule.name} ({detail})')
+
+    if failed:
+        raise ValueError(f"Data quality check failed. {'; '.join(failed)}")
+    logging.info(f'{len(rules)} data quality checks passed in {len(scans)} scans')
+    return len(rules)
+
+
+def count_immigration_staging(max_workers=4, sample_rows=None):
+    """
+    Ensure data has made it to the staging tables and looks sane
+
+    """
+    return run_checks(STAGING_RULES, max_workers, sample_rows)
+
+
+def count_immigration_fact(max_workers=4, sample_rows=None):
+    """
+    Ensure staging data has made it to the fact table intact
+
+    """
+    return run_checks(FACT_RULES, max_workers, sample_rows)
+
+
+@traced('check_data_quality')
+def check_data_quality(max_workers=4, sample_rows=None):
+    """
+    Run every data quality rule, one scan per table
+
+    Keyword arguments:
+    max_workers -- number of scans running at the same time
+    sample_rows -- smoke check the first sample_rows rows of each table
+
+    """
+    logging.info('Data Quality Check')
+    return run_checks(STAGING_RULES + FACT_RULES, max_workers, sample_rows)
 
 
 if __name__ == "__main__":
-    check_data_quality()
\ No newline at end of file
+    check_data_quality()
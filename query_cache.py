@@ -0,0 +1,226 @@
+import configparser
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+logging.basicConfig(filename='staging.log', level=logging.DEBUG)
+logging.getLogger("py4j").setLevel(logging.ERROR)
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_version = None
+# (load version, time.monotonic() it was read at)
+_load_version = None
+_settings = None
+
+
+def get_settings(config_path='dl.cfg'):
+    """
+    Cache settings, read once per process
+
+    Keyword arguments:
+    config_path -- configuration file location
+
+    """
+    global _settings
+    if _settings is None:
+        config = configparser.ConfigParser()
+        config.read(config_path)
+        _settings = {
+            'dir': config.get('CACHE', 'DIR', fallback='.query_cache'),
+            'max_entries': config.getint('CACHE', 'MAX_ENTRIES', fallback=128),
+            'disk': config.getboolean('CACHE', 'DISK', fallback=False),
+            'version_ttl_s': config.getfloat('CACHE', 'VERSION_TTL_S', fallback=5.0),
+        }
+    return _settings
+
+
+def read_load_version():
+    """
+    Load version stored in the warehouse, 'initial' before the first extract
+
+    """
+    import psycopg2
+    from db import fetch_all
+    from sql_queries import current_load_version
+
+    try:
+        rows = fetch_all('query', current_load_version)
+    except psycopg2.errors.UndefinedTable:
+        return 'initial'
+    return rows[0][0] if rows else 'initial'
+
+
+def load_version(max_age=None):
+    """
+    Current warehouse load version, bumped by the pipeline after each extract
+
+    The version lives in the warehouse, so every process and host sees the
+    same one. It is read again once the last read is older than max_age.
+
+    Keyword arguments:
+    max_age -- seconds a read version is trusted, VERSION_TTL_S under [CACHE] by default
+
+    """
+    global _load_version
+    max_age = get_settings()['version_ttl_s'] if max_age is None else max_age
+    read = _load_version
+    if read is not None and time.monotonic() - read[1] < max_age:
+        return read[0]
+    version = read_load_version()
+    _load_version = (version, time.monotonic())
+    return version
+
+
+def bump_load_version():
+    """
+    Publish a new load version in the warehouse, invalidating every cached result
+
+    """
+    global _load_version
+    from db import run_transaction
+    from sql_queries import ensure_load_version_table, publish_load_version
+
+    version = uuid.uuid4().hex
+
+    def publish(cur, conn):
+        cur.execute(ensure_load_version_table)
+        cur.execute(publish_load_version, {'version': version, 'bumped_at': datetime.now()})
+
+    run_transaction('extract', publish)
+    _load_version = (version, time.monotonic())
+    logging.info(f'Bumped query cache load version to {version}')
+    return version
+
+
+def cache_key(query, params):
+    """
+    Cache key for a query and its parameters
+
+    Keyword arguments:
+    query -- SQL query
+    params -- query parameters
+
+    """
+    if isinstance(params, dict):
+        params = sorted(params.items())
+    return hashlib.sha256(f'{query}\0{params!r}'.encode('utf-8')).hexdigest()
+
+
+def check_version(version):
+    """
+    Drop every cached result from an older load version
+
+    Keyword arguments:
+    version -- current load version
+
+    """
+    global _cache_version
+    if version == _cache_version:
+        return
+    with _cache_lock:
+        if version == _cache_version:
+            return
+        _cache.clear()
+        settings = get_settings()
+        if settings['disk'] and os.path.isdir(settings['dir']):
+            for entry in os.listdir(settings['dir']):
+                path = os.path.join(settings['dir'], entry)
+                if os.path.isdir(path) and entry != version:
+                    shutil.rmtree(path, ignore_errors=True)
+        _cache_version = version
+
+
+def disk_path(version, key):
+    """
+    Parquet file holding a cached result
+
+    Keyword arguments:
+    version -- load version
+    key -- cache key
+
+    """
+    return os.path.join(get_settings()['dir'], version, f'{key}.parquet')
+
+
+def remember(key, frame, version):
+    """
+    Store a result in memory, evicting the least recently used beyond the limit
+
+    Keyword arguments:
+    key -- cache key
+    frame -- result DataFrame
+    version -- load version the result was read under; it is not stored
+               if the cache has moved on to another version
+
+    """
+    with _cache_lock:
+        if version != _cache_version:
+            return
+        _cache[key] = frame
+        _cache.move_to_end(key)
+        while len(_cache) > get_settings()['max_entries']:
+            _cache.popitem(last=False)
+
+
+def cached_query(stage, query, columns, params=None):
+    """
+    Query result as a DataFrame, served from cache while the load version holds
+
+    Looks in memory, then in the Parquet tier when enabled, and only then
+    queries the warehouse. A result is not cached if the load version
+    changed while it was being queried.
+
+    Keyword arguments:
+    stage -- pipeline stage name, used for logging
+    query -- SQL query
+    columns -- result column names
+    params -- query parameters
+
+    """
+    import pandas as pd
+    from db import fetch_all
+
+    version = load_version()
+    check_version(version)
+    key = cache_key(query, params)
+
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key].copy()
+
+    settings = get_settings()
+    path = disk_path(version, key)
+    if settings['disk'] and os.path.exists(path):
+        frame = pd.read_parquet(path)
+    else:
+        frame = pd.DataFrame(fetch_all(stage, query, params), columns=columns)
+        if load_version(max_age=0) != version:
+            logging.info(f'Load version changed during query {key[:12]}, result not cached')
+            return frame
+        if settings['disk']:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.tmp'
+            frame.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+
+    remember(key, frame, version)
+    return frame.copy()
+
+
+def clear_cache():
+    """
+    Drop every in-memory result
+
+    """
+    global _cache_version
+    with _cache_lock:
+        _cache.clear()
+        _cache_version = None
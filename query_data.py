@@ -1,39 +1,74 @@
-import configparser
-import re
-import psycopg2
-import os
-import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
+from query_cache import cached_query
+import sql_queries
+from sql_queries import monthly_rollup_loaded
 
-from sql_queries import imigrants_by_country, arrival_days
+# Month the reports cover
+REPORT_YEAR = 2016
+REPORT_MONTH = 4
 
-def load_immigrants_by_country():
-    config = configparser.ConfigParser()
-    config.read('dl.cfg')
+# report name -> (query name in sql_queries, same report from the monthly rollup, result columns)
+REPORTS = {
+    'immigrants-by-country': ('imigrants_by_country', 'imigrants_by_country_rollup', ['Country', 'Number of Immigrants']),
+    'arrival-days': ('arrival_days', 'arrival_days_rollup', ['Day of Week', 'Number of Immigrants']),
+}
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
+def rollup_loaded(year=REPORT_YEAR, month=REPORT_MONTH):
+    """
+    Whether the monthly rollup holds a month, so reports can read it
     
-    cur.execute(imigrants_by_country)
-    conn.commit()
-    values = cur.fetchall()
-    conn.close()
+    Keyword arguments:
+    year -- report year
+    month -- report month
     
-    return pd.DataFrame(values, columns=['Country', 'Number of Immigrants'])
+    """
+    loaded = cached_query('query', monthly_rollup_loaded, ['partitions'], {'year': year, 'month': month})
+    return loaded['partitions'][0] > 0
 
 
-def load_arrival_day():
-    config = configparser.ConfigParser()
-    config.read('dl.cfg')
+def report_query(report, year=REPORT_YEAR, month=REPORT_MONTH):
+    """
+    SQL and parameters for a report, from the monthly rollup when it holds the report month
+    
+    Keyword arguments:
+    report -- report name in REPORTS
+    year -- report year
+    month -- report month
+    
+    """
+    fact_query, rollup_query, _ = REPORTS[report]
+    query = getattr(sql_queries, rollup_query if rollup_loaded(year, month) else fact_query)
+    return query, {'year': year, 'month': month}
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
+
+def load_report(report, year=REPORT_YEAR, month=REPORT_MONTH):
+    """
+    A report's rows as a DataFrame, cached until the next load
     
-    cur.execute(arrival_days)
-    conn.commit()
-    values = cur.fetchall()
-    conn.close()
+    Keyword arguments:
+    report -- report name in REPORTS
+    year -- report year
+    month -- report month
     
-    return pd.DataFrame(values, columns=['Day of Week', 'Number of Immigrants'])
+    """
+    query, params = report_query(report, year, month)
+    return cached_query('query', query, REPORTS[report][2], params)
+
+
+def load_immigrants_by_country():
+    return load_report('immigrants-by-country')
+
+
+def load_arrival_day():
+    return load_report('arrival-days')
 
+
+def print_report(report):
+    """
+    Print a report's rows as tab separated values
+    
+    Keyword arguments:
+    report -- report name in REPORTS
+    
+    """
+    for row in load_report(report).itertuples(index=False):
+        print('\t'.join(str(value) for value in row))
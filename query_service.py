@@ -0,0 +1,264 @@
+import asyncio
+import configparser
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2.extensions import QueryCanceledError
+
+import sql_queries
+from db import get_settings as get_pool_settings, run_transaction
+from instrumentation import span
+
+logging.basicConfig(filename='staging.log', level=logging.DEBUG)
+logging.getLogger("py4j").setLevel(logging.ERROR)
+
+# A catalog query answered from fact_immigration, or from the monthly rollup
+# when the rollup holds every month of the requested range
+CatalogQuery = namedtuple('CatalogQuery', ['fact_query', 'rollup_query', 'columns'])
+
+CATALOG = {
+    'immigrants_by_country': CatalogQuery('immigrants_by_country_query', 'immigrants_by_country_rollup_query',
+                                          ['Country', 'Number of Immigrants']),
+    'immigrants_by_port': CatalogQuery('immigrants_by_port_query', 'immigrants_by_port_rollup_query',
+                                       ['Port', 'City', 'State', 'Number of Immigrants']),
+    'arrival_days': CatalogQuery('arrival_days_query', 'arrival_days_rollup_query',
+                                 ['Day of Week', 'Number of Immigrants']),
+    'monthly_immigrants': CatalogQuery('monthly_immigrants_query', 'monthly_immigrants_rollup_query',
+                                       ['Year', 'Month', 'Number of Immigrants']),
+    'visa_categories': CatalogQuery('visa_categories_query', 'visa_categories_rollup_query',
+                                    ['Visa Category', 'Number of Immigrants']),
+}
+
+# Parameters every catalog query takes and their defaults
+PARAMETERS = {
+    'start_year': 2016, 'start_month': 4, 'end_year': None, 'end_month': None,
+    'country': None, 'port': None, 'visa_category': None, 'limit': 10,
+}
+
+# One finished catalog query; source is 'fact' or 'rollup'
+QueryResult = namedtuple('QueryResult', ['name', 'params', 'columns', 'rows', 'source', 'seconds'])
+
+_settings = None
+
+
+def get_settings(config_path='dl.cfg'):
+    """
+    Query service settings, read once per process
+
+    Keyword arguments:
+    config_path -- configuration file location
+
+    """
+    global _settings
+    if _settings is None:
+        config = configparser.ConfigParser()
+        config.read(config_path)
+        _settings = {
+            'max_concurrency': config.getint('QUERY', 'MAX_CONCURRENCY', fallback=8),
+            'timeout_s': config.getfloat('QUERY', 'TIMEOUT_S', fallback=30.0),
+        }
+    return _settings
+
+
+def query_params(**params):
+    """
+    Complete and check the parameters of a catalog query
+
+    The range ends at the start month when no end is given. Months are
+    also passed as year * 12 + month periods, so a range can span years.
+
+    Keyword arguments:
+    params -- values for names in PARAMETERS
+
+    """
+    unknown = sorted(set(params) - set(PARAMETERS))
+    if unknown:
+        raise ValueError(f"Unknown query parameters {unknown}. Expected names from {sorted(PARAMETERS)}")
+    params = dict(PARAMETERS, **params)
+    if params['end_year'] is None:
+        params['end_year'] = params['start_year']
+    if params['end_month'] is None:
+        params['end_month'] = params['start_month'] if params['end_year'] == params['start_year'] else 12
+    for key in ['start_month', 'end_month']:
+        if not 1 <= params[key] <= 12:
+            raise ValueError(f"{key} must be between 1 and 12, got {params[key]}")
+    params['start_period'] = params['start_year'] * 12 + params['start_month']
+    params['end_period'] = params['end_year'] * 12 + params['end_month']
+    if params['start_period'] > params['end_period']:
+        raise ValueError(f"Query range starts after it ends: {params['start_year']}-{params['start_month']} "
+                         f"to {params['end_year']}-{params['end_month']}")
+    return params
+
+
+class RunningQuery:
+    """
+    Connection of a query running in a worker thread, so it can be cancelled from the event loop
+
+    """
+    def __init__(self):
+        self.conn = None
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+
+    def attach(self, conn):
+        with self.lock:
+            if self.cancelled.is_set():
+                raise asyncio.CancelledError()
+            self.conn = conn
+
+    def detach(self):
+        with self.lock:
+            self.conn = None
+
+    def cancel(self):
+        """
+        Cancel the statement running on the attached connection, if any
+
+        """
+        with self.lock:
+            self.cancelled.set()
+            if self.conn is not None:
+                self.conn.cancel()
+
+
+class QueryService:
+    """
+    Run catalog queries concurrently from asyncio on the shared connection pool
+
+    Queries run in at most max_concurrency worker threads, never more than
+    the pool has connections. A query that exceeds its timeout, or whose
+    task is cancelled, has its statement cancelled in the database and
+    raises TimeoutError or CancelledError in the caller.
+
+    Keyword arguments:
+    max_concurrency -- queries running at the same time, MAX_CONCURRENCY under [QUERY] by default
+    timeout_s -- default per-query timeout in seconds, TIMEOUT_S under [QUERY] by default
+
+    """
+    def __init__(self, max_concurrency=None, timeout_s=None):
+        settings = get_settings()
+        max_concurrency = max_concurrency or settings['max_concurrency']
+        self.max_concurrency = min(max_concurrency, get_pool_settings()['max_connections'])
+        self.timeout_s = settings['timeout_s'] if timeout_s is None else timeout_s
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='query')
+        self.slots = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def fetch(self, name, params, running, timeout_s):
+        """
+        Run one catalog query in a pooled transaction, in a worker thread
+
+        The statement timeout is set to the query timeout as a backstop
+        for when the event loop cannot cancel it.
+
+        """
+        query = CATALOG[name]
+
+        def fetch_rows(cur, conn):
+            running.attach(conn)
+            try:
+                cur.execute(sql_queries.rollup_months_loaded, params)
+                rollup = cur.fetchone()[0] == params['end_period'] - params['start_period'] + 1
+                cur.execute(getattr(sql_queries, query.rollup_query if rollup else query.fact_query), params)
+                return cur.fetchall(), 'rollup' if rollup else 'fact'
+            except QueryCanceledError as e:
+                # not retried as a transient error
+                raise TimeoutError(f'Query {name} was cancelled after {timeout_s}s') from e
+            finally:
+                running.detach()
+
+        with span(f'query_{name}') as record:
+            rows, source = run_transaction('query', fetch_rows, statement_timeout=int(timeout_s * 1000))
+            record['rows_out'] = len(rows)
+        return rows, source
+
+    async def run(self, name, timeout_s=None, **params):
+        """
+        Run a catalog query and return its QueryResult
+
+        The timeout covers the query once it holds a connection, not the
+        wait for a free slot.
+
+        Keyword arguments:
+        name -- query name in CATALOG
+        timeout_s -- timeout in seconds, the service default when None
+        params -- values for names in PARAMETERS
+
+        """
+        if name not in CATALOG:
+            raise ValueError(f"Unknown query {name}. Expected names from {sorted(CATALOG)}")
+        params = query_params(**params)
+        timeout_s = self.timeout_s if timeout_s is None else timeout_s
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_concurrency)
+
+        async with self.slots:
+            running = RunningQuery()
+            start = time.perf_counter()
+            future = asyncio.get_running_loop().run_in_executor(
+                self.executor, self.fetch, name, params, running, timeout_s)
+            try:
+                rows, source = await asyncio.wait_for(future, timeout_s)
+            except asyncio.TimeoutError:
+                running.cancel()
+                logging.warning(f'Query {name} timed out after {timeout_s}s with {params}')
+                raise TimeoutError(f'Query {name} timed out after {timeout_s}s')
+            except asyncio.CancelledError:
+                running.cancel()
+                logging.info(f'Query {name} cancelled with {params}')
+                raise
+        return QueryResult(name, params, CATALOG[name].columns, rows, source, time.perf_counter() - start)
+
+    async def run_many(self, requests):
+        """
+        Run several catalog queries concurrently
+
+        Returns one QueryResult per request, in request order, or the
+        exception a request failed with. Cancelling the call cancels every
+        query still running.
+
+        Keyword arguments:
+        requests -- (name, params) pairs, params a dict that may hold timeout_s
+
+        """
+        return await asyncio.gather(*(self.run(name, **params) for name, params in requests),
+                                    return_exceptions=True)
+
+
+def run_queries(names, max_concurrency=None, timeout_s=None, **params):
+    """
+    Run catalog queries concurrently with the same parameters and print each one's rows
+
+    Keyword arguments:
+    names -- query names in CATALOG
+    max_concurrency -- queries running at the same time
+    timeout_s -- per-query timeout in seconds
+    params -- values for names in PARAMETERS
+
+    """
+    params = {key: value for key, value in params.items() if value is not None}
+    with QueryService(max_concurrency, timeout_s) as service:
+        results = asyncio.run(service.run_many([(name, params) for name in names]))
+    failed = []
+    for name, result in zip(names, results):
+        if isinstance(result, BaseException):
+            print(f'# {name} failed: {result}')
+            failed.append(name)
+            continue
+        print(f'# {name} ({result.source}, {result.seconds:.2f}s)')
+        print('\t'.join(result.columns))
+        for row in result.rows:
+            print('\t'.join(str(value) for value in row))
+    if failed:
+        raise RuntimeError(f'Queries {failed} failed')
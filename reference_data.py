@@ -0,0 +1,253 @@
+import configparser
+import logging
+import re
+
+import code_mapping
+import schemas
+from input_manifest import run_if_changed
+from instrumentation import traced, annotate
+from join_keys import normalize_key
+from storage import copy_manifest
+
+logging.basicConfig(filename='staging.log', level=logging.DEBUG)
+logging.getLogger("py4j").setLevel(logging.ERROR)
+
+AIRPORT_FILE = schemas.RAW_FILES['airport_codes'].name
+DEMOGRAPHIC_FILE = schemas.RAW_FILES['demographic'].name
+
+# Airport columns kept and their types in the schema registry
+AIRPORT_COLUMNS = schemas.arrow_types(schemas.RAW_FILES['airport_codes'], [
+    'ident', 'type', 'name', 'elevation_ft', 'iso_country', 'municipality', 'gps_code',
+    'local_code', 'coordinates'])
+
+# Demographic CSV columns and their types in the schema registry
+DEMOGRAPHIC_COLUMNS = schemas.arrow_types(schemas.RAW_FILES['demographic'])
+
+_settings = None
+
+
+def get_settings(config_path='dl.cfg'):
+    """
+    Preprocessing settings, read once per process
+
+    Keyword arguments:
+    config_path -- configuration file location
+
+    """
+    global _settings
+    if _settings is None:
+        config = configparser.ConfigParser()
+        config.read(config_path)
+        _settings = {
+            'arrow_max_bytes': config.getint('PREPROCESS', 'ARROW_MAX_MB', fallback=256) * 2 ** 20,
+            'enriched_output': config.getboolean('PREPROCESS', 'ENRICHED_OUTPUT', fallback=False),
+        }
+    return _settings
+
+
+def filesystem(path):
+    """
+    Arrow filesystem and path for a local or s3a location
+
+    """
+    import pyarrow.fs as pa_fs
+
+    if re.match(r'^s3a?://', path):
+        return pa_fs.FileSystem.from_uri(re.sub(r'^s3a://', 's3://', path))
+    return pa_fs.LocalFileSystem(), path
+
+
+def file_size(path):
+    """
+    Size in bytes of a local or s3a file
+
+    """
+    fs, fs_path = filesystem(path)
+    return fs.get_file_info(fs_path).size
+
+
+def write_dataset(table, processed_path, dataset):
+    """
+    Replace a processed dataset with a single Parquet file and write its COPY manifest
+
+    Matches what the Spark writers leave behind: a dataset directory of
+    Parquet files and manifests/<dataset>.manifest listing them.
+
+    Keyword arguments:
+    table -- Arrow table
+    processed_path -- the output data location
+    dataset -- output directory name below processed_path
+
+    """
+    import pyarrow.parquet as pq
+
+    schemas.check_arrow(table.schema, dataset, dataset)
+    fs, root = filesystem(processed_path)
+    directory = f"{root.rstrip('/')}/{dataset}"
+    fs.create_dir(directory, recursive=True)
+    fs.delete_dir_contents(directory)
+    pq.write_table(table, f'{directory}/part-00000.snappy.parquet', filesystem=fs, compression='snappy')
+
+    files = [(f'{processed_path}{dataset}/part-00000.snappy.parquet',
+              fs.get_file_info(f'{directory}/part-00000.snappy.parquet').size)]
+    fs.create_dir(f"{root.rstrip('/')}/manifests", recursive=True)
+    with fs.open_output_stream(f"{root.rstrip('/')}/manifests/{dataset}.manifest") as out:
+        out.write(copy_manifest(files).encode('utf-8'))
+    annotate(rows_out=table.num_rows, files_written=1, bytes_written=files[0][1])
+    logging.info(f'Wrote {table.num_rows} rows to {dataset} without Spark')
+
+
+def with_key(table, source, key):
+    """
+    Table with a normalized join key column built from source appended
+
+    """
+    import pyarrow as pa
+
+    keys = [normalize_key(value) for value in table.column(source).to_pylist()]
+    return table.append_column(key, pa.array(keys, type=pa.string()))
+
+
+def read_csv(path, column_types, delimiter=','):
+    """
+    Read the typed columns of a CSV file, empty values as nulls
+
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+
+    fs, fs_path = filesystem(path)
+    with fs.open_input_stream(fs_path) as source:
+        return pa_csv.read_csv(
+            source,
+            parse_options=pa_csv.ParseOptions(delimiter=delimiter),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={name: getattr(pa, dtype)() for name, dtype in column_types.items()},
+                include_columns=list(column_types), strings_can_be_null=True))
+
+
+@traced('process_port_codes')
+def process_port_codes(processed_path):
+    """
+    Write port codes from the labels file with Arrow
+
+    Keyword arguments:
+    processed_path -- the output data location
+
+    """
+    import pyarrow as pa
+
+    codes, cities, states = code_mapping.port_columns(code_mapping.load_labels())
+    table = pa.table({
+        'port_code': pa.array(codes, type=pa.string()),
+        'port_city': pa.array(cities, type=pa.string()),
+        'port_state': pa.array(states, type=pa.string()),
+    })
+    write_dataset(with_key(table, 'port_city', 'city_key'), processed_path, 'port_codes')
+
+
+@traced('process_country_codes')
+def process_country_codes(processed_path):
+    """
+    Write country codes from the labels file with Arrow
+
+    Keyword arguments:
+    processed_path -- the output data location
+
+    """
+    import pyarrow as pa
+
+    countries = code_mapping.country_codes
+    table = pa.table({
+        'country_code': pa.array(list(countries), type=pa.string()),
+        'country': pa.array(list(countries.values()), type=pa.string()),
+    })
+    write_dataset(with_key(table, 'country', 'country_key'), processed_path, 'country_codes')
+
+
+@traced('process_airport_codes')
+def process_airport_codes(raw_path, processed_path):
+    """
+    Write airport codes with Arrow
+
+    Keyword arguments:
+    raw_path -- the input data location
+    processed_path -- the output data location
+
+    """
+    table = read_csv(f'{raw_path}/{AIRPORT_FILE}', AIRPORT_COLUMNS)
+    write_dataset(table.select(list(AIRPORT_COLUMNS)), processed_path, 'airport_codes')
+
+
+@traced('process_demographic')
+def process_demographic(raw_path, processed_path):
+    """
+    Write demographics with Arrow, column names normalized as the Spark path does
+
+    Keyword arguments:
+    raw_path -- the input data location
+    processed_path -- the output data location
+
+    """
+    table = read_csv(f'{raw_path}/{DEMOGRAPHIC_FILE}', DEMOGRAPHIC_COLUMNS, delimiter=';')
+    table = table.select(list(DEMOGRAPHIC_COLUMNS))
+    table = table.rename_columns([name.lower().replace(' ', '_').replace('-', '_') for name in table.column_names])
+    write_dataset(with_key(table, 'city', 'city_key'), processed_path, 'demographic')
+
+
+# dataset -> raw file checked against the size threshold, None for label tables
+REFERENCE_DATASETS = {
+    'port_codes': None,
+    'country_codes': None,
+    'airport_codes': AIRPORT_FILE,
+    'demographic': DEMOGRAPHIC_FILE,
+}
+
+
+def process_reference_data(dataset, raw_path, processed_path, get_spark, force=False):
+    """
+    Process a small reference dataset unless its input and code are unchanged
+
+    Keyword arguments:
+    dataset -- one of REFERENCE_DATASETS
+    raw_path -- the input data location
+    processed_path -- the output data location
+    get_spark -- callable returning a Spark session, only called for large inputs
+    force -- process even when nothing changed since the last run
+
+    """
+    raw_file = REFERENCE_DATASETS[dataset]
+    source = code_mapping.LABELS_PATH if raw_file is None else f'{raw_path}/{raw_file}'
+    return run_if_changed(dataset, [source], [f'manifests/{dataset}.manifest'], processed_path,
+                          lambda: write_reference_data(dataset, raw_path, processed_path, get_spark), force)
+
+
+def write_reference_data(dataset, raw_path, processed_path, get_spark):
+    """
+    Process a small reference dataset with Arrow, or with Spark above the size threshold
+
+    Keyword arguments:
+    dataset -- one of REFERENCE_DATASETS
+    raw_path -- the input data location
+    processed_path -- the output data location
+    get_spark -- callable returning a Spark session, only called for large inputs
+
+    """
+    raw_file = REFERENCE_DATASETS[dataset]
+    max_bytes = get_settings()['arrow_max_bytes']
+    if raw_file is not None and file_size(f'{raw_path}/{raw_file}') > max_bytes:
+        import preprocessing
+        logging.info(f'{dataset} input is over {max_bytes} bytes, processing with Spark')
+        spark_steps = {
+            'airport_codes': lambda spark: preprocessing.process_airport_codes(spark, raw_path, processed_path),
+            'demographic': lambda spark: preprocessing.process_demographic(spark, raw_path, processed_path),
+        }
+        return spark_steps[dataset](get_spark())
+
+    arrow_steps = {
+        'port_codes': lambda: process_port_codes(processed_path),
+        'country_codes': lambda: process_country_codes(processed_path),
+        'airport_codes': lambda: process_airport_codes(raw_path, processed_path),
+        'demographic': lambda: process_demographic(raw_path, processed_path),
+    }
+    return arrow_steps[dataset]()
@@ -0,0 +1,128 @@
+import logging
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from instrumentation import span
+
+logging.basicConfig(filename='staging.log', level=logging.DEBUG)
+logging.getLogger("py4j").setLevel(logging.ERROR)
+
+# A pipeline step: a callable taking no arguments and the steps it waits on
+Task = namedtuple('Task', ['func', 'deps'])
+
+# Timing of one finished step, in seconds since the run started
+NodeTiming = namedtuple('NodeTiming', ['name', 'start', 'end', 'status'])
+
+
+def validate_graph(graph):
+    """
+    Check every dependency exists and the graph has no cycles
+
+    Keyword arguments:
+    graph -- {name: Task}
+
+    """
+    for name, task in graph.items():
+        missing = [dep for dep in task.deps if dep not in graph]
+        if missing:
+            raise ValueError(f"Step {name} depends on unknown steps {missing}")
+
+    visiting, done = set(), set()
+
+    def visit(name, path):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f"Dependency cycle: {' -> '.join(path + [name])}")
+        visiting.add(name)
+        for dep in graph[name].deps:
+            visit(dep, path + [name])
+        visiting.remove(name)
+        done.add(name)
+
+    for name in graph:
+        visit(name, [])
+
+
+def run_graph(graph, max_workers=4):
+    """
+    Run pipeline steps concurrently as soon as their dependencies finish
+
+    When a step fails, no new steps are started, running steps are allowed
+    to finish and the first error is raised.
+
+    Keyword arguments:
+    graph -- {name: Task}
+    max_workers -- number of steps running at the same time
+
+    """
+    validate_graph(graph)
+
+    remaining = {name: set(task.deps) for name, task in graph.items()}
+    timings = {}
+    running = {}
+    errors = []
+    run_start = time.perf_counter()
+
+    def timed(name):
+        start = time.perf_counter() - run_start
+        logging.info(f'Starting step {name}')
+        with span(name, kind='step'):
+            graph[name].func()
+        return start
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while remaining or running:
+            if not errors:
+                ready = [name for name, deps in remaining.items() if not deps]
+                for name in ready:
+                    del remaining[name]
+                    running[executor.submit(timed, name)] = (name, time.perf_counter() - run_start)
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, submitted = running.pop(future)
+                end = time.perf_counter() - run_start
+                try:
+                    start = future.result()
+                except Exception as e:
+                    logging.error(f'Step {name} failed after {end - submitted:.1f}s: {e}')
+                    timings[name] = NodeTiming(name, submitted, end, 'failed')
+                    errors.append(e)
+                    continue
+                logging.info(f'Finished step {name} in {end - start:.1f}s')
+                timings[name] = NodeTiming(name, start, end, 'ok')
+                for deps in remaining.values():
+                    deps.discard(name)
+
+    log_timings(timings, time.perf_counter() - run_start, skipped=sorted(remaining))
+    if errors:
+        raise errors[0]
+    return timings
+
+
+def log_timings(timings, wall_time, skipped=()):
+    """
+    Log and print a per-step timing summary
+
+    Keyword arguments:
+    timings -- {name: NodeTiming}
+    wall_time -- total run time in seconds
+    skipped -- steps never started because an earlier step failed
+
+    """
+    lines = [f'{"step":<32} {"start":>8} {"end":>8} {"seconds":>8}  status']
+    for timing in sorted(timings.values(), key=lambda t: t.start):
+        lines.append(f'{timing.name:<32} {timing.start:>8.1f} {timing.end:>8.1f} '
+                     f'{timing.end - timing.start:>8.1f}  {timing.status}')
+    for name in skipped:
+        lines.append(f'{name:<32} {"":>8} {"":>8} {"":>8}  skipped')
+    total = sum(t.end - t.start for t in timings.values())
+    lines.append(f'Wall time {wall_time:.1f}s for {total:.1f}s of step time')
+
+    for line in lines:
+        logging.info(line)
+    print('\n'.join(lines))
@@ -0,0 +1,302 @@
+from collections import namedtuple
+
+# One column of a raw file, a processed dataset or a warehouse table.
+# type is a logical type from TYPES; sql overrides the SQL type it maps to
+Column = namedtuple('Column', ['name', 'type', 'sql', 'nullable'], defaults=(None, True))
+
+# A raw file or warehouse table; constraints and options are SQL appended
+# inside and after the column list
+Table = namedtuple('Table', ['name', 'columns', 'constraints', 'options'], defaults=((), ''))
+
+# logical type -> (Spark type class, SQL type, Arrow type factory)
+TYPES = {
+    'string': ('StringType', 'TEXT', 'string'),
+    'int': ('IntegerType', 'INT', 'int32'),
+    'bigint': ('LongType', 'BIGINT', 'int64'),
+    'double': ('DoubleType', 'DOUBLE PRECISION', 'float64'),
+    'date': ('DateType', 'DATE', 'date32'),
+    'timestamp': ('TimestampType', 'TIMESTAMP WITHOUT TIME ZONE', 'timestamp'),
+    'boolean': ('BooleanType', 'BOOLEAN', 'bool_'),
+}
+
+IDENTITY = 'BIGINT GENERATED ALWAYS AS IDENTITY'
+
+
+def varchar(name, length, nullable=True):
+    return Column(name, 'string', f'VARCHAR({length})', nullable)
+
+
+# RAW FILES
+
+RAW_FILES = {
+    'airport_codes': Table('airport-codes_csv.csv', [
+        Column('ident', 'string'), Column('type', 'string'), Column('name', 'string'),
+        Column('elevation_ft', 'int'), Column('continent', 'string'), Column('iso_country', 'string'),
+        Column('iso_region', 'string'), Column('municipality', 'string'), Column('gps_code', 'string'),
+        Column('iata_code', 'string'), Column('local_code', 'string'), Column('coordinates', 'string'),
+    ]),
+    'temperature': Table('GlobalLandTemperaturesByCity.csv', [
+        Column('dt', 'timestamp'), Column('AverageTemperature', 'double'),
+        Column('AverageTemperatureUncertainty', 'double'), Column('City', 'string'),
+        Column('Country', 'string'), Column('Latitude', 'string'), Column('Longitude', 'string'),
+    ]),
+    'demographic': Table('us-cities-demographics.csv', [
+        Column('City', 'string'), Column('State', 'string'), Column('Median Age', 'double'),
+        Column('Male Population', 'int'), Column('Female Population', 'int'),
+        Column('Total Population', 'int'), Column('Number of Veterans', 'int'),
+        Column('Foreign-born', 'int'), Column('Average Household Size', 'double'),
+        Column('State Code', 'string'), Column('Race', 'string'), Column('Count', 'int'),
+    ]),
+}
+
+
+# STAGING TABLES
+# Columns are in the order of the processed Parquet files, which COPY maps by position
+
+STAGING_TABLES = {
+    'staging_ports': Table('staging_ports', [
+        varchar('port_code', 3), varchar('city', 256), varchar('state', 50), varchar('city_key', 256),
+    ], options='DISTSTYLE ALL\nSORTKEY (city_key)'),
+    'staging_countries': Table('staging_countries', [
+        varchar('country_code', 3, False), varchar('country', 256, False), varchar('country_key', 256),
+    ], options='DISTSTYLE ALL\nSORTKEY (country_key)'),
+    'staging_airports': Table('staging_airports', [
+        varchar('ident', 256, False), varchar('type', 256, False), varchar('name', 256, False),
+        Column('elevation_ft', 'int'), varchar('iso_country', 256), varchar('municipality', 256),
+        varchar('gps_code', 256), varchar('local_code', 256), varchar('coordinates', 256),
+    ]),
+    'staging_temperatures': Table('staging_temperatures', [
+        Column('dt', 'timestamp'), Column('average_temperature', 'double'),
+        Column('average_temperature_uncertainty', 'double'), Column('city', 'string'),
+        Column('country', 'string'), Column('latitude', 'string'), Column('longitude', 'string'),
+        varchar('city_key', 256), varchar('country_key', 256),
+    ], options='DISTSTYLE ALL\nSORTKEY (city_key, country_key)'),
+    'staging_demographics': Table('staging_demographics', [
+        varchar('city', 256), varchar('state', 100), Column('median_age', 'double'),
+        Column('male_population', 'int'), Column('female_population', 'int'),
+        Column('total_population', 'int'), Column('number_of_veterans', 'int'),
+        Column('foreign_born', 'int'), Column('average_household_size', 'double'),
+        varchar('state_code', 50), varchar('race', 100), Column('count', 'int'), varchar('city_key', 256),
+    ], options='DISTSTYLE ALL\nSORTKEY (city_key, state_code)'),
+    # year, month and arrival_day are partition directories, not file columns
+    'staging_immigration': Table('staging_immigration', [
+        Column('cicid', 'double'), Column('origin_country_code', 'string'), Column('age', 'int'),
+        Column('arrival_date', 'date'), Column('departure_date', 'date'), Column('depdate', 'double'),
+        Column('arrdate', 'double'), Column('port_code', 'string'), Column('mode', 'string'),
+        Column('gender', 'string'), Column('visa_category', 'string'), Column('visatype', 'string'),
+    ]),
+    # Distinct (country, port) pairs of staging_immigration with their rows and departure range, per month
+    'staging_immigration_keys': Table('staging_immigration_keys', [
+        Column('year', 'int'), Column('month', 'int'), Column('origin_country_code', 'string'),
+        Column('port_code', 'string'), Column('row_count', 'bigint'), Column('min_depdate', 'double'),
+        Column('max_depdate', 'double'),
+    ], options='DISTSTYLE ALL'),
+}
+
+
+# processed dataset -> staging table it is copied into
+DATASETS = {
+    'port_codes': 'staging_ports',
+    'country_codes': 'staging_countries',
+    'airport_codes': 'staging_airports',
+    'temperature': 'staging_temperatures',
+    'demographic': 'staging_demographics',
+    'immigration_data': 'staging_immigration',
+    'immigration_keys': 'staging_immigration_keys',
+}
+
+# Processed datasets that are only read from S3, never staged
+OUTPUT_TABLES = {
+    # staging_immigration with its country, port and temperature lookups joined on
+    'immigration_enriched': Table('immigration_enriched', STAGING_TABLES['staging_immigration'].columns + [
+        Column('origin_country', 'string'), Column('country_average_temperature', 'double'),
+        Column('port_city', 'string'), Column('port_state', 'string'),
+        Column('port_average_temperature', 'double'),
+    ]),
+}
+
+
+# DIMENSION AND FACT TABLES
+
+WAREHOUSE_TABLES = {
+    'dim_countries': Table('dim_countries', [
+        Column('country_id', 'bigint', IDENTITY), varchar('country_code', 3, False),
+        varchar('country', 256, False), Column('average_temperature', 'double', 'NUMERIC(16,3)'),
+    ], ['UNIQUE (country_code)', 'UNIQUE (country)', 'PRIMARY KEY (country_id)']),
+    'dim_ports': Table('dim_ports', [
+        Column('port_id', 'bigint', IDENTITY), varchar('port_code', 3), varchar('port_city', 256),
+        varchar('port_state', 50), Column('average_temperature', 'double', 'NUMERIC(16,3)'),
+        varchar('city_key', 256),
+    ], ['UNIQUE (port_code)', 'PRIMARY KEY (port_id)']),
+    'dim_airports': Table('dim_airports', [
+        Column('airport_id', 'bigint', IDENTITY), Column('port_id', 'bigint'),
+        varchar('airport_type', 256), varchar('airport_name', 256), Column('elevation_ft', 'int'),
+        varchar('municipality', 256), varchar('gps_code', 256), varchar('iata_code', 256),
+        varchar('local_code', 256), varchar('coordinates', 256),
+    ], ['UNIQUE (port_id)', 'PRIMARY KEY (airport_id)',
+        'CONSTRAINT fk_port FOREIGN KEY (port_id) REFERENCES dim_ports (port_id)']),
+    'dim_demographics': Table('dim_demographics', [
+        Column('demographics_id', 'bigint', IDENTITY), Column('port_id', 'bigint'),
+        Column('median_age', 'double', 'NUMERIC(18,2)'), Column('male_population', 'int'),
+        Column('female_population', 'int'), Column('total_population', 'bigint'),
+        Column('number_of_veterans', 'int'), Column('foreign_born', 'int'),
+        Column('avg_household_size', 'double', 'NUMERIC(18,2)'), varchar('race', 100),
+        Column('demo_count', 'int'),
+    ], ['UNIQUE (port_id, race)', 'PRIMARY KEY (demographics_id)',
+        'CONSTRAINT fk_port FOREIGN KEY (port_id) REFERENCES dim_ports (port_id)']),
+    'dim_time': Table('dim_time', [
+        Column('sas_timestamp', 'int', nullable=False), Column('year', 'int', nullable=False),
+        Column('month', 'int', nullable=False), Column('day', 'int', nullable=False),
+        Column('week', 'int', nullable=False), Column('day_of_week', 'int', nullable=False),
+        Column('quarter', 'int', nullable=False), Column('iso_year', 'int', nullable=False),
+        Column('is_weekend', 'boolean', nullable=False), Column('is_holiday', 'boolean', nullable=False),
+        varchar('holiday', 64),
+    ], ['PRIMARY KEY (sas_timestamp)']),
+    'fact_immigration': Table('fact_immigration', [
+        Column('immigration_id', 'bigint', IDENTITY), Column('country_id', 'bigint'),
+        Column('port_id', 'bigint'), Column('age', 'int'), varchar('travel_mode', 100),
+        varchar('visa_category', 100), varchar('visa_type', 100), varchar('gender', 10),
+        Column('arrdate', 'int', nullable=False), Column('depdate', 'int'),
+        Column('year', 'int', nullable=False), Column('month', 'int', nullable=False),
+    ], ['PRIMARY KEY (immigration_id)',
+        'CONSTRAINT fk_port FOREIGN KEY (port_id) REFERENCES dim_ports (port_id)',
+        'CONSTRAINT fk_country FOREIGN KEY (country_id) REFERENCES dim_countries (country_id)',
+        'CONSTRAINT fk_arrdate FOREIGN KEY (arrdate) REFERENCES dim_time (sas_timestamp)',
+        'CONSTRAINT fk_depdate FOREIGN KEY (depdate) REFERENCES dim_time (sas_timestamp)']),
+    'agg_monthly_immigration': Table('agg_monthly_immigration', [
+        Column('year', 'int', nullable=False), Column('month', 'int', nullable=False),
+        Column('country_id', 'bigint'), Column('port_id', 'bigint'), Column('day_of_week', 'int'),
+        varchar('visa_category', 100), varchar('travel_mode', 100),
+        Column('immigrant_count', 'bigint', nullable=False),
+    ]),
+}
+
+
+def sql_type(column):
+    return column.sql or TYPES[column.type][1]
+
+
+def column_ddl(column):
+    return f"    {column.name} {sql_type(column)}{'' if column.nullable else ' NOT NULL'}"
+
+
+def table_ddl(table, if_not_exists=False):
+    """
+    CREATE TABLE statement for a registry table
+
+    Keyword arguments:
+    table -- Table from the registry
+    if_not_exists -- keep an existing table
+
+    """
+    lines = [column_ddl(column) for column in table.columns] + [f'    {c}' for c in table.constraints]
+    options = f'\n{table.options}' if table.options else ''
+    return (f"CREATE TABLE {'IF NOT EXISTS ' if if_not_exists else ''}public.{table.name} (\n"
+            + ',\n'.join(lines) + f'\n){options};\n')
+
+
+def create_ddl(table):
+    """
+    Statements dropping and recreating a registry table
+
+    """
+    return f"\nDROP TABLE IF EXISTS public.{table.name};\n" + table_ddl(table)
+
+
+def spark_schema(table):
+    """
+    Spark StructType of a registry table, for reading raw files without inferSchema
+
+    """
+    from pyspark.sql import types
+
+    return types.StructType([
+        types.StructField(column.name, getattr(types, TYPES[column.type][0])(), column.nullable)
+        for column in table.columns])
+
+
+def arrow_types(table, names=None):
+    """
+    Arrow type factory names by column, for typed CSV reads with pyarrow
+
+    Keyword arguments:
+    table -- Table from the registry
+    names -- columns to include, all by default
+
+    """
+    types = {column.name: TYPES[column.type][2] for column in table.columns}
+    return {name: types[name] for name in (names or types)}
+
+
+def logical_type(type_name):
+    """
+    Logical type of a Spark simpleString or Arrow type name, None when unknown
+
+    """
+    if type_name == 'large_string':
+        return 'string'
+    for logical, (_, _, arrow_name) in TYPES.items():
+        if type_name in (logical, arrow_name) or type_name.startswith(f'{arrow_name}['):
+            return logical
+    return None
+
+
+def mismatches(table, fields):
+    """
+    Differences between written columns and a registry table, compared by position
+
+    Names are only reported, not compared, because COPY maps Parquet
+    columns to table columns by position.
+
+    Keyword arguments:
+    table -- Table from the registry
+    fields -- (name, Spark or Arrow type name) pairs in file order
+
+    """
+    problems = []
+    if len(fields) != len(table.columns):
+        problems.append(f'{len(fields)} columns, {table.name} has {len(table.columns)}')
+    for position, ((name, type_name), column) in enumerate(zip(fields, table.columns), 1):
+        if logical_type(type_name) != column.type:
+            problems.append(f'column {position} {name} is {type_name}, {table.name}.{column.name} is {column.type}')
+    return problems
+
+
+def dataset_table(dataset):
+    """
+    Registry table the files of a processed dataset must match
+
+    """
+    if dataset in OUTPUT_TABLES:
+        return OUTPUT_TABLES[dataset]
+    return STAGING_TABLES[DATASETS[dataset]]
+
+
+def check_dataframe(df, dataset):
+    """
+    Raise if a DataFrame about to be written does not match its registry table
+
+    Keyword arguments:
+    df -- DataFrame holding the file columns only, in file order
+    dataset -- processed dataset name in DATASETS or OUTPUT_TABLES
+
+    """
+    problems = mismatches(dataset_table(dataset),
+                          [(field.name, field.dataType.simpleString()) for field in df.schema.fields])
+    if problems:
+        raise ValueError(f'Output for {dataset} does not match the schema registry: ' + '; '.join(problems))
+
+
+def check_arrow(schema, dataset, path):
+    """
+    Raise if an Arrow schema, e.g. from a Parquet footer, does not match its registry table
+
+    Keyword arguments:
+    schema -- Arrow schema
+    dataset -- processed dataset name in DATASETS or OUTPUT_TABLES
+    path -- file location, for the error message
+
+    """
+    problems = mismatches(dataset_table(dataset), [(field.name, str(field.type)) for field in schema])
+    if problems:
+        raise ValueError(f'{path} does not match the schema registry: ' + '; '.join(problems))
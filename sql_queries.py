@@ -1,357 +1,557 @@
 import configparser
 
+from schemas import STAGING_TABLES, WAREHOUSE_TABLES, create_ddl, table_ddl
+
 # CONFIG
-config = configparser.ConfigParser()
-config.read('dl.cfg')
-IAM_ROLE = config.get('IAM_ROLE', 'ARN')
-AIRPORT_DATA = config.get('S3', 'AIRPORT_PATH')
-DEMO_DATA = config.get('S3', 'DEMO_PATH')
-PORT_DATA = config.get('S3', 'PORT_PATH')
-COUNTRY_DATA = config.get('S3', 'COUNTRY_PATH')
-TEMPERATURE_DATA = config.get('S3', 'TEMPERATURE_PATH')
-IMMIGRATION_DATA = config.get('S3', 'IMMIGRATION_PATH')
+# dl.cfg is only read when one of these values or a COPY query is first used
+CONFIG_VALUES = {
+    'IAM_ROLE': ('IAM_ROLE', 'ARN'),
+    'AIRPORT_DATA': ('S3', 'AIRPORT_PATH'),
+    'DEMO_DATA': ('S3', 'DEMO_PATH'),
+    'PORT_DATA': ('S3', 'PORT_PATH'),
+    'COUNTRY_DATA': ('S3', 'COUNTRY_PATH'),
+    'TEMPERATURE_DATA': ('S3', 'TEMPERATURE_PATH'),
+    'IMMIGRATION_DATA': ('S3', 'IMMIGRATION_PATH'),
+    'IMMIGRATION_KEYS_DATA': ('S3', 'IMMIGRATION_KEYS_PATH'),
+    'MANIFEST_DATA': ('S3', 'MANIFEST_PATH'),
+}
+
+_config = None
+
+
+def read_config():
+    """
+    Read dl.cfg once per process
+
+    """
+    global _config
+    if _config is None:
+        _config = configparser.ConfigParser()
+        _config.read('dl.cfg')
+    return _config
 
 
 # CREATE STAGING TABLES
 
-create_staging_port_table = ("""
-DROP TABLE IF EXISTS public.staging_ports;
-CREATE TABLE IF NOT EXISTS public.staging_ports (
-    port_code varchar(3),
-    city varchar(256),
-    state varchar(50)
-);
-""")
-
-create_staging_country_table = ("""
-DROP TABLE IF EXISTS public.staging_countries;
-CREATE TABLE public.staging_countries (
-    country_code varchar(3) NOT NULL,
-    country varchar(256) NOT NULL
-    );
-""")
-
-create_staging_airport_table = ("""
-DROP TABLE IF EXISTS public.staging_airports;
-    CREATE TABLE public.staging_airports (
-    ident VARCHAR(256) NOT NULL, 
-    type VARCHAR(256) NOT NULL, 
-    name VARCHAR(256) NOT NULL, 
-    elevation_ft INTEGER, 
-    iso_country VARCHAR(256), 
-    municipality VARCHAR(256), 
-    gps_code VARCHAR(256), 
-    local_code VARCHAR(256), 
-    coordinates varchar(256)
-    );
-""")
-
-create_staging_temperature_table = ("""
-DROP TABLE IF EXISTS public.staging_temperatures;
-CREATE TABLE public.staging_temperatures (
-    dt TIMESTAMP WITHOUT TIME ZONE,
-    average_temperature DOUBLE PRECISION,
-    average_temperature_uncertainty DOUBLE PRECISION,
-    city TEXT,
-    country TEXT,
-    latitude TEXT,
-    longitude TEXT
-    );
-""")
-
-create_staging_demographic_table = ("""
-DROP TABLE IF EXISTS public.staging_demographics;
-CREATE TABLE public.staging_demographics (
-    city VARCHAR(256),
-    state VARCHAR(100),
-    median_age DOUBLE PRECISION,
-    male_population INT,
-    female_population INT,
-    total_population INT,
-    number_of_veterans INT,
-    foreign_born INT,
-    average_household_size DOUBLE PRECISION,
-    state_code VARCHAR(50),
-    race VARCHAR(100),
-    count INT
-    );
-""")
-
-create_staging_immigration_table = ("""
-DROP TABLE IF EXISTS public.staging_immigration;
-CREATE TABLE public.staging_immigration (
-    cicid DOUBLE PRECISION,
-    origin_country_code TEXT,
-    age DOUBLE PRECISION,
-    arrival_date DATE,
-    departure_date DATE,
-    depdate DOUBLE PRECISION,
-    arrdate DOUBLE PRECISION,
-    port_code TEXT,
-    mode TEXT,
-    gender TEXT, 
-    visa_category TEXT, 
-    visatype TEXT
-    )
-""")
+# Generated from the schema registry, columns in processed Parquet order
+create_staging_port_table = create_ddl(STAGING_TABLES['staging_ports'])
+create_staging_country_table = create_ddl(STAGING_TABLES['staging_countries'])
+create_staging_airport_table = create_ddl(STAGING_TABLES['staging_airports'])
+create_staging_temperature_table = create_ddl(STAGING_TABLES['staging_temperatures'])
+create_staging_demographic_table = create_ddl(STAGING_TABLES['staging_demographics'])
+create_staging_immigration_table = create_ddl(STAGING_TABLES['staging_immigration'])
+create_staging_immigration_keys_table = create_ddl(STAGING_TABLES['staging_immigration_keys'])
 
 # STAGING TABLES
 
-staging_airport_copy = ("""
-    COPY staging_airports 
-    FROM {} 
-    IAM_ROLE '{}'
-    FORMAT AS PARQUET;
-""").format(AIRPORT_DATA, IAM_ROLE)
-
-
-staging_demographic_copy = ("""
-    COPY staging_demographics 
+staging_copy = ("""
+    COPY {} 
     FROM {} 
     IAM_ROLE '{}'
     FORMAT AS PARQUET;
-""").format(DEMO_DATA, IAM_ROLE)
-
+""")
 
-staging_port_codes_copy = ("""
-    COPY staging_ports 
-    FROM {} 
+staging_manifest_copy = ("""
+    COPY {} 
+    FROM '{}{}.manifest' 
     IAM_ROLE '{}'
-    FORMAT AS PARQUET;
-""").format(PORT_DATA, IAM_ROLE)
-
+    FORMAT AS PARQUET
+    MANIFEST;
+""")
 
-staging_country_codes_copy = ("""
-    COPY staging_countries 
-    FROM {} 
+staging_written_manifest_copy = ("""
+    COPY {} 
+    FROM '{}{}.written.manifest' 
     IAM_ROLE '{}'
-    FORMAT AS PARQUET;
-""").format(COUNTRY_DATA, IAM_ROLE)
+    FORMAT AS PARQUET
+    MANIFEST;
+""")
 
+# COPY query name -> (staging table, S3 location config value, processed dataset)
+# each also has a <name>_manifest variant reading only the files in the
+# dataset's manifest
+STAGING_COPIES = {
+    'staging_airport_copy': ('staging_airports', 'AIRPORT_DATA', 'airport_codes'),
+    'staging_demographic_copy': ('staging_demographics', 'DEMO_DATA', 'demographic'),
+    'staging_port_codes_copy': ('staging_ports', 'PORT_DATA', 'port_codes'),
+    'staging_country_codes_copy': ('staging_countries', 'COUNTRY_DATA', 'country_codes'),
+    'staging_temperature_copy': ('staging_temperatures', 'TEMPERATURE_DATA', 'temperature'),
+    'staging_immigration_copy': ('staging_immigration', 'IMMIGRATION_DATA', 'immigration_data'),
+    'staging_immigration_keys_copy': ('staging_immigration_keys', 'IMMIGRATION_KEYS_DATA', 'immigration_keys'),
+}
+
+# Datasets whose <dataset>.manifest lists every processed month, with a
+# <dataset>.written.manifest of only the months the last run wrote. Only
+# incremental loads copy from the written manifest, through the
+# <name>_written_manifest COPY variant
+WRITTEN_MANIFEST_DATASETS = ['immigration_data', 'immigration_keys']
+
+
+def manifest_name(dataset, incremental=False):
+    """
+    Manifest file name, without .manifest, a dataset is staged from
+
+    Keyword arguments:
+    dataset -- processed dataset name
+    incremental -- the load only replaces the months written by the last run
+
+    """
+    if incremental and dataset in WRITTEN_MANIFEST_DATASETS:
+        return f'{dataset}.written'
+    return dataset
+
+
+def copy_query_name(copy_name, use_manifests=True, incremental=False):
+    """
+    Name of the COPY query variant staging a dataset
+
+    Keyword arguments:
+    copy_name -- COPY query name in STAGING_COPIES
+    use_manifests -- copy only the files listed in a manifest
+    incremental -- the load only replaces the months written by the last run
+
+    """
+    if not use_manifests:
+        return copy_name
+    _, _, dataset = STAGING_COPIES[copy_name]
+    return copy_name + ('_written_manifest' if manifest_name(dataset, incremental) != dataset else '_manifest')
+
+
+def __getattr__(name):
+    """
+    Resolve config values and COPY queries on first access
+
+    """
+    if name in CONFIG_VALUES:
+        section, key = CONFIG_VALUES[name]
+        return read_config().get(section, key)
+    if name in STAGING_COPIES:
+        table, location, _ = STAGING_COPIES[name]
+        return staging_copy.format(table, __getattr__(location), __getattr__('IAM_ROLE'))
+    if name.endswith('_written_manifest') and name[:-len('_written_manifest')] in STAGING_COPIES:
+        table, _, dataset = STAGING_COPIES[name[:-len('_written_manifest')]]
+        return staging_written_manifest_copy.format(table, __getattr__('MANIFEST_DATA'), dataset, __getattr__('IAM_ROLE'))
+    if name.endswith('_manifest') and name[:-len('_manifest')] in STAGING_COPIES:
+        table, _, dataset = STAGING_COPIES[name[:-len('_manifest')]]
+        return staging_manifest_copy.format(table, __getattr__('MANIFEST_DATA'), dataset, __getattr__('IAM_ROLE'))
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Staging load times and row counts, one row per COPY
+ensure_staging_load_table = """
+CREATE TABLE IF NOT EXISTS public.etl_staging_loads (
+    table_name varchar(64) NOT NULL,
+    rows_loaded bigint,
+    seconds DOUBLE PRECISION,
+    loaded_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+);
+"""
 
-staging_temperature_copy = ("""
-    COPY staging_temperatures
-    FROM {} 
-    IAM_ROLE '{}'
-    FORMAT AS PARQUET;
-""").format(TEMPERATURE_DATA, IAM_ROLE)
+record_staging_load = """
+INSERT INTO public.etl_staging_loads (table_name, rows_loaded, seconds, loaded_at)
+VALUES (%(table_name)s, %(rows_loaded)s, %(seconds)s, %(loaded_at)s)
+"""
 
+# Column types of a staging table in column order, used by local bulk loads
+staging_column_types = """
+SELECT column_name, data_type FROM information_schema.columns
+WHERE table_schema = 'public' AND table_name = %(table_name)s
+ORDER BY ordinal_position
+"""
 
-staging_immigration_copy = ("""
-    COPY staging_immigration 
-    FROM {} 
-    IAM_ROLE '{}'
-    FORMAT AS PARQUET;
-""").format(IMMIGRATION_DATA, IAM_ROLE)
+# Rows loaded by the last COPY in this session
+last_copy_count = """
+SELECT pg_last_copy_count()
+"""
 
 
 # Create Countries Table
+ensure_countries_table = table_ddl(WAREHOUSE_TABLES['dim_countries'], if_not_exists=True)
+
 create_countries_table = """
 DROP TABLE IF EXISTS public.dim_countries CASCADE;
-CREATE TABLE public.dim_countries (
-    country_id bigint GENERATED ALWAYS AS IDENTITY,
-    country_code varchar(3) NOT NULL UNIQUE,
-    country varchar(256) NOT NULL UNIQUE,
-    average_temperature NUMERIC(16,3) NULL,
-    PRIMARY KEY(country_id)
-);
+""" + ensure_countries_table
+
+# Countries seen in staging immigration data, one row per country code
+# The staged key set stands in for staging_immigration, so this never scans it
+countries_source = """
+SELECT c.country_code, c.country, AVG(t.average_temperature) AS average_temperature
+FROM public.staging_countries c
+LEFT JOIN public.staging_temperatures t ON c.country_key = t.country_key
+WHERE EXISTS (SELECT 1 FROM public.staging_immigration_keys k
+WHERE k.origin_country_code = c.country_code)
+GROUP BY c.country_code, c.country
 """
 
 # Extract countries from staging immigration data
 extract_countries = """
 INSERT INTO public.dim_countries (country_code, country, average_temperature)
-SELECT DISTINCT c.country_code, c.country, t.average_temperature
-FROM public.staging_immigration i
-INNER JOIN public.staging_countries c ON i.origin_country_code = c.country_code
-LEFT JOIN public.staging_temperatures t ON UPPER(c.country) = UPPER(t.country)
-ORDER BY c.country
-"""
+SELECT s.country_code, s.country, s.average_temperature
+FROM ({}) s
+ORDER BY s.country
+""".format(countries_source)
+
+# Upsert countries by country code
+upsert_countries = """
+UPDATE public.dim_countries
+SET country = s.country, average_temperature = s.average_temperature
+FROM ({0}) s
+WHERE public.dim_countries.country_code = s.country_code;
+
+INSERT INTO public.dim_countries (country_code, country, average_temperature)
+SELECT s.country_code, s.country, s.average_temperature
+FROM ({0}) s
+WHERE NOT EXISTS (SELECT 1 FROM public.dim_countries d WHERE d.country_code = s.country_code)
+ORDER BY s.country;
+""".format(countries_source)
 
 
 # Create Ports Dimension Table
+ensure_ports_table = table_ddl(WAREHOUSE_TABLES['dim_ports'], if_not_exists=True)
+
 create_ports_table = """
 DROP TABLE IF EXISTS public.dim_ports CASCADE;
-CREATE TABLE public.dim_ports (
-    port_id BIGINT GENERATED ALWAYS AS IDENTITY,
-    port_code VARCHAR(3) UNIQUE,
-    port_city VARCHAR(256),
-    port_state VARCHAR(50),
-    average_temperature NUMERIC(16,3) NULL,
-    PRIMARY KEY(port_id)
-);
+""" + ensure_ports_table
+
+# Ports seen in staging immigration data, one row per port code
+ports_source = """
+SELECT p.port_code, p.city, p.state, p.city_key, AVG(t.average_temperature) AS average_temperature
+FROM public.staging_ports p
+LEFT JOIN public.staging_temperatures t ON p.city_key = t.city_key
+WHERE EXISTS (SELECT 1 FROM public.staging_immigration_keys k
+WHERE k.port_code = p.port_code)
+GROUP BY p.port_code, p.city, p.state, p.city_key
 """
 
-
 # Extract ports from staging immigration data
 extract_ports = """
-INSERT INTO public.dim_ports (port_code, port_city, port_state, average_temperature)
-SELECT DISTINCT p.port_code, p.city, p.state, t.average_temperature
-FROM public.staging_immigration i
-INNER JOIN public.staging_ports p ON i.port_code = p.port_code
-LEFT JOIN public.staging_temperatures t ON UPPER(p.city) = UPPER(t.city)
-ORDER BY p.port_code
-"""
+INSERT INTO public.dim_ports (port_code, port_city, port_state, average_temperature, city_key)
+SELECT s.port_code, s.city, s.state, s.average_temperature, s.city_key
+FROM ({}) s
+ORDER BY s.port_code
+""".format(ports_source)
+
+# Upsert ports by port code
+upsert_ports = """
+UPDATE public.dim_ports
+SET port_city = s.city, port_state = s.state, average_temperature = s.average_temperature,
+city_key = s.city_key
+FROM ({0}) s
+WHERE public.dim_ports.port_code = s.port_code;
+
+INSERT INTO public.dim_ports (port_code, port_city, port_state, average_temperature, city_key)
+SELECT s.port_code, s.city, s.state, s.average_temperature, s.city_key
+FROM ({0}) s
+WHERE NOT EXISTS (SELECT 1 FROM public.dim_ports d WHERE d.port_code = s.port_code)
+ORDER BY s.port_code;
+""".format(ports_source)
 
 
 # Create Airports Dimension Table
+ensure_airports_table = table_ddl(WAREHOUSE_TABLES['dim_airports'], if_not_exists=True)
+
 create_airports_table = """
 DROP TABLE IF EXISTS public.dim_airports CASCADE;
-CREATE TABLE public.dim_airports (
-    airport_id BIGINT GENERATED ALWAYS AS IDENTITY,
-    port_id BIGINT UNIQUE,
-    airport_type VARCHAR(256),
-    airport_name VARCHAR(256),
-    elevation_ft INT,
-    municipality VARCHAR(256),
-    gps_code VARCHAR(256),
-    iata_code VARCHAR(256),
-    local_code VARCHAR(256),
-    coordinates VARCHAR(256),
-PRIMARY KEY(airport_id),
-CONSTRAINT fk_port
-FOREIGN KEY(port_id) REFERENCES dim_ports(port_id)
-);
-"""
-
+""" + ensure_airports_table
 
-# Extract airports data from staging airports 
-extract_airports = """
-INSERT INTO public.dim_airports (port_id, airport_type, airport_name, elevation_ft, municipality, gps_code, local_code, coordinates)
-SELECT p.port_id, a.type, a.name, a.elevation_ft, a.municipality,
+airports_source = """
+SELECT p.port_id, p.port_code, a.type, a.name, a.elevation_ft, a.municipality,
 a.gps_code, a.local_code, a.coordinates
 FROM public.staging_airports a
 INNER JOIN public.dim_ports p ON a.ident = p.port_code
-ORDER BY p.port_code
 """
 
+# Extract airports data from staging airports 
+extract_airports = """
+INSERT INTO public.dim_airports (port_id, airport_type, airport_name, elevation_ft, municipality, gps_code, local_code, coordinates)
+SELECT s.port_id, s.type, s.name, s.elevation_ft, s.municipality,
+s.gps_code, s.local_code, s.coordinates
+FROM ({}) s
+ORDER BY s.port_code
+""".format(airports_source)
+
+# Upsert airports by port
+upsert_airports = """
+UPDATE public.dim_airports
+SET airport_type = s.type, airport_name = s.name, elevation_ft = s.elevation_ft,
+municipality = s.municipality, gps_code = s.gps_code, local_code = s.local_code,
+coordinates = s.coordinates
+FROM ({0}) s
+WHERE public.dim_airports.port_id = s.port_id;
+
+INSERT INTO public.dim_airports (port_id, airport_type, airport_name, elevation_ft, municipality, gps_code, local_code, coordinates)
+SELECT s.port_id, s.type, s.name, s.elevation_ft, s.municipality,
+s.gps_code, s.local_code, s.coordinates
+FROM ({0}) s
+WHERE NOT EXISTS (SELECT 1 FROM public.dim_airports d WHERE d.port_id = s.port_id)
+ORDER BY s.port_code;
+""".format(airports_source)
+
 
 # Create demographics dimension table
+ensure_demographics_table = table_ddl(WAREHOUSE_TABLES['dim_demographics'], if_not_exists=True)
+
 create_demographics_table = """
 DROP TABLE IF EXISTS public.dim_demographics CASCADE;
-CREATE TABLE public.dim_demographics (
-    demographics_id BIGINT GENERATED ALWAYS AS IDENTITY,
-    port_id BIGINT,
-    median_age numeric(18,2),
-    male_population int,
-    female_population int,
-    total_population bigint,
-    number_of_veterans int,
-    foreign_born int,
-    avg_household_size numeric(18,2),
-    race varchar(100),
-    demo_count int,
-UNIQUE (port_id, race),
-PRIMARY KEY(demographics_id),
-CONSTRAINT fk_port
-FOREIGN KEY(port_id) REFERENCES dim_ports(port_id)
-);
-"""
+""" + ensure_demographics_table
 
-# Extract demographics from staging data
-extract_demographics = """
-INSERT INTO public.dim_demographics (port_id, median_age, male_population, female_population, total_population, number_of_veterans,foreign_born,avg_household_size, race, demo_count)
+demographics_source = """
 SELECT DISTINCT p.port_id, d.median_age, d.male_population, d.female_population, d.total_population,
 d.number_of_veterans, d.foreign_born, d.average_household_size, d.race, d.count
 FROM public.dim_ports p
 INNER JOIN public.staging_demographics d 
-ON UPPER(p.port_city) = UPPER(d.city) AND UPPER(p.port_state) = UPPER(d.state_code)
-WHERE EXISTS (SELECT port_code FROM public.staging_immigration i 
-WHERE p.port_code = i.port_code)
+ON p.city_key = d.city_key AND p.port_state = d.state_code
+WHERE EXISTS (SELECT 1 FROM public.staging_immigration_keys k
+WHERE k.port_code = p.port_code)
 """
 
+# Extract demographics from staging data
+extract_demographics = """
+INSERT INTO public.dim_demographics (port_id, median_age, male_population, female_population, total_population, number_of_veterans,foreign_born,avg_household_size, race, demo_count)
+{}
+""".format(demographics_source)
+
+# Upsert demographics by port and race
+upsert_demographics = """
+UPDATE public.dim_demographics
+SET median_age = s.median_age, male_population = s.male_population,
+female_population = s.female_population, total_population = s.total_population,
+number_of_veterans = s.number_of_veterans, foreign_born = s.foreign_born,
+avg_household_size = s.average_household_size, demo_count = s.count
+FROM ({0}) s
+WHERE public.dim_demographics.port_id = s.port_id AND public.dim_demographics.race = s.race;
+
+INSERT INTO public.dim_demographics (port_id, median_age, male_population, female_population, total_population, number_of_veterans,foreign_born,avg_household_size, race, demo_count)
+SELECT s.port_id, s.median_age, s.male_population, s.female_population, s.total_population,
+s.number_of_veterans, s.foreign_born, s.average_household_size, s.race, s.count
+FROM ({0}) s
+WHERE NOT EXISTS (SELECT 1 FROM public.dim_demographics d
+WHERE d.port_id = s.port_id AND d.race = s.race);
+""".format(demographics_source)
+
 
  # Create time dimension table
-create_time_table = """
-DROP TABLE IF EXISTS public.dim_time CASCADE;
-CREATE TABLE public.dim_time (
-sas_timestamp INT NOT NULL UNIQUE,
-year INT NOT NULL,
-month INT NOT NULL,
-day INT NOT NULL,
-week INT NOT NULL,
-day_of_week INT NOT NULL,
-quarter INT NOT NULL,
-PRIMARY KEY (sas_timestamp)
-);
+ensure_time_table = table_ddl(WAREHOUSE_TABLES['dim_time'], if_not_exists=True)
+
+time_columns = ', '.join(column.name for column in WAREHOUSE_TABLES['dim_time'].columns)
+
+# Staged arrival years and departure SAS days, whose calendar years dim_time covers.
+# Read from the key set, so staging_immigration is not scanned
+staged_day_range = """
+SELECT MIN(year), MAX(year), CAST(MIN(min_depdate) AS INT), CAST(MAX(max_depdate) AS INT)
+FROM public.staging_immigration_keys
+"""
+
+# Days in a range with every calendar attribute set
+complete_time_day_count = """
+SELECT COUNT(*) FROM public.dim_time
+WHERE sas_timestamp BETWEEN %(first_day)s AND %(last_day)s AND is_holiday IS NOT NULL
 """
 
-# Extract time dimension data from staging immigration arrival and departure dates
-extract_time_data = """
-INSERT INTO public.dim_time (sas_timestamp, year, month, day, quarter, week, day_of_week)
-SELECT ts, 
-    date_part('year', t1.sas_date) as year,
-    date_part('month', t1.sas_date) as month,
-    date_part('day', t1.sas_date) as day, 
-    date_part('quarter', t1.sas_date) as quarter,
-    date_part('week', t1.sas_date) as week,
-    date_part('dow', t1.sas_date) as day_of_week
-FROM
-(SELECT DISTINCT arrdate as ts, TIMESTAMP '1960-01-01 00:00:00 +00:00' + (arrdate * INTERVAL '1 day') as sas_date
-FROM staging_immigration
-UNION
-SELECT DISTINCT depdate as ts, TIMESTAMP '1960-01-01 00:00:00 +00:00' + (depdate * INTERVAL '1 day') as sas_date
-FROM staging_immigration
-WHERE depdate IS NOT NULL
-) t1
+complete_time_days = """
+SELECT sas_timestamp FROM public.dim_time
+WHERE sas_timestamp BETWEEN %(first_day)s AND %(last_day)s AND is_holiday IS NOT NULL
 """
 
+# Session table holding generated calendar days until they are upserted
+create_time_load_table = """
+DROP TABLE IF EXISTS dim_time_load;
+CREATE TEMP TABLE dim_time_load (LIKE public.dim_time);
+"""
+
+insert_time_load = """
+INSERT INTO dim_time_load ({}) VALUES %s
+""".format(time_columns)
+
+# Upsert generated days by SAS day
+upsert_time_load = """
+UPDATE public.dim_time
+SET {updates}
+FROM dim_time_load s
+WHERE public.dim_time.sas_timestamp = s.sas_timestamp;
+
+INSERT INTO public.dim_time ({columns})
+SELECT {source_columns} FROM dim_time_load s
+WHERE NOT EXISTS (SELECT 1 FROM public.dim_time d WHERE d.sas_timestamp = s.sas_timestamp);
+
+DROP TABLE dim_time_load;
+""".format(
+    updates=', '.join(f'{column.name} = s.{column.name}' for column in WAREHOUSE_TABLES['dim_time'].columns[1:]),
+    columns=time_columns,
+    source_columns=', '.join(f's.{column.name}' for column in WAREHOUSE_TABLES['dim_time'].columns))
+
 # Create fact immigration table
+ensure_fact_immigration_table = table_ddl(WAREHOUSE_TABLES['fact_immigration'], if_not_exists=True)
+
 create_fact_immigration_table = """
 DROP TABLE IF EXISTS public.fact_immigration CASCADE;
-CREATE TABLE public.fact_immigration (
-    immigration_id BIGINT GENERATED ALWAYS AS IDENTITY,
-    country_id BIGINT,
-    port_id BIGINT,
-    age int,
-    travel_mode varchar(100),
-    visa_category varchar(100),
-    visa_type varchar(100),
-    gender varchar(10),
-    arrdate int NOT NULL,
-    depdate int NULL,
-PRIMARY KEY (immigration_id),
-CONSTRAINT fk_port FOREIGN KEY(port_id) REFERENCES dim_ports(port_id),
-CONSTRAINT fk_country FOREIGN KEY(country_id) REFERENCES dim_countries(country_id),
-CONSTRAINT fk_arrdate FOREIGN KEY(arrdate) REFERENCES dim_time(sas_timestamp),
-CONSTRAINT fk_depdate FOREIGN KEY(depdate) REFERENCES dim_time(sas_timestamp)
-);
+""" + ensure_fact_immigration_table
+
+# Fill the partition columns of fact rows loaded before they existed,
+# from the arrival date as the fact load does
+backfill_fact_partitions = """
+UPDATE public.fact_immigration
+SET year = t.year, month = t.month
+FROM public.dim_time t
+WHERE public.fact_immigration.arrdate = t.sas_timestamp AND public.fact_immigration.year IS NULL
 """
 
 # Extract immigration data from staging to fact table
 extract_immigration_data = """
-INSERT INTO public.fact_immigration (country_id, port_id, age, travel_mode, visa_category, visa_type, gender, arrdate,depdate)
-SELECT c.country_id, p.port_id, i.age, i.mode, i.visa_category, i.visatype, i.gender, i.arrdate, i.depdate
+INSERT INTO public.fact_immigration (country_id, port_id, age, travel_mode, visa_category, visa_type, gender, arrdate, depdate, year, month)
+SELECT c.country_id, p.port_id, i.age, i.mode, i.visa_category, i.visatype, i.gender, i.arrdate, i.depdate,
+date_part('year', i.arrival_date), date_part('month', i.arrival_date)
 FROM public.staging_immigration i
 INNER JOIN public.dim_countries c ON i.origin_country_code = c.country_code
 INNER JOIN public.dim_ports p ON i.port_code = p.port_code
 """
 
+# Staged immigration rows per arrival day, used to plan fact load chunks
+staged_immigration_days = """
+SELECT CAST(arrdate AS INT) AS arrdate,
+CAST(date_part('year', arrival_date) AS INT) AS year,
+CAST(date_part('month', arrival_date) AS INT) AS month,
+COUNT(*) AS row_count
+FROM public.staging_immigration
+WHERE arrdate IS NOT NULL AND arrival_date IS NOT NULL
+GROUP BY 1, 2, 3
+ORDER BY 1
+"""
 
-# Staging count data quality check
-# Ensure items are in staging table
-staging_count_data_quality_check = """
-SELECT COUNT(*) FROM staging_immigration
+# Remove one (year, month) partition from the fact table
+delete_immigration_partition = """
+DELETE FROM public.fact_immigration
+WHERE year = %(year)s AND month = %(month)s
 """
 
-# Staging to fact table data quality check
-# Ensures that qualifying staging items make it to fact table
-staging_to_fact_data_quality_check = """
-SELECT s.stagingCount - f.factCount FROM
-(SELECT COUNT(i.*) as stagingCount
-FROM public.staging_immigration i
-INNER JOIN public.dim_countries c ON i.origin_country_code = c.country_code
-INNER JOIN public.dim_ports p ON i.port_code = p.port_code) s
-CROSS JOIN (SELECT COUNT(*) as factCount FROM fact_immigration i INNER JOIN dim_time t ON i.arrdate = t.sas_timestamp 
-WHERE t.year = 2016) f
+# Load one range of arrival days from staging into the fact table
+extract_immigration_chunk = extract_immigration_data + """
+WHERE i.arrdate BETWEEN %(chunk_start)s AND %(chunk_end)s
+"""
+
+
+# Finished fact load chunks, so an interrupted load can resume
+ensure_fact_chunk_table = """
+CREATE TABLE IF NOT EXISTS public.etl_fact_chunks (
+    year int NOT NULL,
+    month int NOT NULL,
+    chunk_start int NOT NULL,
+    chunk_end int NOT NULL,
+    rows_loaded bigint,
+    loaded_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+PRIMARY KEY (chunk_start, chunk_end)
+);
+"""
+
+finished_fact_chunks = """
+SELECT year, month, chunk_start, chunk_end, rows_loaded
+FROM public.etl_fact_chunks
+"""
+
+record_fact_chunk = """
+INSERT INTO public.etl_fact_chunks (year, month, chunk_start, chunk_end, rows_loaded, loaded_at)
+VALUES (%(year)s, %(month)s, %(chunk_start)s, %(chunk_end)s, %(rows_loaded)s, %(loaded_at)s)
+"""
+
+clear_fact_chunks = """
+DELETE FROM public.etl_fact_chunks
+WHERE year = %(year)s AND month = %(month)s
+"""
+
+
+# Monthly immigration rollup for reporting
+ensure_monthly_rollup_table = table_ddl(WAREHOUSE_TABLES['agg_monthly_immigration'], if_not_exists=True)
+
+create_monthly_rollup_table = """
+DROP TABLE IF EXISTS public.agg_monthly_immigration;
+""" + ensure_monthly_rollup_table
+
+# Rebuild the rollup rows of one (year, month) partition
+refresh_monthly_rollup = """
+DELETE FROM public.agg_monthly_immigration
+WHERE year = %(year)s AND month = %(month)s;
+
+INSERT INTO public.agg_monthly_immigration (year, month, country_id, port_id, day_of_week, visa_category, travel_mode, immigrant_count)
+SELECT i.year, i.month, i.country_id, i.port_id, t.day_of_week, i.visa_category, i.travel_mode, COUNT(*)
+FROM public.fact_immigration i
+INNER JOIN public.dim_time t ON i.arrdate = t.sas_timestamp
+WHERE i.year = %(year)s AND i.month = %(month)s
+GROUP BY i.year, i.month, i.country_id, i.port_id, t.day_of_week, i.visa_category, i.travel_mode;
+"""
+
+
+
+# Warehouse load version, one row replaced after each extract so query
+# caches in every process can tell their results are stale
+ensure_load_version_table = """
+CREATE TABLE IF NOT EXISTS public.etl_load_version (
+    version varchar(32) NOT NULL,
+    bumped_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+);
+"""
+
+publish_load_version = """
+DELETE FROM public.etl_load_version;
+INSERT INTO public.etl_load_version (version, bumped_at) VALUES (%(version)s, %(bumped_at)s);
+"""
+
+current_load_version = """
+SELECT version FROM public.etl_load_version
+"""
+
+# Load watermarks, one row per table and (year, month) partition
+ensure_watermark_table = """
+CREATE TABLE IF NOT EXISTS public.etl_watermarks (
+    table_name varchar(64) NOT NULL,
+    year int NOT NULL,
+    month int NOT NULL,
+    rows_loaded bigint,
+    loaded_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+PRIMARY KEY (table_name, year, month)
+);
+"""
+
+# Forget every load, used when the fact table is rebuilt from scratch
+clear_watermarks = """
+DELETE FROM public.etl_watermarks
+"""
+
+upsert_watermark = """
+DELETE FROM public.etl_watermarks
+WHERE table_name = %(table_name)s AND year = %(year)s AND month = %(month)s;
+
+INSERT INTO public.etl_watermarks (table_name, year, month, rows_loaded, loaded_at)
+VALUES (%(table_name)s, %(year)s, %(month)s, %(rows_loaded)s, %(loaded_at)s);
+"""
+
+
+# Data quality scan, one per table, with every metric the declared rules need
+# computed in a single pass over alias t
+quality_scan = """
+SELECT {metrics}
+FROM {source} t
+{joins}
+"""
+
+# Bounded sample of a table for quick smoke checks
+quality_sample = """(SELECT * FROM public.{table} LIMIT {rows})"""
+
+# (year, month) partitions present in staging immigration
+staged_immigration_partitions = """
+SELECT DISTINCT CAST(date_part('year', arrival_date) AS INT) AS year,
+CAST(date_part('month', arrival_date) AS INT) AS month
+FROM public.staging_immigration
+WHERE arrival_date IS NOT NULL
 """
 
 
 ## Testing Data
+# Reports on one month, given as year and month parameters
 imigrants_by_country = """
 SELECT c.country, COUNT(*) FROM fact_immigration i
 INNER JOIN dim_countries c ON i.country_id = c.country_id
 INNER JOIN dim_time t ON i.arrdate=t.sas_timestamp
-WHERE t.year=2016 AND t.month=4
+WHERE t.year=%(year)s AND t.month=%(month)s
 GROUP BY c.country
 ORDER BY count DESC
 LIMIT 10;
@@ -362,7 +562,122 @@ SELECT t.day_of_week,COUNT(*) as count
 FROM fact_immigration i
 INNER JOIN dim_ports p ON i.port_id = p.port_id
 INNER JOIN dim_time t ON i.arrdate=t.sas_timestamp
-WHERE t.year=2016 AND t.month=4
+WHERE t.year=%(year)s AND t.month=%(month)s
 GROUP BY t.day_of_week
 ORDER BY t.day_of_week
 """
+
+# Reporting queries answered from the monthly rollup
+imigrants_by_country_rollup = """
+SELECT c.country, SUM(a.immigrant_count) AS count FROM agg_monthly_immigration a
+INNER JOIN dim_countries c ON a.country_id = c.country_id
+WHERE a.year=%(year)s AND a.month=%(month)s
+GROUP BY c.country
+ORDER BY count DESC
+LIMIT 10;
+"""
+
+arrival_days_rollup = """
+SELECT a.day_of_week, SUM(a.immigrant_count) as count
+FROM agg_monthly_immigration a
+WHERE a.year=%(year)s AND a.month=%(month)s AND a.port_id IS NOT NULL
+GROUP BY a.day_of_week
+ORDER BY a.day_of_week
+"""
+
+# Whether the rollup holds a given month
+monthly_rollup_loaded = """
+SELECT COUNT(*) FROM etl_watermarks
+WHERE table_name = 'agg_monthly_immigration' AND year = %(year)s AND month = %(month)s
+"""
+
+# QUERY SERVICE CATALOG
+
+# Rollup months loaded within a (year * 12 + month) period range
+rollup_months_loaded = """
+SELECT COUNT(*) FROM etl_watermarks
+WHERE table_name = 'agg_monthly_immigration'
+AND year * 12 + month BETWEEN %(start_period)s AND %(end_period)s
+"""
+
+# Filters of every catalog query, on fact_immigration or agg_monthly_immigration as f.
+# The year range comes first so sort keys and zone maps can skip blocks
+catalog_filters = """
+f.year BETWEEN %(start_year)s AND %(end_year)s
+AND f.year * 12 + f.month BETWEEN %(start_period)s AND %(end_period)s
+AND (%(country)s IS NULL OR f.country_id IN (
+    SELECT country_id FROM public.dim_countries WHERE country = UPPER(%(country)s) OR country_code = %(country)s))
+AND (%(port)s IS NULL OR f.port_id IN (
+    SELECT port_id FROM public.dim_ports WHERE port_code = UPPER(%(port)s)))
+AND (%(visa_category)s IS NULL OR f.visa_category = %(visa_category)s)
+"""
+
+immigrants_by_country_query = """
+SELECT c.country, COUNT(*) AS count FROM public.fact_immigration f
+INNER JOIN public.dim_countries c ON f.country_id = c.country_id
+WHERE""" + catalog_filters + """GROUP BY c.country
+ORDER BY count DESC
+LIMIT %(limit)s;
+"""
+
+immigrants_by_country_rollup_query = """
+SELECT c.country, SUM(f.immigrant_count) AS count FROM public.agg_monthly_immigration f
+INNER JOIN public.dim_countries c ON f.country_id = c.country_id
+WHERE""" + catalog_filters + """GROUP BY c.country
+ORDER BY count DESC
+LIMIT %(limit)s;
+"""
+
+immigrants_by_port_query = """
+SELECT p.port_code, p.port_city, p.port_state, COUNT(*) AS count FROM public.fact_immigration f
+INNER JOIN public.dim_ports p ON f.port_id = p.port_id
+WHERE""" + catalog_filters + """GROUP BY p.port_code, p.port_city, p.port_state
+ORDER BY count DESC
+LIMIT %(limit)s;
+"""
+
+immigrants_by_port_rollup_query = """
+SELECT p.port_code, p.port_city, p.port_state, SUM(f.immigrant_count) AS count FROM public.agg_monthly_immigration f
+INNER JOIN public.dim_ports p ON f.port_id = p.port_id
+WHERE""" + catalog_filters + """GROUP BY p.port_code, p.port_city, p.port_state
+ORDER BY count DESC
+LIMIT %(limit)s;
+"""
+
+arrival_days_query = """
+SELECT t.day_of_week, COUNT(*) AS count FROM public.fact_immigration f
+INNER JOIN public.dim_time t ON f.arrdate = t.sas_timestamp
+WHERE f.port_id IS NOT NULL AND""" + catalog_filters + """GROUP BY t.day_of_week
+ORDER BY t.day_of_week;
+"""
+
+arrival_days_rollup_query = """
+SELECT f.day_of_week, SUM(f.immigrant_count) AS count FROM public.agg_monthly_immigration f
+WHERE f.port_id IS NOT NULL AND""" + catalog_filters + """GROUP BY f.day_of_week
+ORDER BY f.day_of_week;
+"""
+
+monthly_immigrants_query = """
+SELECT f.year, f.month, COUNT(*) AS count FROM public.fact_immigration f
+WHERE""" + catalog_filters + """GROUP BY f.year, f.month
+ORDER BY f.year, f.month;
+"""
+
+monthly_immigrants_rollup_query = """
+SELECT f.year, f.month, SUM(f.immigrant_count) AS count FROM public.agg_monthly_immigration f
+WHERE""" + catalog_filters + """GROUP BY f.year, f.month
+ORDER BY f.year, f.month;
+"""
+
+visa_categories_query = """
+SELECT f.visa_category, COUNT(*) AS count FROM public.fact_immigration f
+WHERE""" + catalog_filters + """GROUP BY f.visa_category
+ORDER BY count DESC;
+"""
+
+visa_categories_rollup_query = """
+SELECT f.visa_category, SUM(f.immigrant_count) AS count FROM public.agg_monthly_immigration f
+WHERE""" + catalog_filters + """GROUP BY f.visa_category
+ORDER BY count DESC;
+"""
+
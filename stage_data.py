@@ -1,9 +1,14 @@
 import configparser
 import re
-import psycopg2
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
 
-from sql_queries import create_staging_port_table, create_staging_country_table, create_staging_airport_table, create_staging_temperature_table, create_staging_demographic_table, create_staging_immigration_table, staging_airport_copy, staging_demographic_copy, staging_port_codes_copy, staging_country_codes_copy, staging_temperature_copy, staging_immigration_copy
+from db import run_transaction
+from instrumentation import span, traced, submit
+from warehouse import get_warehouse
+from sql_queries import create_staging_port_table, create_staging_country_table, create_staging_airport_table, create_staging_temperature_table, create_staging_demographic_table, create_staging_immigration_table, create_staging_immigration_keys_table, ensure_staging_load_table, record_staging_load
 
 
 import logging
@@ -11,56 +16,114 @@ logging.basicConfig(filename='staging.log', level=logging.DEBUG)
 logging.getLogger("py4j").setLevel(logging.ERROR)
 
 create_staging_table_queries = [
-    create_staging_port_table, create_staging_country_table, 
+    create_staging_port_table, create_staging_country_table,
     create_staging_airport_table, create_staging_temperature_table,
-    create_staging_demographic_table, create_staging_immigration_table
+    create_staging_demographic_table, create_staging_immigration_table,
+    create_staging_immigration_keys_table
 ]
 
-copy_staging_table_queries = [
-    staging_airport_copy, staging_demographic_copy, staging_port_codes_copy,
-    staging_country_codes_copy, staging_temperature_copy, staging_immigration_copy
-]
+# staging table -> (CREATE TABLE query, COPY query name in sql_queries)
+# largest first, so the immigration COPY starts before the small tables
+staging_tables = {
+    'staging_immigration': (create_staging_immigration_table, 'staging_immigration_copy'),
+    'staging_temperatures': (create_staging_temperature_table, 'staging_temperature_copy'),
+    'staging_airports': (create_staging_airport_table, 'staging_airport_copy'),
+    'staging_demographics': (create_staging_demographic_table, 'staging_demographic_copy'),
+    'staging_ports': (create_staging_port_table, 'staging_port_codes_copy'),
+    'staging_countries': (create_staging_country_table, 'staging_country_codes_copy'),
+    'staging_immigration_keys': (create_staging_immigration_keys_table, 'staging_immigration_keys_copy'),
+}
 
 
-def load_staging_tables(cur, conn):
+def create_tables(cur, conn):
     """
-    Load PARQUET files into staging tables
-    
+    Execute CREATE TABLE queries
+
     """
-    for query in copy_staging_table_queries:
-        cur.execute(query)
-        conn.commit()
+    warehouse = get_warehouse()
+    for query in create_staging_table_queries:
+        cur.execute(warehouse.ddl(query))
 
 
-def create_tables(cur, conn):
+def stage_table(cur, conn, table, use_manifests=True, incremental=False):
     """
-    Execute CREATE TABLE queries
-    
+    Create one staging table, copy its PARQUET files into it and record the load
+
+    The COPY itself is done by the configured warehouse backend. A full load
+    stages every processed immigration month, as the extract rebuilds the
+    fact table from staging.
+
+    Keyword arguments:
+    table -- staging table name
+    use_manifests -- copy only the files listed in the dataset's manifest
+    incremental -- stage only the immigration months written by the last preprocessing run
+
     """
-    for query in create_staging_table_queries:
-        cur.execute(query)
-        conn.commit()
+    create_query, copy_name = staging_tables[table]
+    warehouse = get_warehouse()
+
+    with span(f'stage {table}', table=table) as record:
+        start = time.perf_counter()
+        cur.execute(warehouse.ddl(create_query))
+        rows_loaded = warehouse.copy(cur, table, copy_name, use_manifests, incremental)
+        seconds = time.perf_counter() - start
+        record['rows_out'] = rows_loaded
 
+        cur.execute(ensure_staging_load_table)
+        cur.execute(record_staging_load, {'table_name': table, 'rows_loaded': rows_loaded,
+                                          'seconds': seconds, 'loaded_at': datetime.now()})
+    logging.info(f'Staged {rows_loaded} rows into {table} in {seconds:.1f}s')
+    return rows_loaded, seconds
 
-def stage_data():
+
+def load_staging_tables(max_workers=6, use_manifests=True, incremental=False):
     """
-    Connect to DB, create staging tables, copy data from S3 to DB
-    
+    Load PARQUET files into staging tables concurrently
+
+    Each table is created and copied in its own transaction on its own
+    pooled connection.
+
+    Keyword arguments:
+    max_workers -- number of COPYs running at the same time
+    use_manifests -- copy only the files listed in each dataset's manifest
+    incremental -- stage only the immigration months written by the last preprocessing run
+
     """
-    config = configparser.ConfigParser()
-    config.read('dl.cfg')
-
-    logging.info('Connecting to DB')
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
-    
-    logging.info('Creating Staging Tables')
-    create_tables(cur, conn)
-    logging.info('Copying Staging Tables')
-    load_staging_tables(cur, conn)
+    loads = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            submit(executor, run_transaction, 'stage', stage_table, table, use_manifests, incremental): table
+            for table in staging_tables
+        }
+        for future in as_completed(futures):
+            table = futures[future]
+            try:
+                loads[table] = future.result()
+            except Exception as e:
+                logging.error(f'Staging {table} failed: {e}')
+                failed.append(table)
+
+    if failed:
+        raise RuntimeError(f"Staging failed for {sorted(failed)}")
+    return loads
 
-    conn.close()
+
+@traced('stage_data')
+def stage_data(max_workers=6, use_manifests=True, incremental=False):
+    """
+    Create staging tables, copy processed data into the warehouse
+
+    Keyword arguments:
+    max_workers -- number of COPYs running at the same time
+    use_manifests -- copy only the files listed in each dataset's manifest
+    incremental -- stage only the immigration months written by the last
+                   preprocessing run, for extract_data(incremental=True)
+
+    """
+    logging.info('Copying Staging Tables')
+    return load_staging_tables(max_workers, use_manifests, incremental)
 
 
 if __name__ == "__main__":
-    stage_data()
\ No newline at end of file
+    stage_data()
@@ -0,0 +1,141 @@
+import json
+import re
+
+
+def hadoop_path(spark, path):
+    """
+    Resolve a path to its Hadoop FileSystem and Path objects
+
+    Keyword arguments:
+    spark -- Spark Context
+    path -- local or s3a path
+
+    """
+    jvm = spark._jvm
+    hpath = jvm.org.apache.hadoop.fs.Path(path)
+    fs = hpath.getFileSystem(spark._jsc.hadoopConfiguration())
+    return fs, hpath
+
+
+def path_exists(spark, path):
+    """
+    Check whether a file or directory exists
+
+    Keyword arguments:
+    spark -- Spark Context
+    path -- local or s3a path
+
+    """
+    fs, hpath = hadoop_path(spark, path)
+    return fs.exists(hpath)
+
+
+def write_text(spark, path, text):
+    """
+    Write a small text file, replacing any existing file
+
+    Keyword arguments:
+    spark -- Spark Context
+    path -- local or s3a path
+    text -- file contents
+
+    """
+    fs, hpath = hadoop_path(spark, path)
+    out = fs.create(hpath, True)
+    try:
+        out.write(bytearray(text.encode('utf-8')))
+    finally:
+        out.close()
+
+
+def read_text(spark, path):
+    """
+    Read a small text file
+
+    Keyword arguments:
+    spark -- Spark Context
+    path -- local or s3a path
+
+    """
+    fs, hpath = hadoop_path(spark, path)
+    stream = fs.open(hpath)
+    try:
+        return spark._jvm.org.apache.commons.io.IOUtils.toString(stream, 'UTF-8')
+    finally:
+        stream.close()
+
+
+def delete_path(spark, path):
+    """
+    Recursively delete a file or directory
+
+    Keyword arguments:
+    spark -- Spark Context
+    path -- local or s3a path
+
+    """
+    fs, hpath = hadoop_path(spark, path)
+    return fs.delete(hpath, True)
+
+
+def move_path(spark, source, target):
+    """
+    Move a file or directory, creating the target's parent directories
+
+    Keyword arguments:
+    spark -- Spark Context
+    source -- local or s3a path to move
+    target -- local or s3a path it ends up at
+
+    """
+    fs, source_path = hadoop_path(spark, source)
+    _, target_path = hadoop_path(spark, target)
+    fs.mkdirs(target_path.getParent())
+    if not fs.rename(source_path, target_path):
+        raise IOError(f'Could not move {source} to {target}')
+
+
+def list_files(spark, path, pattern='*'):
+    """
+    List data files below a directory with their sizes
+
+    Hidden and marker files (names starting with _ or .) are skipped.
+
+    Keyword arguments:
+    spark -- Spark Context
+    path -- local or s3a directory
+    pattern -- glob below path selecting directories to list, such as year=*/month=4
+
+    """
+    fs, hpath = hadoop_path(spark, path.rstrip('/') + '/' + pattern)
+    statuses = fs.globStatus(hpath) or []
+
+    files = []
+    pending = list(statuses)
+    while pending:
+        status = pending.pop()
+        name = status.getPath().getName()
+        if name.startswith('_') or name.startswith('.'):
+            continue
+        if status.isDirectory():
+            pending.extend(fs.listStatus(status.getPath()))
+        else:
+            files.append((status.getPath().toString(), status.getLen()))
+    return sorted(files)
+
+
+def copy_manifest(files):
+    """
+    Redshift COPY manifest for a list of files
+
+    Parquet manifests need each file's content_length.
+
+    Keyword arguments:
+    files -- (path, size) pairs from list_files
+
+    """
+    entries = [
+        {'url': re.sub(r'^s3a://', 's3://', path), 'mandatory': True, 'meta': {'content_length': size}}
+        for path, size in files
+    ]
+    return json.dumps({'entries': entries}, indent=1)
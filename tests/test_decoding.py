@@ -0,0 +1,68 @@
+import pytest
+
+pytest.importorskip('pyspark')
+
+from pyspark.sql import SparkSession
+
+from decoding import I94_CODES, I94_CODE_DECODERS, I94_DATES, I94_DAYS, decode_immigration
+
+DECODED_COLUMNS = list(I94_DATES) + list(I94_DAYS) + list(I94_CODES)
+
+# id, arrdate, depdate, i94mode, i94visa; SAS days and codes are doubles as in the raw files
+ROWS = [
+    (1, 20545.0, 20560.0, 1.0, 1.0),
+    (2, 20546.0, None, 2.0, 2.0),
+    (3, None, 20570.0, 3.0, 3.0),
+    (4, None, None, None, None),
+    (5, 20545.5, 20560.99, 9.0, 0.0),
+    (6, 20573.25, 20574.75, 0.0, 4.0),
+    (7, -0.5, -1.5, -1.0, 2.5),
+    (8, 0.0, 59.0, 4.0, 99.0),
+]
+
+
+@pytest.fixture(scope='module')
+def spark():
+    spark = SparkSession.builder.master('local[1]').appName('test-decoding').getOrCreate()
+    yield spark
+    spark.stop()
+
+
+@pytest.fixture(scope='module')
+def i94(spark):
+    return spark.createDataFrame(ROWS, 'id long, arrdate double, depdate double, i94mode double, i94visa double')
+
+
+def decoded_rows(i94, engine):
+    return {row['id']: row.asDict() for row in decode_immigration(i94, engine=engine).select(['id'] + DECODED_COLUMNS).collect()}
+
+
+def test_engines_agree(i94):
+    native = decoded_rows(i94, 'native')
+    reference = decoded_rows(i94, 'udf')
+    assert native == reference
+
+
+def test_null_dates_stay_null(i94):
+    native = decoded_rows(i94, 'native')
+    assert native[4]['arrival_date'] is None
+    assert native[4]['departure_date'] is None
+    assert native[4]['arrival_day'] is None
+
+
+def test_unknown_codes_get_defaults(i94):
+    native = decoded_rows(i94, 'native')
+    for row_id in [4, 5, 6]:
+        for column, (_, _, default) in I94_CODES.items():
+            assert native[row_id][column] == default
+
+
+@pytest.mark.parametrize('column', list(I94_CODES))
+def test_reference_decoders_match_code_table(column):
+    _, codes, default = I94_CODES[column]
+    decoder = I94_CODE_DECODERS[column]
+    for code, label in codes.items():
+        assert decoder(code) == label
+        assert decoder(float(code)) == label
+    for code in [None, 0, -1, max(codes) + 1, 2.5]:
+        assert decoder(code) == default
@@ -0,0 +1,159 @@
+import logging
+from datetime import date, timedelta
+
+from psycopg2.extras import execute_values
+
+from db import run_transaction, add_missing_columns
+from instrumentation import traced, annotate
+from schemas import WAREHOUSE_TABLES
+from sql_queries import staged_day_range, complete_time_day_count, complete_time_days, create_time_load_table, insert_time_load, upsert_time_load
+
+logging.basicConfig(filename='staging.log', level=logging.DEBUG)
+logging.getLogger("py4j").setLevel(logging.ERROR)
+
+SAS_EPOCH = date(1960, 1, 1)
+
+# rows per multi-row INSERT into the load table
+INSERT_PAGE_ROWS = 1000
+
+
+def nth_weekday(year, month, weekday, n):
+    """
+    Date of the nth weekday of a month, counting from the end for negative n
+
+    Keyword arguments:
+    year -- year
+    month -- month (1-12)
+    weekday -- Monday is 0, as in date.weekday
+    n -- 1 for the first, -1 for the last
+
+    """
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+    return last - timedelta(days=(last.weekday() - weekday) % 7 + 7 * (-n - 1))
+
+
+# US federal holiday -> (first year observed, date in a given year)
+# Holidays are flagged on the day they fall, not on a weekday they are observed on
+US_HOLIDAYS = {
+    "New Year's Day": (1870, lambda year: date(year, 1, 1)),
+    'Martin Luther King Jr. Day': (1986, lambda year: nth_weekday(year, 1, 0, 3)),
+    "Washington's Birthday": (1971, lambda year: nth_weekday(year, 2, 0, 3)),
+    'Memorial Day': (1971, lambda year: nth_weekday(year, 5, 0, -1)),
+    'Juneteenth': (2021, lambda year: date(year, 6, 19)),
+    'Independence Day': (1870, lambda year: date(year, 7, 4)),
+    'Labor Day': (1894, lambda year: nth_weekday(year, 9, 0, 1)),
+    'Columbus Day': (1971, lambda year: nth_weekday(year, 10, 0, 2)),
+    'Veterans Day': (1938, lambda year: date(year, 11, 11)),
+    'Thanksgiving Day': (1942, lambda year: nth_weekday(year, 11, 3, 4)),
+    'Christmas Day': (1870, lambda year: date(year, 12, 25)),
+}
+
+
+def holidays(year):
+    """
+    US federal holidays of a year by date
+
+    """
+    return {rule(year): name for name, (since, rule) in US_HOLIDAYS.items() if year >= since}
+
+
+def sas_date(sas_day):
+    return SAS_EPOCH + timedelta(days=sas_day)
+
+
+def calendar_row(sas_day, year_holidays):
+    """
+    dim_time row of one SAS day, in table column order
+
+    week and iso_year are the ISO 8601 week and its year, day_of_week
+    counts from 0 on Sunday as date_part('dow') does.
+
+    Keyword arguments:
+    sas_day -- days since 1960-01-01
+    year_holidays -- holidays of the day's year from holidays()
+
+    """
+    day = sas_date(sas_day)
+    iso_year, iso_week, iso_weekday = day.isocalendar()
+    holiday = year_holidays.get(day)
+    return (sas_day, day.year, day.month, day.day, iso_week, iso_weekday % 7, (day.month - 1) // 3 + 1,
+            iso_year, iso_weekday >= 6, holiday is not None, holiday)
+
+
+def calendar_rows(sas_days):
+    """
+    dim_time rows of a set of SAS days
+
+    """
+    rows, year_holidays = [], {}
+    for sas_day in sorted(sas_days):
+        year = sas_date(sas_day).year
+        if year not in year_holidays:
+            year_holidays[year] = holidays(year)
+        rows.append(calendar_row(sas_day, year_holidays[year]))
+    return rows
+
+
+def calendar_range(cur):
+    """
+    First and last SAS day of the whole years spanned by staged arrival and departure dates
+
+    Arrival years and departure days come from staging_immigration_keys.
+    Whole years are covered so later months usually need no new days.
+    Returns None when staging is empty.
+
+    """
+    cur.execute(staged_day_range)
+    first_year, last_year, first_departure, last_departure = cur.fetchone()
+    years = [year for year in [first_year, last_year] if year is not None]
+    years += [sas_date(day).year for day in [first_departure, last_departure] if day is not None]
+    if not years:
+        return None
+    return (date(min(years), 1, 1) - SAS_EPOCH).days, (date(max(years), 12, 31) - SAS_EPOCH).days
+
+
+def upsert_time_dimension(cur, conn):
+    """
+    Extend dim_time to the calendar range of the staged dates
+
+    Days already in dim_time with every attribute set are left alone, so
+    once the range is covered this reads two aggregates and writes nothing.
+
+    """
+    day_range = calendar_range(cur)
+    if day_range is None:
+        logging.info('No staged dates, dim_time unchanged')
+        return 0
+    first_day, last_day = day_range
+    params = {'first_day': first_day, 'last_day': last_day}
+
+    # rows of a dim_time from before a column existed are filled in as incomplete days
+    add_missing_columns(cur, WAREHOUSE_TABLES['dim_time'])
+    cur.execute(complete_time_day_count, params)
+    if cur.fetchone()[0] == last_day - first_day + 1:
+        logging.info(f'dim_time already covers SAS days {first_day}-{last_day}')
+        annotate(rows_out=0)
+        return 0
+
+    cur.execute(complete_time_days, params)
+    complete = {row[0] for row in cur.fetchall()}
+    rows = calendar_rows(set(range(first_day, last_day + 1)) - complete)
+
+    cur.execute(create_time_load_table)
+    execute_values(cur, insert_time_load, rows, page_size=INSERT_PAGE_ROWS)
+    cur.execute(upsert_time_load)
+    annotate(rows_out=len(rows))
+    logging.info(f'Upserted {len(rows)} days into dim_time for SAS days {first_day}-{last_day}')
+    return len(rows)
+
+
+@traced('load_time_dimension')
+def load_time_dimension():
+    """
+    Upsert the calendar days the staged immigration data needs into dim_time
+
+    """
+    return run_transaction('extract', upsert_time_dimension)
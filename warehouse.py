@@ -0,0 +1,334 @@
+import configparser
+import glob
+import json
+import os
+import re
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, repeat
+
+import schemas
+import sql_queries
+from sql_queries import last_copy_count, staging_column_types
+
+import logging
+logging.basicConfig(filename='staging.log', level=logging.DEBUG)
+logging.getLogger("py4j").setLevel(logging.ERROR)
+
+# PostgreSQL binary COPY framing
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('>h', -1)
+NULL_FIELD = struct.pack('>i', -1)
+# days and microseconds between the Unix and PostgreSQL epochs
+PG_EPOCH_DAYS = 10957
+PG_EPOCH_MICROS = PG_EPOCH_DAYS * 86400 * 1000000
+
+# bytes psycopg2 reads from the stream per COPY message
+COPY_READ_BYTES = 1 << 20
+
+_warehouse = None
+
+
+class RedshiftWarehouse:
+    """
+    Redshift cluster loading processed Parquet from S3 with COPY
+
+    """
+    name = 'redshift'
+    connection_section = 'CLUSTER'
+
+    def __init__(self, processed_path='s3a://staging-immigration/', validate=True):
+        self.processed_path = processed_path
+        self.validate = validate
+
+    def ddl(self, query):
+        return query
+
+    def check_files(self, dataset, use_manifests=True, incremental=False):
+        """
+        Check the Parquet footers of a dataset on S3 against the schema registry
+
+        A mismatch fails here with the file and column named, rather than
+        as a Redshift COPY error.
+
+        Keyword arguments:
+        dataset -- output directory name below processed_path
+        use_manifests -- check only the files in the dataset's manifest
+        incremental -- check the manifest of the months written by the last run
+
+        """
+        import pyarrow.fs as pa_fs
+        import pyarrow.parquet as pq
+        from reference_data import filesystem
+
+        fs, root = filesystem(self.processed_path)
+        root = root.rstrip('/')
+        if use_manifests:
+            with fs.open_input_stream(f'{root}/manifests/{sql_queries.manifest_name(dataset, incremental)}.manifest') as f:
+                entries = json.loads(f.read())['entries']
+            paths = [re.sub(r'^s3a?://', '', entry['url']) for entry in entries]
+        else:
+            infos = fs.get_file_info(pa_fs.FileSelector(f'{root}/{dataset}', recursive=True))
+            paths = [info.path for info in infos
+                     if info.is_file and not info.base_name.startswith(('_', '.'))]
+
+        def check(path):
+            schemas.check_arrow(pq.read_schema(path, filesystem=fs), dataset, path)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(check, paths))
+
+    def copy(self, cur, table, copy_name, use_manifests=True, incremental=False):
+        """
+        COPY a dataset into a staging table and return the rows loaded
+
+        Keyword arguments:
+        table -- staging table name
+        copy_name -- COPY query name in sql_queries.STAGING_COPIES
+        use_manifests -- copy only the files listed in the dataset's manifest
+        incremental -- copy only the months written by the last preprocessing run
+
+        """
+        if self.validate:
+            _, _, dataset = sql_queries.STAGING_COPIES[copy_name]
+            self.check_files(dataset, use_manifests, incremental)
+        cur.execute(getattr(sql_queries, sql_queries.copy_query_name(copy_name, use_manifests, incremental)))
+        cur.execute(last_copy_count)
+        return cur.fetchone()[0]
+
+
+class PostgresWarehouse:
+    """
+    PostgreSQL database loading processed Parquet from a local directory
+
+    Files are streamed into staging tables with binary COPY FROM STDIN, a
+    record batch at a time, and map to columns by position as Redshift's
+    Parquet COPY does.
+
+    """
+    name = 'postgres'
+    connection_section = 'POSTGRES'
+
+    def __init__(self, processed_path='data/processed/', batch_rows=100000):
+        self.processed_path = processed_path
+        self.batch_rows = batch_rows
+
+    def ddl(self, query):
+        """
+        Redshift DDL without its distribution and sort clauses
+
+        """
+        return re.sub(r'\s*(DISTSTYLE \w+|SORTKEY \([^)]*\))', '', query)
+
+    def dataset_files(self, dataset, use_manifests=True, incremental=False):
+        """
+        Local Parquet files of a processed dataset
+
+        Keyword arguments:
+        dataset -- output directory name below processed_path
+        use_manifests -- list only the files in the dataset's manifest
+        incremental -- list the manifest of the months written by the last run
+
+        """
+        if use_manifests:
+            name = sql_queries.manifest_name(dataset, incremental)
+            with open(os.path.join(self.processed_path, 'manifests', f'{name}.manifest')) as f:
+                return [re.sub(r'^file:', '', entry['url']) for entry in json.load(f)['entries']]
+        pattern = os.path.join(self.processed_path, dataset, '**', '*.parquet')
+        return sorted(path for path in glob.glob(pattern, recursive=True)
+                      if not os.path.basename(path).startswith(('_', '.')))
+
+    def copy(self, cur, table, copy_name, use_manifests=True, incremental=False):
+        """
+        Stream a dataset into a staging table and return the rows loaded
+
+        Keyword arguments:
+        table -- staging table name
+        copy_name -- COPY query name in sql_queries.STAGING_COPIES
+        use_manifests -- copy only the files listed in the dataset's manifest
+        incremental -- copy only the months written by the last preprocessing run
+
+        """
+        _, _, dataset = sql_queries.STAGING_COPIES[copy_name]
+        cur.execute(staging_column_types, {'table_name': table})
+        column_types = [data_type for _, data_type in cur.fetchall()]
+
+        stream = BinaryCopyStream(self.dataset_files(dataset, use_manifests, incremental), column_types, self.batch_rows, dataset)
+        cur.copy_expert(f'COPY public.{table} FROM STDIN WITH (FORMAT binary)', stream, size=COPY_READ_BYTES)
+        return stream.rows
+
+
+class BinaryCopyStream:
+    """
+    File-like object producing PostgreSQL binary COPY data from Parquet files
+
+    Only one encoded record batch is held in memory at a time. With a
+    dataset, each file is checked against the schema registry before it
+    is read.
+
+    """
+    def __init__(self, paths, column_types, batch_rows, dataset=None):
+        self.paths = paths
+        self.column_types = column_types
+        self.batch_rows = batch_rows
+        self.dataset = dataset
+        self.rows = 0
+        self.chunks = self.generate()
+        self.buffer = b''
+        self.offset = 0
+
+    def generate(self):
+        import pyarrow.parquet as pq
+
+        yield PGCOPY_HEADER
+        for path in self.paths:
+            parquet = pq.ParquetFile(path)
+            if self.dataset is not None:
+                schemas.check_arrow(parquet.schema_arrow, self.dataset, path)
+            if len(parquet.schema_arrow.names) != len(self.column_types):
+                raise ValueError(f'{path} has {len(parquet.schema_arrow.names)} columns, '
+                                 f'the table has {len(self.column_types)}')
+            for batch in parquet.iter_batches(batch_size=self.batch_rows):
+                self.rows += batch.num_rows
+                yield encode_batch(batch, self.column_types)
+        yield PGCOPY_TRAILER
+
+    def read(self, size=-1):
+        parts = []
+        while size < 0 or size > 0:
+            if self.offset == len(self.buffer):
+                self.buffer, self.offset = next(self.chunks, b''), 0
+                if not self.buffer:
+                    break
+            end = len(self.buffer) if size < 0 else min(len(self.buffer), self.offset + size)
+            parts.append(self.buffer[self.offset:end])
+            if size > 0:
+                size -= end - self.offset
+            self.offset = end
+        return b''.join(parts)
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+# PostgreSQL type -> (Arrow type name, numpy big-endian dtype or None for text)
+BINARY_TYPES = {
+    'double precision': ('float64', '>f8'),
+    'real': ('float32', '>f4'),
+    'integer': ('int32', '>i4'),
+    'bigint': ('int64', '>i8'),
+    'smallint': ('int16', '>i2'),
+    'date': ('date32', '>i4'),
+    'timestamp without time zone': ('timestamp', '>i8'),
+    'text': ('string', None),
+    'character varying': ('string', None),
+}
+
+
+def encode_column(column, data_type):
+    """
+    Binary COPY fields of one Arrow column, each with its length prefix
+
+    Keyword arguments:
+    column -- Arrow array
+    data_type -- PostgreSQL type of the target column
+
+    """
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if data_type not in BINARY_TYPES:
+        raise ValueError(f'No binary COPY encoding for {data_type} columns')
+    arrow_type, dtype = BINARY_TYPES[data_type]
+
+    if dtype is None:
+        encoded = []
+        for value in pc.cast(column, pa.string()).to_pylist():
+            if value is None:
+                encoded.append(NULL_FIELD)
+            else:
+                value = value.encode('utf-8')
+                encoded.append(struct.pack('>i', len(value)) + value)
+        return encoded
+
+    if arrow_type == 'date32':
+        column = pc.cast(column, pa.date32())
+        values = pc.subtract(pc.cast(column, pa.int32()), PG_EPOCH_DAYS)
+    elif arrow_type == 'timestamp':
+        column = pc.cast(column, pa.timestamp('us'))
+        values = pc.subtract(pc.cast(column, pa.int64()), PG_EPOCH_MICROS)
+    else:
+        values = pc.cast(column, getattr(pa, arrow_type)(), safe=False)
+
+    width = np.dtype(dtype).itemsize
+    fields = np.empty(len(column), dtype=[('length', '>i4'), ('value', dtype)])
+    fields['length'] = width
+    fields['value'] = values.fill_null(0).to_numpy(zero_copy_only=False)
+    blob = fields.tobytes()
+    step = 4 + width
+    encoded = [blob[i:i + step] for i in range(0, len(blob), step)]
+    if column.null_count:
+        for i in np.flatnonzero(column.is_null().to_numpy(zero_copy_only=False)):
+            encoded[i] = NULL_FIELD
+    return encoded
+
+
+def encode_batch(batch, column_types):
+    """
+    Binary COPY tuples of an Arrow record batch
+
+    Keyword arguments:
+    batch -- Arrow record batch, columns in table order
+    column_types -- PostgreSQL types of the table columns
+
+    """
+    columns = [encode_column(column, data_type) for column, data_type in zip(batch.columns, column_types)]
+    tuple_header = struct.pack('>h', len(column_types))
+    return b''.join(chain.from_iterable(zip(repeat(tuple_header, batch.num_rows), *columns)))
+
+
+WAREHOUSES = {
+    'redshift': RedshiftWarehouse,
+    'postgres': PostgresWarehouse,
+}
+
+
+def read_warehouse(config_path='dl.cfg'):
+    """
+    Warehouse backend named in the configuration, Redshift by default
+
+    Keyword arguments:
+    config_path -- configuration file location
+
+    """
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    backend = config.get('WAREHOUSE', 'BACKEND', fallback='redshift')
+    if backend not in WAREHOUSES:
+        raise ValueError(f"Unknown warehouse backend {backend}. Expected one of {sorted(WAREHOUSES)}")
+    if backend == 'postgres':
+        return PostgresWarehouse(config.get('WAREHOUSE', 'LOCAL_PATH', fallback='data/processed/'),
+                                 config.getint('WAREHOUSE', 'BATCH_ROWS', fallback=100000))
+    return RedshiftWarehouse(validate=config.getboolean('WAREHOUSE', 'VALIDATE_PARQUET', fallback=True))
+
+
+def get_warehouse():
+    """
+    Warehouse backend, read once per process
+
+    """
+    global _warehouse
+    if _warehouse is None:
+        _warehouse = read_warehouse()
+    return _warehouse
+
+
+def use_warehouse(warehouse):
+    """
+    Replace the configured warehouse backend, e.g. with a local PostgreSQL in benchmarks
+
+    """
+    global _warehouse
+    _warehouse = warehouse
+    return warehouse